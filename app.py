@@ -2,16 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import atexit
+import logging
+import logging.handlers
 import telebot
-from telebot import types
-from flask import Flask, request, render_template_string, redirect, session, jsonify
+from telebot import types, apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from flask import Flask, request, render_template, redirect, session, jsonify, g
+from werkzeug.middleware.proxy_fix import ProxyFix
 import json
 import random
 import hashlib
+import hmac
 import time
 import uuid
+import queue
+import threading
+import datetime
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import collections
+import heapq
+import itertools
+import math
+import functools
+import dataclasses
+import tracemalloc
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
 from dotenv import load_dotenv
 
 # تحميل متغيرات البيئة من .env (للتطوير)
@@ -24,6 +46,651 @@ try:
 except ImportError:
     USE_FIELD_FILTER = False
 
+# --- السجلات (JSON منظم بدون حجب) ---
+# الطلبات تضع السجلات في طابور فقط، وخيط خلفي (QueueListener) ينسقها ويكتبها على stdout
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.05))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+class JsonLogFormatter(logging.Formatter):
+    """سطر JSON واحد لكل سجل"""
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': record.getMessage(),
+            'logger': record.name,
+            'thread': record.threadName,
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """يضع السجل في الطابور دون تنسيق، ويتجاهله (مع العد) إذا تجاوز الطابور max_size بدل حجب الطلب.
+    SimpleQueue أسرع بكثير من queue.Queue لأنه بدون Condition، لذلك نطبق الحد يدوياً"""
+    def __init__(self, max_size):
+        super().__init__(queue.SimpleQueue())
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        # التنسيق وتحويل JSON يتمان في خيط الكتابة وليس في خيط الطلب
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put(record)
+
+class StructuredLogger:
+    """واجهة مختصرة: log.info("حدث", key=value) مع أخذ عينات للأحداث المتكررة"""
+    def __init__(self, logger, sample_rate):
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def _log(self, level, event, sample=False, exc=False, **fields):
+        # نتحقق من المستوى والعينة قبل إنشاء السجل حتى تكون السجلات المعطلة شبه مجانية
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample:
+            if random.random() >= self.sample_rate:
+                return
+            fields['sample_rate'] = self.sample_rate
+        # بناء السجل مباشرة بدون findCaller (لا نحتاج رقم السطر) لأنه أغلى جزء في logger.log
+        record = self.logger.makeRecord(self.logger.name, level, '', 0, event, None,
+                                        sys.exc_info() if exc else None, extra={'fields': fields})
+        self.logger.handle(record)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, **fields)
+
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(JsonLogFormatter())
+log_queue_handler = DroppingQueueHandler(LOG_QUEUE_SIZE)
+log_listener = None
+
+def start_log_listener():
+    """تشغيل خيط الكتابة (يعاد تشغيله بعد fork في كل عامل gunicorn)"""
+    global log_listener
+    log_queue_handler.queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue_handler.queue, _log_stream_handler)
+    log_listener.start()
+
+def stop_log_listener():
+    """تفريغ ما تبقى في الطابور قبل الخروج"""
+    if log_listener is not None and log_listener._thread is not None:
+        log_listener.stop()
+
+logging.logProcesses = False
+logging.logMultiprocessing = False
+_app_logger = logging.getLogger("tr-mm")
+_app_logger.setLevel(LOG_LEVEL)
+_app_logger.propagate = False
+_app_logger.addHandler(log_queue_handler)
+start_log_listener()
+os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(stop_log_listener)
+log = StructuredLogger(_app_logger, LOG_SAMPLE_RATE)
+
+# --- المقاييس (بصيغة Prometheus) ---
+# كل عامل gunicorn يحتفظ بمقاييسه الخاصة، ويعرضها عبر /metrics
+
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _metric_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Histogram:
+    """توزيع زمني (buckets تراكمية + المجموع + العدد) لكل مجموعة قيم labels"""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def timed(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(labels, time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labelnames, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_metric_labels(self.labelnames, labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Counter:
+    """عداد تراكمي لكل مجموعة قيم labels"""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        labels = labels if isinstance(labels, tuple) else (labels,)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class CallbackMetric:
+    """قيم تُحسب عند القراءة (أطوال الطوابير، نسب الإصابة في الذاكرة المؤقتة...)
+    fn ترجع رقماً أو قاموس {labels_tuple: قيمة}"""
+
+    def __init__(self, name, help_text, fn, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception as e:
+            log.warning("خطأ في حساب المقياس", metric=self.name, error=str(e))
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            lines.append(f"{self.name}{_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class MetricsRegistry:
+    """سجل المقاييس وتحويلها لصيغة Prometheus النصية"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=()):
+        return self.register(Histogram(name, help_text, labelnames))
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def callback(self, name, help_text, fn, labelnames=(), kind='gauge'):
+        return self.register(CallbackMetric(name, help_text, fn, labelnames, kind))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+http_latency = metrics.histogram('http_request_duration_seconds', 'زمن طلبات Flask لكل مسار', ['route', 'method', 'status'])
+handler_latency = metrics.histogram('bot_handler_duration_seconds', 'زمن معالجات البوت', ['handler'])
+handler_errors = metrics.counter('bot_handler_errors_total', 'أخطاء معالجات البوت', ['handler'])
+firestore_latency = metrics.histogram('firestore_operation_duration_seconds', 'زمن عمليات Firestore', ['operation'])
+telegram_latency = metrics.histogram('telegram_api_duration_seconds', 'زمن استدعاءات Telegram Bot API', ['method', 'transport'])
+metrics.callback('log_queue_depth', 'عدد السجلات المنتظرة في طابور الكتابة',
+                 lambda: log_queue_handler.queue.qsize())
+metrics.callback('log_records_dropped_total', 'عدد السجلات المتجاهلة بسبب امتلاء الطابور',
+                 lambda: log_queue_handler.dropped, kind='counter')
+
+# --- التتبع (spans بصيغة OpenTelemetry) ---
+# كل طلب Flask وكل تحديث تيليجرام يبدأ trace، وكل استدعاء خارجي (Firestore / Bot API) يصبح span فرعياً.
+# الـ traces المكتملة تُحفظ في الذاكرة لعرضها في /debug/traces، واختيارياً في ملف JSON lines
+# بصيغة OTLP/JSON (TRACE_EXPORT_FILE) يمكن قراءته بأي أداة متوافقة مع OpenTelemetry.
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1.0))
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 500))
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "")
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_NOT_SAMPLED = object()
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class Span:
+    """عملية واحدة داخل trace (الأزمنة بالنانو ثانية كما في OpenTelemetry)"""
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, trace, name, parent_id, kind, attributes):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self):
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_otel(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or self.start_ns),
+            'attributes': [{'key': key, 'value': _otel_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+class Trace:
+    """مجموعة spans لطلب واحد (أول span هو الجذر)"""
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+
+    @property
+    def root(self):
+        return self.spans[0]
+
+    @property
+    def duration_ms(self):
+        return self.root.duration_ms
+
+    def to_otel(self):
+        """resourceSpans بصيغة OTLP/JSON"""
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'tr-mm'}}]},
+            'scopeSpans': [{'scope': {'name': 'tr-mm'}, 'spans': [span.to_otel() for span in self.spans]}],
+        }]}
+
+class InMemoryTraceExporter:
+    """آخر TRACE_BUFFER_SIZE trace في الذاكرة لصفحة /debug/traces"""
+
+    def __init__(self, size):
+        self.traces = collections.deque(maxlen=size)
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+    def slowest(self, limit=20, name=None):
+        traces = [trace for trace in list(self.traces) if name is None or trace.root.name == name]
+        return sorted(traces, key=lambda trace: trace.duration_ms, reverse=True)[:limit]
+
+class FileTraceExporter:
+    """كتابة كل trace كسطر OTLP/JSON في ملف عبر خيط خلفي (بدون حجب الطلب)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.started_pid = None
+        self.lock = threading.Lock()
+
+    def export(self, trace):
+        with self.lock:
+            if self.started_pid != os.getpid():
+                self.queue = queue.SimpleQueue()
+                threading.Thread(target=self._writer, args=(self.queue,), name="trace-exporter", daemon=True).start()
+                self.started_pid = os.getpid()
+        self.queue.put(trace)
+
+    def _writer(self, trace_queue):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                trace = trace_queue.get()
+                try:
+                    f.write(json.dumps(trace.to_otel(), ensure_ascii=False, default=str) + '\n')
+                    if trace_queue.empty():
+                        f.flush()
+                except Exception as e:
+                    log.warning("خطأ في كتابة التتبع", error=str(e))
+
+class Tracer:
+    """إنشاء spans وربطها بالـ span الحالي عبر contextvars"""
+
+    def __init__(self, exporters, sample_rate):
+        self.exporters = exporters
+        self.sample_rate = sample_rate
+
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, root=False, **attributes):
+        """ترجع (span, parent) أو (None, parent) إذا لم يكن هناك trace نشط.
+        root=True يسمح ببدء trace جديد عندما لا يوجد trace حالي"""
+        parent = _current_span.get()
+        if parent is _NOT_SAMPLED or (parent is None and not root):
+            return None, parent
+        if parent is None:
+            if random.random() >= self.sample_rate:
+                _current_span.set(_NOT_SAMPLED)
+                return None, parent
+            trace = Trace()
+            span = Span(trace, name, None, kind, attributes)
+        else:
+            trace = parent.trace
+            span = Span(trace, name, parent.span_id, kind, attributes)
+        trace.spans.append(span)
+        _current_span.set(span)
+        return span, parent
+
+    def end_span(self, span, parent, error=None):
+        _current_span.set(parent)
+        if span is None:
+            return
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        if span.parent_id is None:
+            for exporter in self.exporters:
+                exporter.export(span.trace)
+
+    @contextlib.contextmanager
+    def span(self, name, kind=SPAN_KIND_INTERNAL, root=False, **attributes):
+        span, parent = self.start_span(name, kind, root, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.end_span(span, parent, e)
+            raise
+        self.end_span(span, parent)
+
+    def bind(self, coro):
+        """تمرير الـ span الحالي إلى coroutine ستعمل في حلقة asyncio بخيط آخر"""
+        parent = _current_span.get()
+
+        async def run():
+            _current_span.set(parent)
+            return await coro
+        return run()
+
+trace_store = InMemoryTraceExporter(TRACE_BUFFER_SIZE)
+tracer = Tracer([trace_store] + ([FileTraceExporter(TRACE_EXPORT_FILE)] if TRACE_EXPORT_FILE else []), TRACE_SAMPLE_RATE)
+
+# --- أدوات التشخيص (profiler بالعينات و tracemalloc) ---
+# يعمل على العامل الحالي فقط (كل عامل gunicorn عملية مستقلة)، ويُشغل عند الطلب من لوحة المالك.
+# النتيجة بصيغة collapsed stacks (سطر لكل مسار استدعاء + عدد العينات) المتوافقة مع flamegraph.pl و speedscope.
+
+PROFILER_MAX_SECONDS = int(os.environ.get("PROFILER_MAX_SECONDS", 120))
+PROFILER_INTERVAL_MS = float(os.environ.get("PROFILER_INTERVAL_MS", 10))
+
+# دوال انتظار نتجاهلها افتراضياً حتى لا تغطي الخيوط الخاملة على العمل الفعلي
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('handlers.py', 'dequeue'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'accept'),
+    ('socketserver.py', 'serve_forever'),
+    ('base_events.py', '_run_once'),
+}
+
+class SamplingProfiler:
+    """يأخذ عينة من مكدس كل خيط كل interval ويجمعها كـ collapsed stacks"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.running = False
+        self.started_at = None
+        self.finished_at = None
+        self.seconds = 0
+        self.interval = PROFILER_INTERVAL_MS / 1000
+        self.include_idle = False
+        self.stop_event = threading.Event()
+
+    def start(self, seconds, interval_ms=PROFILER_INTERVAL_MS, include_idle=False):
+        """بدء جلسة جديدة (ترجع False إذا كانت هناك جلسة قيد التشغيل)"""
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = {}
+            self.samples = 0
+            self.running = True
+            self.started_at = time.time()
+            self.finished_at = None
+            self.seconds = max(1, min(int(seconds), PROFILER_MAX_SECONDS))
+            self.interval = max(float(interval_ms), 1.0) / 1000
+            self.include_idle = include_idle
+            self.stop_event.clear()
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _frame_name(self, code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self.stop_event.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)).replace(';', ','))
+                key = ';'.join(reversed(stack))
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            with self.lock:
+                self.samples += 1
+            self.stop_event.wait(self.interval)
+        with self.lock:
+            self.running = False
+            self.finished_at = time.time()
+
+    def status(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'running': self.running,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'seconds': self.seconds,
+                'interval_ms': self.interval * 1000,
+                'samples': self.samples,
+                'stacks': len(self.stacks),
+            }
+
+    def collapsed(self):
+        """سطر لكل مسار: thread;outer;...;inner count (الأكثر أولاً)"""
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
+
+class MemorySnapshots:
+    """لقطات tracemalloc مع مقارنة كل لقطة بالسابقة لمعرفة مصادر نمو الذاكرة"""
+
+    # طرق التجميع التي يقبلها Snapshot.statistics
+    GROUPS = ('lineno', 'filename', 'traceback')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def start(self, frames=10):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.previous = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+    def snapshot(self, top=25, key_type='lineno'):
+        """أكبر مواقع التخصيص الحالية والفرق عن اللقطة السابقة"""
+        if not tracemalloc.is_tracing():
+            return None
+        with self.lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            current, peak = tracemalloc.get_traced_memory()
+            result = {
+                'pid': os.getpid(),
+                'traced_current_bytes': current,
+                'traced_peak_bytes': peak,
+                'top': [
+                    {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics(key_type)[:top]
+                ],
+            }
+            if self.previous is not None:
+                result['diff'] = [
+                    {'location': str(stat.traceback), 'size_diff_bytes': stat.size_diff,
+                     'size_bytes': stat.size, 'count_diff': stat.count_diff}
+                    for stat in snapshot.compare_to(self.previous, key_type)[:top]
+                ]
+            self.previous = snapshot
+            return result
+
+profiler = SamplingProfiler()
+memory_snapshots = MemorySnapshots()
+
+def timed_handler(func):
+    """قياس زمن معالج البوت وعدد أخطائه (وتسجيله كـ span)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracer.span(f"handler {func.__name__}", root=True):
+                return func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(func.__name__)
+            raise
+        finally:
+            handler_latency.observe(func.__name__, time.perf_counter() - start)
+    return wrapper
+
+# --- إعدادات اتصال Firestore ---
+# قناة gRPC واحدة لكل عملية مع keepalive حتى لا يُغلق الاتصال بين الطلبات
+# (ملاحظة: عدد التدفقات المتزامنة يحدده الخادم عبر HTTP/2 SETTINGS وليس العميل)
+FIRESTORE_KEEPALIVE_MS = int(os.environ.get("FIRESTORE_KEEPALIVE_MS", 30000))
+FIRESTORE_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", FIRESTORE_KEEPALIVE_MS),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+
+# firestore.Client لا يقبل خيارات قناة gRPC عبر واجهته العامة (client_options لا تحملها)، فالاستبدال
+# يعتمد على حقول داخلية في google-cloud-firestore. لذلك الإصدار مثبت في requirements.txt،
+# ولا يطبق إلا على الإصدارات المجربة وبوجود كل الحقول المطلوبة، وإلا تبقى القناة الافتراضية
+FIRESTORE_CHANNEL_TESTED_VERSIONS = ((2, 11), (3, 0))
+FIRESTORE_CLIENT_INTERNALS = ('_target', '_credentials', '_client_options', '_client_info', '_emulator_host',
+                              '_firestore_api_internal')
+
+def configure_firestore_channel(client):
+    """استبدال قناة gRPC الافتراضية بقناة بإعداداتنا (قبل أول استدعاء). يرجع True إذا طُبقت"""
+    try:
+        from importlib import metadata
+        from google.cloud.firestore_v1.services.firestore import client as firestore_client
+        from google.cloud.firestore_v1.services.firestore.transports import grpc as firestore_grpc
+        
+        version = tuple(int(part) for part in metadata.version("google-cloud-firestore").split('.')[:2])
+        lowest, below = FIRESTORE_CHANNEL_TESTED_VERSIONS
+        missing = [name for name in FIRESTORE_CLIENT_INTERNALS if not hasattr(client, name)]
+        if not lowest <= version < below or missing:
+            log.warning("إصدار Firestore غير مجرب لضبط القناة، سيتم استخدام الإعدادات الافتراضية",
+                        version='.'.join(map(str, version)), missing=missing)
+            return False
+        if client._emulator_host is not None or client._firestore_api_internal is not None:
+            return False
+        channel = firestore_grpc.FirestoreGrpcTransport.create_channel(
+            client._target,
+            credentials=client._credentials,
+            options=FIRESTORE_CHANNEL_OPTIONS
+        )
+        transport = firestore_grpc.FirestoreGrpcTransport(host=client._target, channel=channel)
+        api = firestore_client.FirestoreClient(transport=transport, client_options=client._client_options)
+        # التعيين في النهاية فقط: أي خطأ قبلها يترك العميل كما هو
+        client._transport = transport
+        client._firestore_api_internal = api
+        firestore_client._client_info = client._client_info
+        return True
+    except Exception as e:
+        log.warning("تعذر ضبط قناة Firestore، سيتم استخدام الإعدادات الافتراضية", error=str(e))
+        return False
+
 # --- إعدادات Firebase ---
 # التحقق من وجود متغير البيئة أولاً (للإنتاج في Render)
 firebase_credentials_json = os.environ.get("FIREBASE_CREDENTIALS")
@@ -33,25 +700,26 @@ try:
         # استخدام المتغير البيئي (Render)
         cred_dict = json.loads(firebase_credentials_json)
         cred = credentials.Certificate(cred_dict)
-        print("✅ Firebase: استخدام المتغير البيئي (Production)")
+        log.info("Firebase: استخدام المتغير البيئي (Production)")
     else:
         # استخدام الملف المحلي (للتطوير)
         if os.path.exists('serviceAccountKey.json'):
             cred = credentials.Certificate('serviceAccountKey.json')
-            print("✅ Firebase: استخدام الملف المحلي (Development)")
+            log.info("Firebase: استخدام الملف المحلي (Development)")
         else:
-            print("⚠️ تحذير: لا يوجد ملف Firebase ومتغير البيئة فارغ!")
+            log.warning("لا يوجد ملف Firebase ومتغير البيئة فارغ")
             cred = None
     
     if cred:
         firebase_admin.initialize_app(cred)
         db = firestore.client()
-        print("✅ تم الاتصال بـ Firebase بنجاح")
+        configure_firestore_channel(db)
+        log.info("تم الاتصال بـ Firebase بنجاح")
     else:
-        print("❌ فشل الاتصال بـ Firebase")
+        log.error("فشل الاتصال بـ Firebase")
         db = None
 except Exception as e:
-    print(f"❌ خطأ في إعداد Firebase: {e}")
+    log.error("خطأ في إعداد Firebase", error=str(e))
     db = None
 
 # --- إعدادات البوت ---
@@ -61,11 +729,10 @@ TOKEN = os.environ.get("BOT_TOKEN")
 
 # التحقق من وجود TOKEN
 if not TOKEN:
-    print("❌ خطأ: متغير BOT_TOKEN غير موجود!")
-    print("   ستحتاج إلى تعيين BOT_TOKEN في Render Environment Variables")
+    log.error("متغير BOT_TOKEN غير موجود! قم بتعيينه في Render Environment Variables")
     TOKEN = "default_token"  # قيمة افتراضية لتجنب الأخطاء أثناء البدء
 else:
-    print(f"✅ تم تحميل BOT_TOKEN بنجاح")
+    log.info("تم تحميل BOT_TOKEN بنجاح")
 
 SITE_URL = os.environ.get("SITE_URL", "https://example.com")
 
@@ -79,19 +746,350 @@ ADMINS_LIST = [
     # 987654321,  # المشرف 3
 ]
 
-bot = telebot.TeleBot(TOKEN)
+# threaded=False: المعالجات تعمل داخل عمال طابور الـ Webhook (انظر UpdateDispatcher)
+bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-here-change-it")
+# عدد البروكسيات أمام التطبيق (Render = 1): remote_addr يصبح العنوان الذي أضافه البروكسي في X-Forwarded-For
+# وليس أول عنوان فيه الذي يستطيع العميل كتابته بنفسه. 0 عند التشغيل بدون بروكسي
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+# --- سجلات البيانات في الذاكرة ---
+# dataclasses بـ __slots__ بدل القواميس: لا يوجد __dict__ لكل عنصر ولا تتكرر أسماء الحقول،
+# مع تحويل من/إلى مستندات Firestore. الحقول غير المعروفة (مثل الطوابع الزمنية) تبقى في Firestore فقط.
+
+@functools.cache
+def _record_fields(cls):
+    return tuple(field.name for field in dataclasses.fields(cls))
+
+class Record:
+    """أساس مشترك للسجلات. get() للتوافق مع القوالب التي تستخدم item.get('field')"""
+    __slots__ = ()
+    id_field = 'id'
+
+    @classmethod
+    def from_dict(cls, doc_id, data):
+        values = {name: data[name] for name in _record_fields(cls) if name in data}
+        if cls.id_field:
+            values[cls.id_field] = doc_id
+        return cls(**values)
+
+    def to_dict(self):
+        """مستند Firestore (بدون حقل المعرف)"""
+        return {name: getattr(self, name) for name in _record_fields(type(self)) if name != self.id_field}
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+@dataclasses.dataclass(slots=True)
+class Product(Record):
+    id: str
+    item_name: str = ''
+    price: float = 0.0
+    seller_id: str = ''
+    seller_name: str = ''
+    hidden_data: str = ''
+    category: str = ''
+    details: str = ''
+    image_url: str = ''
+    sold: bool = False
+
+    def __post_init__(self):
+        self.price = float(self.price or 0)
+        self.seller_id = str(self.seller_id or '')
+
+    def listing(self, fields=None):
+        """نسخة مختصرة للعرض في المتجر (بدون البيانات المخفية)"""
+        return {'id': self.id, **{name: self.get(name, '') for name in fields or PRODUCT_LISTING_FIELDS}}
+
+# الحقول التي تحتاجها صفحة المتجر فقط (hidden_data لا تخرج أبداً في العرض)
+PRODUCT_LISTING_FIELDS = ('item_name', 'price', 'seller_id', 'seller_name', 'category', 'details', 'image_url', 'sold')
+SOLD_LISTING_FIELDS = ('item_name', 'price', 'seller_name', 'category', 'image_url', 'buyer_name')
+
+@dataclasses.dataclass(slots=True)
+class Order(Record):
+    id: str
+    buyer_id: str = ''
+    buyer_name: str = ''
+    item_name: str = ''
+    price: float = 0.0
+    seller_id: str = ''
+    hidden_data: str = ''
+    game_id: str = ''
+    game_name: str = ''
+    status: str = 'pending'
+    admin_id: int | str | None = None
+    admin_messages: dict | None = None
+
+    def __post_init__(self):
+        self.price = float(self.price or 0)
+        self.buyer_id = str(self.buyer_id or '')
+
+# حقول الطلبات النشطة في الذاكرة (البيانات المخفية تجلب عند استلام الطلب فقط)
+ORDER_CACHE_FIELDS = ('buyer_id', 'buyer_name', 'item_name', 'price', 'seller_id', 'game_id', 'game_name',
+                      'status', 'admin_id', 'admin_messages')
+
+@dataclasses.dataclass(slots=True)
+class ChargeKey(Record):
+    id_field = 'code'
+    code: str
+    amount: float = 0.0
+    used: bool = False
+    used_by: str | None = None
+    used_at: float | None = None
+    created_at: float | None = None
+
+@dataclasses.dataclass(slots=True)
+class VerificationCode(Record):
+    id_field = None
+    code: str
+    name: str
+    created_at: float
+
+class ProductCatalog:
+    """كتالوج المنتجات في الذاكرة: قاموس مرتب حسب المعرف (بترتيب الإضافة) مع عروض محدثة
+    للمتاح والمباع، حتى يكون البحث والشراء O(1) مهما كبر الكتالوج.
+    أي تغيير في sold يجب أن يمر عبر الكتالوج حتى تبقى العروض متسقة (التصفية حسب الفئة في المتصفح)"""
+
+    def __init__(self, products=()):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.available_items = {}
+        self.sold_items = {}
+        for product in products:
+            self.add(product)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, product_id):
+        return product_id in self.items
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+    def _index(self, product):
+        if product.sold:
+            self.sold_items[product.id] = product
+        else:
+            self.available_items[product.id] = product
+
+    def _unindex(self, product):
+        self.sold_items.pop(product.id, None)
+        self.available_items.pop(product.id, None)
+
+    def add(self, product):
+        """إضافة أو استبدال منتج (يُعطى معرفاً جديداً إذا لم يكن لديه)"""
+        with self.lock:
+            if not product.id:
+                product.id = str(uuid.uuid4())
+            previous = self.items.get(product.id)
+            if previous is not None:
+                self._unindex(previous)
+            self.items[product.id] = product
+            self._index(product)
+            return product
+
+    def get(self, product_id):
+        return self.items.get(product_id)
+
+    def remove(self, product_id):
+        with self.lock:
+            product = self.items.pop(product_id, None)
+            if product is not None:
+                self._unindex(product)
+            return product
+
+    def mark_sold(self, product_id):
+        """نقل المنتج من المتاح إلى المباع (يرجع False إذا لم يكن في الكتالوج)"""
+        with self.lock:
+            product = self.items.get(product_id)
+            if product is None:
+                return False
+            self._unindex(product)
+            product.sold = True
+            self._index(product)
+            return True
+
+    def replace(self, products):
+        """استبدال محتوى الكتالوج بالكامل (عند التحميل من Firebase)"""
+        with self.lock:
+            self.items = {}
+            self.available_items = {}
+            self.sold_items = {}
+            for product in products:
+                self.add(product)
+
+    def available(self):
+        return list(self.available_items.values())
+
+    def sold(self):
+        return list(self.sold_items.values())
+
+# --- قواميس بمدة صلاحية (TTL) ---
+# كل مفتاح له وقت انتهاء، والانتهاءات مرتبة في heap. get/set/pop و الحذف عند الامتلاء O(log n).
+# خيط خلفي واحد لكل عملية يمسح المنتهي دورياً حتى لا تتراكم المدخلات المهجورة في الذاكرة.
+
+TTL_SWEEP_INTERVAL = float(os.environ.get("TTL_SWEEP_INTERVAL", 30))
+
+class TTLMap:
+    """قاموس بمدة صلاحية لكل مفتاح وحد أقصى لعدد المدخلات.
+    sliding=True يجدد الصلاحية عند كل قراءة (مناسب لحالة المحادثات متعددة الخطوات)"""
+
+    def __init__(self, name, ttl, max_size=None, sliding=False):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sliding = sliding
+        self.data = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+        ttl_sweeper.register(self)
+
+    def _push(self, key, value, now):
+        expires_at = now + self.ttl
+        self.data[key] = (value, expires_at)
+        heapq.heappush(self.heap, (expires_at, next(self.counter), key))
+        # إعادة بناء الـ heap إذا تراكمت فيه مدخلات قديمة (بعد التحديث أو الحذف)
+        if len(self.heap) > 2 * len(self.data) + 64:
+            self.heap = [(expires, next(self.counter), k) for k, (_, expires) in self.data.items()]
+            heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        """إزالة مدخلات الـ heap القديمة من رأسه (مفاتيح حُدثت أو جُددت أو حُذفت)"""
+        while self.heap:
+            expires_at, _, key = self.heap[0]
+            entry = self.data.get(key)
+            if entry is not None and entry[1] == expires_at:
+                return
+            heapq.heappop(self.heap)
+
+    def _pop_head(self):
+        """إخراج أقرب مدخل حي انتهاءً ويرجع (key, expires_at)"""
+        self._drop_stale()
+        if not self.heap:
+            return None, None
+        expires_at, _, key = heapq.heappop(self.heap)
+        del self.data[key]
+        return key, expires_at
+
+    def set(self, key, value):
+        if ttl_sweeper.started_pid != os.getpid():
+            ttl_sweeper.start()
+        with self.lock:
+            self._push(key, value, time.monotonic())
+            while self.max_size and len(self.data) > self.max_size:
+                self._pop_head()
+                self.evicted += 1
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            now = time.monotonic()
+            if entry[1] <= now:
+                del self.data[key]
+                self.expired += 1
+                return default
+            if self.sliding:
+                self._push(key, entry[0], now)
+            return entry[0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __contains__(self, key):
+        missing = object()
+        return self.get(key, missing) is not missing
+
+    def __len__(self):
+        return len(self.data)
+
+    def sweep(self):
+        """حذف كل المدخلات المنتهية (يرجع عددها)"""
+        removed = 0
+        with self.lock:
+            now = time.monotonic()
+            while True:
+                # الرأس بعد إزالة القديم هو أقرب مدخل حي، ولا يُحذف إلا إذا انتهى فعلاً
+                self._drop_stale()
+                if not self.heap or self.heap[0][0] > now:
+                    break
+                self._pop_head()
+                removed += 1
+            self.expired += removed
+        return removed
+
+class TTLSweeper:
+    """خيط خلفي واحد يمسح جميع قواميس TTL (يبدأ مرة لكل عملية بعد fork)"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.maps = []
+        self.lock = threading.Lock()
+        self.started_pid = None
+
+    def register(self, ttl_map):
+        self.maps.append(ttl_map)
+
+    def start(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="ttl-sweeper", daemon=True).start()
+            self.started_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for ttl_map in self.maps:
+                try:
+                    ttl_map.sweep()
+                except Exception as e:
+                    log.warning("خطأ في مسح القاموس المؤقت", map=ttl_map.name, error=str(e))
+
+ttl_sweeper = TTLSweeper(TTL_SWEEP_INTERVAL)
+
+metrics.callback('ttl_map_entries', 'عدد المدخلات في كل قاموس مؤقت',
+                 lambda: {(ttl_map.name,): len(ttl_map) for ttl_map in ttl_sweeper.maps}, ['map'])
+metrics.callback('ttl_map_removed_total', 'المدخلات المحذوفة لانتهاء الصلاحية أو لتجاوز الحد',
+                 lambda: {(ttl_map.name, reason): count for ttl_map in ttl_sweeper.maps
+                          for reason, count in (('expired', ttl_map.expired), ('evicted', ttl_map.evicted))},
+                 ['map', 'reason'], kind='counter')
 
 # --- قواعد البيانات (في الذاكرة حالياً) ---
 # ملاحظة: هذه البيانات ستمسح عند إعادة تشغيل السيرفر.
 
-# قائمة المنتجات/الخدمات
-# الشكل: { item_name, price, seller_id, seller_name, hidden_data, image_url, category }
-marketplace_items = []
+# كتالوج المنتجات/الخدمات
+# الشكل: ProductCatalog { product_id: Product }
+marketplace_items = ProductCatalog()
 
 # الطلبات النشطة (قيد التنفيذ بواسطة المشرفين)
-# الشكل: { order_id: {buyer_info, item_info, admin_id, status, message_id} }
+# الشكل: { order_id: Order }
 active_orders = {}
 
 # قائمة المشرفين الديناميكية (يتم تحديثها عبر الأوامر)
@@ -105,14 +1103,1136 @@ users_wallets = {}
 # العمليات المعلقة (المبالغ المحجوزة)
 transactions = {}
 
-# رموز التحقق للمستخدمين
-# الشكل: { user_id: {code, name, created_at} }
-verification_codes = {}
+# رموز التحقق للمستخدمين (صالحة لمدة 10 دقائق وتحذف تلقائياً)
+# الشكل: { user_id: VerificationCode }
+VERIFICATION_CODE_TTL = 600
+VERIFICATION_CODES_MAX = int(os.environ.get("VERIFICATION_CODES_MAX", 100000))
+verification_codes = TTLMap('verification_codes', VERIFICATION_CODE_TTL, VERIFICATION_CODES_MAX)
 
 # مفاتيح الشحن المولدة
-# الشكل: { key_code: {amount, used, used_by, created_at} }
+# الشكل: { key_code: ChargeKey }
 charge_keys = {}
 
+# --- طبقة الوصول للبيانات (Repositories) ---
+# كل الوصول لقاعدة البيانات يمر عبر المستودعات أدناه (users, products, orders, charge_keys).
+# المخزن الفعلي إما Firestore أو مخزن في الذاكرة بنفس الواجهة (للتطوير وقياس الأداء بدون إنترنت).
+# المستندات ترجع كقواميس عادية، ونتائج الاستعلامات كقائمة (doc_id, data).
+
+@contextlib.contextmanager
+def firestore_call(operation, **attributes):
+    """قياس زمن استدعاء Firestore وتسجيله كـ span داخل التتبع الحالي"""
+    with firestore_latency.timed(operation), tracer.span(
+        f"firestore {operation}", SPAN_KIND_CLIENT,
+        **{'db.system': 'firestore', 'db.operation': operation}, **attributes
+    ):
+        yield
+
+class FirestoreBatch:
+    """دفعة كتابة في Firestore (تنفذ كلها أو تفشل كلها)"""
+
+    def __init__(self, store):
+        self.store = store
+        self.batch = store.client.batch()
+        self.writes = 0
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.batch.set(self.store.ref(collection, doc_id), data, merge=merge)
+        self.writes += 1
+
+    def update(self, collection, doc_id, data):
+        self.batch.update(self.store.ref(collection, doc_id), data)
+        self.writes += 1
+
+    def create(self, collection, doc_id, data):
+        self.batch.create(self.store.ref(collection, doc_id), data)
+        self.writes += 1
+
+    def delete(self, collection, doc_id):
+        self.batch.delete(self.store.ref(collection, doc_id))
+        self.writes += 1
+
+    def commit(self):
+        with firestore_call('batch.commit', **{'db.writes': self.writes}):
+            self.batch.commit()
+
+class FirestoreTransaction:
+    """قراءة وكتابة داخل معاملة Firestore (كل القراءات يجب أن تسبق الكتابات).
+    لها نفس واجهة الكتابة في FirestoreBatch فيمكن تمريرها للمستودعات كـ batch"""
+
+    def __init__(self, store, transaction):
+        self.store = store
+        self.transaction = transaction
+
+    def get(self, collection, doc_id):
+        doc = self.store.ref(collection, doc_id).get(transaction=self.transaction)
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.transaction.set(self.store.ref(collection, doc_id), data, merge=merge)
+
+    def update(self, collection, doc_id, data):
+        self.transaction.update(self.store.ref(collection, doc_id), data)
+
+    def create(self, collection, doc_id, data):
+        self.transaction.create(self.store.ref(collection, doc_id), data)
+
+    def delete(self, collection, doc_id):
+        self.transaction.delete(self.store.ref(collection, doc_id))
+
+class FirestoreStore:
+    """مخزن المستندات في Firestore مع قياس زمن كل استدعاء"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def ref(self, collection, doc_id):
+        return self.client.collection(collection).document(str(doc_id))
+
+    def get(self, collection, doc_id):
+        with firestore_call(f'{collection}.get', **{'db.document': f'{collection}/{doc_id}'}):
+            doc = self.ref(collection, doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_many(self, keys):
+        """جلب عدة مستندات (collection, doc_id) في رحلة واحدة بنفس الترتيب"""
+        refs = [self.ref(collection, doc_id) for collection, doc_id in keys]
+        with firestore_call('get_all', **{'db.documents': ','.join(f'{c}/{d}' for c, d in keys)}):
+            snapshots = {snapshot.reference.path: snapshot for snapshot in self.client.get_all(refs)}
+        return [snapshots[ref.path].to_dict() if snapshots[ref.path].exists else None for ref in refs]
+
+    def set(self, collection, doc_id, data, merge=False):
+        with firestore_call(f'{collection}.set', **{'db.document': f'{collection}/{doc_id}'}):
+            self.ref(collection, doc_id).set(data, merge=merge)
+
+    def update(self, collection, doc_id, data):
+        with firestore_call(f'{collection}.update', **{'db.document': f'{collection}/{doc_id}'}):
+            self.ref(collection, doc_id).update(data)
+
+    def create(self, collection, doc_id, data):
+        """إنشاء مستند جديد (يرفع AlreadyExists إذا كان موجوداً)"""
+        with firestore_call(f'{collection}.create', **{'db.document': f'{collection}/{doc_id}'}):
+            self.ref(collection, doc_id).create(data)
+
+    def delete(self, collection, doc_id):
+        with firestore_call(f'{collection}.delete', **{'db.document': f'{collection}/{doc_id}'}):
+            self.ref(collection, doc_id).delete()
+
+    def query(self, collection, field=None, value=None, order_by=None, descending=False, limit=None, fields=None,
+              after=None):
+        """استعلام بالمساواة (field == value) مع ترتيب وحد اختياريين.
+        fields يحدد الحقول المرجعة فقط (select) بدلاً من المستند كاملاً،
+        و after يرجع فقط ما قيمة order_by فيه أكبر منه (قراءة نطاق)"""
+        query = self.client.collection(collection)
+        if fields is not None:
+            query = query.select(list(fields))
+        if field is not None:
+            query = query_where(query, field, '==', value)
+        if after is not None:
+            query = query_where(query, order_by, '>', after)
+        if order_by:
+            query = query.order_by(order_by, direction=firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING)
+        if limit:
+            query = query.limit(limit)
+        with firestore_call(f'{collection}.query', **{
+            'db.filter': f'{field}=={value}' if field else '',
+            'db.limit': limit or 0,
+            'db.select': ','.join(fields) if fields is not None else '*'
+        }):
+            return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def batch(self):
+        return FirestoreBatch(self)
+
+    def run_transaction(self, fn, name='transaction'):
+        """تنفيذ fn(tx) داخل معاملة (يعيد Firestore المحاولة تلقائياً عند التعارض)"""
+        @firestore.transactional
+        def run(transaction):
+            return fn(FirestoreTransaction(self, transaction))
+
+        with firestore_call(name):
+            return run(self.client.transaction())
+
+class MemoryBatch:
+    """دفعة كتابة في مخزن الذاكرة (تطبق دفعة واحدة عند commit)"""
+
+    def __init__(self, store):
+        self.store = store
+        self.operations = []
+
+    def set(self, collection, doc_id, data, merge=False):
+        self.operations.append((self.store.set, (collection, doc_id, data, merge)))
+
+    def update(self, collection, doc_id, data):
+        self.operations.append((self.store.update, (collection, doc_id, data)))
+
+    def create(self, collection, doc_id, data):
+        self.operations.append((self.store.create, (collection, doc_id, data)))
+
+    def delete(self, collection, doc_id):
+        self.operations.append((self.store.delete, (collection, doc_id)))
+
+    def commit(self):
+        with self.store.lock:
+            for operation, args in self.operations:
+                operation(*args)
+
+class MemoryTransaction(MemoryBatch):
+    """معاملة في مخزن الذاكرة: القراءة مباشرة والكتابات تطبق معاً في النهاية (تحت قفل المخزن)"""
+
+    def get(self, collection, doc_id):
+        return self.store.get(collection, doc_id)
+
+class MemoryStore:
+    """مخزن مستندات في الذاكرة بنفس واجهة FirestoreStore"""
+
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _apply(current, data):
+        """تطبيق الحقول مع دعم SERVER_TIMESTAMP و Increment كما يفعل Firestore"""
+        result = dict(current) if current else {}
+        for field, value in data.items():
+            if value is firestore.SERVER_TIMESTAMP:
+                value = datetime.datetime.now(datetime.timezone.utc)
+            elif isinstance(value, firestore.Increment):
+                value = (result.get(field) or 0) + value.value
+            result[field] = value
+        return result
+
+    @staticmethod
+    def _sort_value(value):
+        if isinstance(value, datetime.datetime):
+            return value.timestamp()
+        return value if isinstance(value, (int, float)) else 0
+
+    def get(self, collection, doc_id):
+        with self.lock:
+            data = self.collections.get(collection, {}).get(str(doc_id))
+            return dict(data) if data is not None else None
+
+    def get_many(self, keys):
+        with self.lock:
+            return [self.get(collection, doc_id) for collection, doc_id in keys]
+
+    def set(self, collection, doc_id, data, merge=False):
+        with self.lock:
+            docs = self.collections.setdefault(collection, {})
+            docs[str(doc_id)] = self._apply(docs.get(str(doc_id)) if merge else None, data)
+
+    def update(self, collection, doc_id, data):
+        with self.lock:
+            docs = self.collections.setdefault(collection, {})
+            if str(doc_id) not in docs:
+                raise NotFound(f"{collection}/{doc_id}")
+            docs[str(doc_id)] = self._apply(docs[str(doc_id)], data)
+
+    def create(self, collection, doc_id, data):
+        with self.lock:
+            docs = self.collections.setdefault(collection, {})
+            if str(doc_id) in docs:
+                raise AlreadyExists(f"{collection}/{doc_id}")
+            docs[str(doc_id)] = self._apply(None, data)
+
+    def delete(self, collection, doc_id):
+        with self.lock:
+            self.collections.get(collection, {}).pop(str(doc_id), None)
+
+    def query(self, collection, field=None, value=None, order_by=None, descending=False, limit=None, fields=None,
+              after=None):
+        with self.lock:
+            results = [
+                (doc_id, dict(data))
+                for doc_id, data in self.collections.get(collection, {}).items()
+                if field is None or data.get(field) == value
+            ]
+        if after is not None:
+            results = [item for item in results if self._sort_value(item[1].get(order_by)) > self._sort_value(after)]
+        if order_by:
+            results.sort(key=lambda item: self._sort_value(item[1].get(order_by)), reverse=descending)
+        if limit:
+            results = results[:limit]
+        if fields is not None:
+            results = [(doc_id, {f: data[f] for f in fields if f in data}) for doc_id, data in results]
+        return results
+
+    def batch(self):
+        return MemoryBatch(self)
+
+    def run_transaction(self, fn, name='transaction'):
+        with self.lock:
+            transaction = MemoryTransaction(self)
+            result = fn(transaction)
+            transaction.commit()
+            return result
+
+class Repo:
+    """أساس المستودعات: مجموعة واحدة في المخزن.
+    دوال الكتابة تقبل batch اختياري لتنفيذها ضمن دفعة واحدة مع غيرها"""
+
+    collection = None
+
+    def __init__(self, store):
+        self.store = store
+
+    def key(self, doc_id):
+        """مفتاح المستند لاستخدامه مع store.get_many"""
+        return (self.collection, str(doc_id))
+
+    def get(self, doc_id):
+        return self.store.get(self.collection, doc_id)
+
+    def set(self, doc_id, data, merge=False, batch=None):
+        (batch or self.store).set(self.collection, doc_id, data, merge=merge)
+
+    def update(self, doc_id, data, batch=None):
+        (batch or self.store).update(self.collection, doc_id, data)
+
+    def all(self, limit=None, fields=None):
+        return self.store.query(self.collection, limit=limit, fields=fields)
+
+# المحافظ الساخنة (مثل محفظة المالك التي تستلم ثمن كل المنتجات) يوزع رصيدها على شرائح
+# users/{id}/balance_shards/{n} لأن Firestore يتحمل حوالي كتابة واحدة بالثانية لكل مستند.
+# الرصيد = balance في مستند المستخدم + مجموع الشرائح، ويحفظ المجموع مؤقتاً لبضع ثوان
+HOT_WALLETS = {uid.strip() for uid in (os.environ.get("HOT_WALLETS") or str(ADMIN_ID)).split(",") if uid.strip()}
+BALANCE_SHARDS = int(os.environ.get("BALANCE_SHARDS", 10))
+BALANCE_SHARD_CACHE_TTL = float(os.environ.get("BALANCE_SHARD_CACHE_TTL", 5))
+
+class UsersRepo(Repo):
+    collection = 'users'
+
+    def __init__(self, store, hot_wallets=(), shards=BALANCE_SHARDS):
+        super().__init__(store)
+        self.hot_wallets = {str(user_id) for user_id in hot_wallets}
+        self.shards = shards
+        self.totals = TTLMap('wallet_totals', BALANCE_SHARD_CACHE_TTL, max_size=1000)
+
+    def is_sharded(self, user_id):
+        return str(user_id) in self.hot_wallets
+
+    def shards_collection(self, user_id):
+        return f"{self.collection}/{user_id}/balance_shards"
+
+    def sharded_balance(self, user_id, fresh=False):
+        """مجموع رصيد المحفظة الموزعة (من الذاكرة المؤقتة إلا إذا طُلب fresh)"""
+        uid = str(user_id)
+        total = None if fresh else self.totals.get(uid)
+        if total is None:
+            keys = [self.key(uid)] + [(self.shards_collection(uid), str(n)) for n in range(self.shards)]
+            total = sum((data or {}).get('balance', 0.0) for data in self.store.get_many(keys))
+            self.totals[uid] = total
+        return total
+
+    def get_balance(self, user_id):
+        if self.is_sharded(user_id):
+            return self.sharded_balance(user_id)
+        data = self.get(user_id)
+        return data.get('balance', 0.0) if data else 0.0
+
+    def balance_from(self, user_id, data):
+        """الرصيد من مستند مستخدم تم جلبه مسبقاً (مثلاً عبر get_many)"""
+        if self.is_sharded(user_id):
+            return self.sharded_balance(user_id)
+        return data.get('balance', 0.0) if data else 0.0
+
+    def increment_balance(self, user_id, amount, batch=None):
+        """إضافة مبلغ لمحفظة موزعة: زيادة شريحة عشوائية بدون قراءة"""
+        uid = str(user_id)
+        shard = str(random.randrange(self.shards))
+        (batch or self.store).set(self.shards_collection(uid), shard, {'balance': firestore.Increment(amount)}, merge=True)
+        cached = self.totals.pop(uid)
+        if cached is not None and batch is None:
+            self.totals[uid] = cached + amount
+
+    def opening_balance(self, user_id, data, read):
+        """الرصيد المخزن قبل أول حركة في السجل: حقل balance ومعه الشرائح للمحفظة الموزعة (read تقرأ داخل المعاملة)"""
+        balance = (data or {}).get('balance', 0.0)
+        if self.is_sharded(user_id):
+            balance += sum((read(self.shards_collection(user_id), str(n)) or {}).get('balance', 0.0)
+                           for n in range(self.shards))
+        return balance
+
+    @staticmethod
+    def ledger_opened(data):
+        return bool(data and data.get('ledger_opened'))
+
+    def mark_ledger_opened(self, user_id, batch=None):
+        self.set(user_id, {'ledger_opened': True}, merge=True, batch=batch)
+
+    def set_balance(self, user_id, balance, batch=None):
+        """كتابة رصيد محسوب من قراءة سابقة: داخل balance_locks ومع حركة في السجل فقط (add_balance، الشحن، الشراء)"""
+        if self.is_sharded(user_id):
+            # قيمة مطلقة على الشرائح تمحو أي زيادة وصلت بين القراءة والكتابة، فالتعديل عبر increment_balance فقط
+            raise ValueError(f"المحفظة {user_id} موزعة: استخدم increment_balance")
+        self.set(user_id, {
+            'balance': balance,
+            'telegram_id': str(user_id),
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, merge=True, batch=batch)
+
+    def create_profile(self, user_id, name, username):
+        self.set(user_id, {
+            'telegram_id': str(user_id),
+            'name': name,
+            'username': username,
+            'balance': 0.0,
+            'ledger_opened': True,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'last_seen': firestore.SERVER_TIMESTAMP
+        })
+
+    def touch_profile(self, user_id, name, username, batch=None):
+        # set مع merge بدلاً من update حتى لا يفشل كامل الدفعة إذا حذف مستند مستخدم واحد
+        self.set(user_id, {
+            'name': name,
+            'username': username,
+            'last_seen': firestore.SERVER_TIMESTAMP
+        }, merge=True, batch=batch)
+
+class ProductsRepo(Repo):
+    """المنتجات. البيانات المخفية تحفظ في مستند منفصل (product_secrets/{id}) ولا تقرأ إلا عند الشراء،
+    حتى لا تمر في استعلامات العرض أبداً. المنتجات القديمة التي تحوي hidden_data في مستندها ما زالت مدعومة"""
+    collection = 'products'
+    secrets_collection = 'product_secrets'
+
+    def by_sold(self, sold, fields=None):
+        return self.store.query(self.collection, 'sold', sold, fields=fields)
+
+    def listing(self, sold):
+        """منتجات العرض بالحقول اللازمة للصفحة فقط (select)"""
+        return self.by_sold(sold, fields=SOLD_LISTING_FIELDS if sold else PRODUCT_LISTING_FIELDS)
+
+    def secret_key(self, product_id):
+        """مفتاح مستند البيانات المخفية لاستخدامه مع store.get_many"""
+        return (self.secrets_collection, str(product_id))
+
+    def create(self, product_id, data, merge=False, batch=None):
+        """حفظ منتج مع فصل البيانات المخفية في مستندها (في دفعة واحدة).
+        مستند البيانات المخفية لا يكتب إلا إذا احتوت data على hidden_data"""
+        data = dict(data)
+        own_batch = batch is None
+        batch = batch or self.store.batch()
+        if 'hidden_data' in data:
+            batch.set(self.secrets_collection, product_id, {'hidden_data': data.pop('hidden_data')})
+        batch.set(self.collection, product_id, data, merge=merge)
+        if own_batch:
+            batch.commit()
+
+    @staticmethod
+    def hidden_data(secret, product_data=None):
+        """البيانات المخفية من مستندها المنفصل، أو من مستند المنتج نفسه للمنتجات القديمة"""
+        if secret is not None:
+            return secret.get('hidden_data', '')
+        return (product_data or {}).get('hidden_data', '')
+
+    def mark_sold(self, product_id, buyer_id, buyer_name, batch=None):
+        self.set(product_id, {
+            'sold': True,
+            'buyer_id': buyer_id,
+            'buyer_name': buyer_name,
+            'sold_at': firestore.SERVER_TIMESTAMP
+        }, merge=True, batch=batch)
+
+class OrdersRepo(Repo):
+    collection = 'orders'
+
+    def by_buyer(self, buyer_id):
+        return self.store.query(self.collection, 'buyer_id', str(buyer_id))
+
+    def by_status(self, status, fields=None):
+        return self.store.query(self.collection, 'status', status, fields=fields)
+
+    def hidden_data(self, order_id):
+        """البيانات المخفية للطلب (لا تحمل مع الطلبات النشطة عند بدء التشغيل)"""
+        data = self.get(order_id)
+        return data.get('hidden_data', '') if data else ''
+
+    def recent(self, limit):
+        return self.store.query(self.collection, order_by='created_at', descending=True, limit=limit)
+
+class KeysRepo(Repo):
+    collection = 'charge_keys'
+
+    def unused(self, fields=None):
+        return self.store.query(self.collection, 'used', False, fields=fields)
+
+    def codes(self):
+        """كل الأكواد (المستخدمة وغير المستخدمة) بدون حقولها"""
+        return [key_code for key_code, _ in self.store.query(self.collection, fields=())]
+
+    def created_since(self, since):
+        """الأكواد المولدة بعد since (created_at بالثواني كما يكتبها time.time) — قراءة نطاق بدون الحقول"""
+        return [key_code for key_code, _ in self.store.query(self.collection, order_by='created_at', after=since,
+                                                              fields=('created_at',))]
+
+    def mark_used(self, key_code, used_by, batch=None):
+        self.update(key_code, {
+            'used': True,
+            'used_by': used_by,
+            'used_at': time.time()
+        }, batch=batch)
+
+class LedgerRepo(Repo):
+    """سجل حركات الرصيد: كل إضافة أو خصم مستند ثابت لا يعدل (create)، يكتب في نفس الدفعة مع تغيير الرصيد.
+    معرف الحركة مشتق من (المستخدم، السبب، المرجع)، و add_balance يتحقق منه داخل المعاملة
+    فإعادة نفس العملية (نفس ref_id) لا تغير الرصيد مرة ثانية. الحركات بدون ref_id تأخذ معرفاً عشوائياً.
+    ledger_snapshots/{user_id} يحفظ المجموع حتى آخر حركة مضغوطة (as_of)، فالرصيد = اللقطة + الحركات بعدها.
+    المستخدمون الذين سبق رصيدهم السجل يأخذون حركة افتتاحية (opening) بالرصيد المخزن مع أول حركة لهم"""
+    collection = 'ledger'
+    snapshots_collection = 'ledger_snapshots'
+    opening_reason = 'opening'
+
+    @staticmethod
+    def entry_id(user_id, reason, ref_id):
+        return f"{user_id}_{reason}_{ref_id}"
+
+    def record(self, user_id, amount, reason, ref_id=None, batch=None):
+        """إضافة حركة (amount موجب للإضافة وسالب للخصم) ويرجع معرفها. تفشل الكتابة إذا كانت موجودة"""
+        ref_id = str(ref_id) if ref_id else uuid.uuid4().hex
+        entry_id = self.entry_id(user_id, reason, ref_id)
+        (batch or self.store).create(self.collection, entry_id, {
+            'user_id': str(user_id),
+            'amount': float(amount),
+            'reason': reason,
+            'ref_id': ref_id,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        return entry_id
+
+    def record_opening(self, user_id, balance, batch):
+        """الحركة الافتتاحية بمعرف ثابت و set لا create: كتابتان متزامنتان قرأتا نفس الرصيد تكتبان نفس المستند"""
+        batch.set(self.collection, self.entry_id(user_id, self.opening_reason, 'balance'), {
+            'user_id': str(user_id),
+            'amount': float(balance),
+            'reason': self.opening_reason,
+            'ref_id': 'balance',
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def entries(self, user_id, after=None):
+        """حركات المستخدم بالترتيب الزمني (بعد as_of إذا أعطي)"""
+        return self.store.query(self.collection, 'user_id', str(user_id), order_by='created_at', after=after)
+
+    def snapshot(self, user_id):
+        return self.store.get(self.snapshots_collection, user_id) or {'balance': 0.0, 'as_of': None, 'entries': 0}
+
+    def balance(self, user_id):
+        """إعادة بناء الرصيد من آخر لقطة والحركات بعدها فقط"""
+        snapshot = self.snapshot(user_id)
+        return snapshot['balance'] + sum(entry['amount'] for _, entry in self.entries(user_id, snapshot['as_of']))
+
+    def compact(self, user_id, before):
+        """ضم الحركات الأقدم من before إلى اللقطة. يرجع عدد الحركات الأحدث التي لم تضم بعد"""
+        snapshot = self.snapshot(user_id)
+        entries = self.entries(user_id, snapshot['as_of'])
+        folded = [(entry_id, entry) for entry_id, entry in entries if entry['created_at'] <= before]
+        if folded:
+            self.store.set(self.snapshots_collection, user_id, {
+                'balance': snapshot['balance'] + sum(entry['amount'] for _, entry in folded),
+                'as_of': folded[-1][1]['created_at'],
+                'last_entry': folded[-1][0],
+                'entries': snapshot['entries'] + len(folded),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+        return len(entries) - len(folded)
+
+# اختيار المخزن: STORE_BACKEND=memory للتشغيل بدون Firebase (افتراضي عند فشل الاتصال)
+STORE_BACKEND = os.environ.get("STORE_BACKEND") or ("firestore" if db else "memory")
+if STORE_BACKEND == "firestore":
+    store = FirestoreStore(db)
+else:
+    store = MemoryStore()
+    log.warning("يتم استخدام مخزن في الذاكرة (البيانات ستمسح عند إعادة التشغيل)")
+
+users_repo = UsersRepo(store, hot_wallets=HOT_WALLETS)
+products_repo = ProductsRepo(store)
+orders_repo = OrdersRepo(store)
+keys_repo = KeysRepo(store)
+ledger_repo = LedgerRepo(store)
+
+def open_ledger(user_id, opening, batch):
+    """فتح سجل مستخدم قديم في نفس المعاملة/الدفعة مع أول حركة له، فيبقى مجموع السجل مساوياً للرصيد"""
+    if opening:
+        ledger_repo.record_opening(user_id, opening, batch)
+    users_repo.mark_ledger_opened(user_id, batch=batch)
+
+# --- ضغط سجل الحركات ---
+# خيط خلفي يضم حركات المستخدمين الذين تغير رصيدهم في هذا العامل إلى لقطاتهم دورياً.
+# الحركات الأحدث من LEDGER_COMPACT_GRACE لا تضم حتى تكتمل الدفعات التي ما زالت قيد الكتابة
+
+LEDGER_COMPACT_INTERVAL = float(os.environ.get("LEDGER_COMPACT_INTERVAL", 300))
+LEDGER_COMPACT_GRACE = float(os.environ.get("LEDGER_COMPACT_GRACE", 60))
+
+class LedgerCompactor:
+    """ضغط دوري لسجل الحركات (يبدأ مرة لكل عملية بعد fork)"""
+
+    def __init__(self, ledger, interval, grace):
+        self.ledger = ledger
+        self.interval = interval
+        self.grace = grace
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.started_pid = None
+        self.compacted = 0
+
+    def touch(self, user_id):
+        """تعليم المستخدم لضغط حركاته في الدورة القادمة"""
+        if self.started_pid != os.getpid():
+            self.start()
+        with self.lock:
+            self.dirty.add(str(user_id))
+
+    def start(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.dirty = set()
+            threading.Thread(target=self._run, name="ledger-compactor", daemon=True).start()
+            self.started_pid = os.getpid()
+
+    def compact_all(self):
+        before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.grace)
+        with self.lock:
+            users, self.dirty = self.dirty, set()
+        for user_id in users:
+            try:
+                pending = self.ledger.compact(user_id, before)
+                self.compacted += 1
+            except Exception as e:
+                log.warning("خطأ في ضغط سجل الحركات", user_id=user_id, error=str(e))
+                pending = 1
+            if pending:
+                with self.lock:
+                    self.dirty.add(user_id)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.compact_all()
+
+ledger_compactor = LedgerCompactor(ledger_repo, LEDGER_COMPACT_INTERVAL, LEDGER_COMPACT_GRACE)
+metrics.callback('ledger_pending_users', 'المستخدمون الذين لديهم حركات لم تضم للقطة بعد في هذا العامل',
+                 lambda: len(ledger_compactor.dirty))
+metrics.callback('ledger_compactions_total', 'عدد مرات ضغط حركات مستخدم في لقطته',
+                 lambda: ledger_compactor.compacted, kind='counter')
+
+# --- تجميع تحديثات الملف الشخصي ---
+# /start يحدث الاسم و last_seen في كل مرة. بدلاً من كتابة لكل رسالة تحفظ آخر قيمة لكل مستخدم
+# في الذاكرة وتكتب كلها في دفعات كل PROFILE_FLUSH_INTERVAL ثانية (تكرار /start خلال الفترة = كتابة واحدة).
+# المستخدمون المعروفون يحفظون مؤقتاً فلا نحتاج قراءة مستندهم للتأكد من وجوده
+
+PROFILE_FLUSH_INTERVAL = float(os.environ.get("PROFILE_FLUSH_INTERVAL", 2))
+PROFILE_BATCH_SIZE = 400  # أقل من حد Firestore (500 عملية في الدفعة)
+KNOWN_USERS_TTL = float(os.environ.get("KNOWN_USERS_TTL", 86400))
+KNOWN_USERS_MAX = int(os.environ.get("KNOWN_USERS_MAX", 100000))
+
+class ProfileWriteBuffer:
+    """write-behind لتحديثات الملف الشخصي (خيط واحد لكل عملية، ويفرغ عند الإغلاق)"""
+
+    def __init__(self, users, interval, batch_size):
+        self.users = users
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.started_pid = None
+        self.coalesced = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def touch(self, user_id, name, username):
+        if self.started_pid != os.getpid():
+            self.start()
+        with self.lock:
+            if user_id in self.pending:
+                self.coalesced += 1
+            self.pending[user_id] = (name, username)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="profile-writer", daemon=True).start()
+            self.started_pid = os.getpid()
+
+    def flush(self):
+        """كتابة كل التحديثات المعلقة في دفعات (الفاشلة تعاد للانتظار ما لم يصل تحديث أحدث)"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            batch = self.users.store.batch()
+            for user_id, (name, username) in chunk:
+                self.users.touch_profile(user_id, name, username, batch=batch)
+            try:
+                batch.commit()
+                self.flushed += len(chunk)
+            except Exception as e:
+                self.failures += 1
+                log.warning("خطأ في كتابة تحديثات الملفات الشخصية", count=len(chunk), error=str(e))
+                with self.lock:
+                    for user_id, profile in chunk:
+                        self.pending.setdefault(user_id, profile)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+profile_buffer = ProfileWriteBuffer(users_repo, PROFILE_FLUSH_INTERVAL, PROFILE_BATCH_SIZE)
+known_users = TTLMap('known_users', KNOWN_USERS_TTL, max_size=KNOWN_USERS_MAX)
+atexit.register(profile_buffer.flush)
+metrics.callback('profile_buffer_pending', 'تحديثات الملف الشخصي المنتظرة للكتابة',
+                 lambda: len(profile_buffer.pending))
+metrics.callback('profile_updates_coalesced_total', 'تحديثات دمجت مع تحديث سابق لنفس المستخدم قبل الكتابة',
+                 lambda: profile_buffer.coalesced, kind='counter')
+metrics.callback('profile_updates_written_total', 'تحديثات الملف الشخصي المكتوبة في Firestore',
+                 lambda: profile_buffer.flushed, kind='counter')
+
+# --- استخدام أكواد الشحن ---
+# الكود يستخدم داخل معاملة Firestore واحدة: قراءة الكود والرصيد، ثم تعليم الكود مستخدماً وزيادة الرصيد
+# وتسجيل الحركة معاً. فلا يمكن استخدام نفس الكود مرتين حتى من عاملين مختلفين،
+# والأكواد المولدة في عامل آخر تعمل مباشرة. الأكواد المجهولة أو المستخدمة تحفظ مؤقتاً
+# في الذاكرة حتى لا تكلف المحاولات العشوائية قراءة من Firestore في كل مرة
+
+CHARGE_KEY_MISS_TTL = float(os.environ.get("CHARGE_KEY_MISS_TTL", 60))
+CHARGE_KEY_MISS_MAX = int(os.environ.get("CHARGE_KEY_MISS_MAX", 100000))
+
+@dataclasses.dataclass(slots=True)
+class Redemption:
+    status: str  # redeemed | used | unknown
+    amount: float = 0.0
+    balance: float | None = None
+    used_by: str | None = None
+
+class KeyRedemption:
+    """استخدام أكواد الشحن بمعاملة واحدة مع ذاكرة مؤقتة للأكواد المرفوضة"""
+
+    def __init__(self, store, miss_ttl, miss_max):
+        self.store = store
+        self.misses = TTLMap('charge_key_misses', miss_ttl, max_size=miss_max)
+        self.results = collections.Counter()
+
+    def redeem(self, key_code, user_id, used_by):
+        """استخدام الكود لصالح user_id مرة واحدة فقط (يرجع Redemption)"""
+        uid = str(user_id)
+        missed = self.misses.get(key_code)
+        if missed is not None:
+            self.results['cached_miss'] += 1
+            return missed
+        if not charge_key_filter.might_exist(key_code):
+            self.results['filtered'] += 1
+            return Redemption('unknown')
+
+        def redeem_in_transaction(tx):
+            key = tx.get(keys_repo.collection, key_code)
+            if key is None:
+                return Redemption('unknown')
+            if key.get('used'):
+                return Redemption('used', used_by=key.get('used_by'))
+            amount = float(key.get('amount', 0))
+            sharded = users_repo.is_sharded(uid)
+            user = tx.get(users_repo.collection, uid)
+            opened = users_repo.ledger_opened(user)
+            opening = None if opened else users_repo.opening_balance(uid, user, tx.get)
+            if not sharded:
+                balance = (user or {}).get('balance', 0.0) + amount
+            # كل القراءات قبل أول كتابة في معاملة Firestore
+            if not opened:
+                open_ledger(uid, opening, tx)
+            keys_repo.mark_used(key_code, used_by, batch=tx)
+            if sharded:
+                users_repo.increment_balance(uid, amount, batch=tx)
+                balance = None
+            else:
+                users_repo.set_balance(uid, balance, batch=tx)
+            ledger_repo.record(uid, amount, 'charge_key', key_code, batch=tx)
+            return Redemption('redeemed', amount, balance)
+
+        with balance_locks.hold(uid):
+            result = self.store.run_transaction(redeem_in_transaction, 'charge_keys.redeem')
+        self.results[result.status] += 1
+        if result.status == 'redeemed':
+            if result.balance is None:
+                result.balance = users_repo.get_balance(uid)
+            ledger_compactor.touch(uid)
+        else:
+            self.misses[key_code] = result
+        return result
+
+key_redemption = KeyRedemption(store, CHARGE_KEY_MISS_TTL, CHARGE_KEY_MISS_MAX)
+
+def register_charge_key(key_code, amount):
+    """إضافة كود مولد للذاكرة المحلية والمرشح (وحذفه من الأكواد المرفوضة إن سبق تجربته)"""
+    charge_keys[key_code] = ChargeKey(key_code, amount, created_at=time.time())
+    charge_key_filter.add(key_code)
+    key_redemption.misses.pop(key_code)
+
+# --- مرشح أكواد الشحن (Bloom filter) ---
+# مرشح صغير بكل الأكواد المولدة (المستخدمة أيضاً حتى ترد بـ "مستخدم" لا "غير صالح"):
+# إذا لم يكن الكود فيه فهو غير موجود قطعاً، فترفض الأكواد الخاطئة بدون قراءة من Firestore
+# وبذاكرة ثابتة (حوالي 10 بتات لكل كود عند 1%). يبنى عند التحميل ويحدث عند التوليد،
+# والأكواد المولدة في عامل آخر تضاف كل CHARGE_KEY_FILTER_SYNC ثانية بقراءة نطاق على created_at
+# (الأكواد الجديدة فقط). إعادة البناء الكاملة (معرفات كل الأكواد) كل CHARGE_KEY_FILTER_REFRESH ثانية فقط
+# لضبط حجم المرشح، ولا يطلبها أي كود مرفوض: الرفض دائماً على آخر بناء ناجح
+
+CHARGE_KEY_FILTER_FPR = float(os.environ.get("CHARGE_KEY_FILTER_FPR", 0.01))
+CHARGE_KEY_FILTER_REFRESH = float(os.environ.get("CHARGE_KEY_FILTER_REFRESH", 3600))
+CHARGE_KEY_FILTER_SYNC = float(os.environ.get("CHARGE_KEY_FILTER_SYNC", 5))
+
+class BloomFilter:
+    """مرشح Bloom ثابت الحجم: لا يرفض عنصراً مضافاً أبداً، ويقبل غيره بنسبة false_positive_rate تقريباً"""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = max(int(capacity), 1)
+        self.false_positive_rate = false_positive_rate
+        self.size = max(64, math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing من hash واحد بطول 128 بت
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def estimated_fpr(self):
+        """نسبة القبول الخاطئ المتوقعة بعدد العناصر الحالي"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+class ChargeKeyFilter:
+    """المرشح الحالي لهذا العامل مع مزامنة الأكواد الجديدة وإعادة البناء الدورية (قبل أول بناء يقبل كل الأكواد)"""
+
+    # تداخل نافذة المزامنة (بالثواني) لتغطية فرق الساعة بين العمال والكتابات التي وصلت متأخرة
+    sync_overlap = 30.0
+
+    def __init__(self, false_positive_rate, refresh_interval, sync_interval):
+        self.false_positive_rate = false_positive_rate
+        self.refresh_interval = refresh_interval
+        self.sync_interval = sync_interval
+        self.bloom = None
+        self.built_at = 0.0
+        self.synced_until = 0.0
+        self.recent = None
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.started_pid = None
+        self.rejected = 0
+        self.synced = 0
+
+    def rebuild(self, key_codes):
+        """بناء مرشح جديد (بسعة ضعف عدد الأكواد) واستبدال الحالي به"""
+        with self.rebuild_lock:
+            with self.lock:
+                self.recent = []
+            started = time.time()
+            codes = list(key_codes)
+            bloom = BloomFilter(max(2 * len(codes), 1024), self.false_positive_rate)
+            for code in codes:
+                bloom.add(code)
+            with self.lock:
+                # الأكواد المولدة أثناء البناء
+                for code in self.recent:
+                    bloom.add(code)
+                self.recent = None
+                self.bloom = bloom
+                # المزامنة التالية تبدأ من بداية القراءة لأن ما ولد بعدها في عامل آخر ليس فيه
+                self.built_at = self.synced_until = started
+
+    def refresh(self):
+        self.rebuild(keys_repo.codes())
+
+    def sync(self):
+        """إضافة الأكواد المولدة منذ آخر مزامنة (في أي عامل) للمرشح الحالي"""
+        if self.bloom is None:
+            return self.refresh()
+        with self.rebuild_lock:
+            started = time.time()
+            codes = keys_repo.created_since(self.synced_until - self.sync_overlap)
+            with self.lock:
+                for code in codes:
+                    if code not in self.bloom:
+                        self.bloom.add(code)
+                        self.synced += 1
+                self.synced_until = started
+
+    def add(self, key_code):
+        with self.lock:
+            if self.recent is not None:
+                self.recent.append(key_code)
+            if self.bloom is not None:
+                self.bloom.add(key_code)
+
+    def might_exist(self, key_code):
+        """False يعني أن الكود غير موجود قطعاً (حتى آخر بناء أو مزامنة)"""
+        if self.started_pid != os.getpid():
+            self.start()
+        bloom = self.bloom
+        if bloom is None or key_code in bloom:
+            return True
+        self.rejected += 1
+        return False
+
+    def start(self):
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="charge-key-filter", daemon=True).start()
+            self.started_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                if time.time() - self.built_at >= self.refresh_interval:
+                    self.refresh()
+                else:
+                    self.sync()
+            except Exception as e:
+                log.warning("خطأ في تحديث مرشح أكواد الشحن", error=str(e))
+
+charge_key_filter = ChargeKeyFilter(CHARGE_KEY_FILTER_FPR, CHARGE_KEY_FILTER_REFRESH, CHARGE_KEY_FILTER_SYNC)
+metrics.callback('charge_key_filter_target_fpr', 'نسبة القبول الخاطئ المضبوطة لمرشح أكواد الشحن',
+                 lambda: charge_key_filter.false_positive_rate)
+metrics.callback('charge_key_filter_estimated_fpr', 'نسبة القبول الخاطئ المتوقعة بعدد الأكواد الحالي',
+                 lambda: charge_key_filter.bloom.estimated_fpr() if charge_key_filter.bloom else 0)
+metrics.callback('charge_key_filter_keys', 'عدد الأكواد المضافة للمرشح',
+                 lambda: charge_key_filter.bloom.count if charge_key_filter.bloom else 0)
+metrics.callback('charge_key_filter_bytes', 'حجم المرشح بالبايت',
+                 lambda: len(charge_key_filter.bloom.bits) if charge_key_filter.bloom else 0)
+metrics.callback('charge_key_filter_rejected_total', 'الأكواد المرفوضة من المرشح بدون قراءة',
+                 lambda: charge_key_filter.rejected, kind='counter')
+metrics.callback('charge_key_filter_synced_total', 'أكواد من عمال آخرين أضيفت للمرشح عبر المزامنة',
+                 lambda: charge_key_filter.synced, kind='counter')
+
+def mark_charge_key_used(key_code, used_by):
+    """تحديث نسخة الكود في الذاكرة المحلية بعد استخدامه"""
+    key_data = charge_keys.get(key_code)
+    if key_data is not None:
+        key_data.used = True
+        key_data.used_by = used_by
+        key_data.used_at = time.time()
+metrics.callback('charge_key_redemptions_total', 'محاولات استخدام أكواد الشحن حسب النتيجة',
+                 lambda: {(status,): count for status, count in key_redemption.results.items()},
+                 ['result'], kind='counter')
+
+# --- تحديد معدل الطلبات ---
+# حماية المسارات التي تقبل التخمين (/verify و /charge_balance) و /buy من الطلبات المفرطة.
+# كل قاعدة إما token bucket (سماح بدفعة ثم معدل ثابت) أو نافذة منزلقة (حد على فترة طويلة)،
+# وتطبق على IP العميل أو على معرف المستخدم. الحالة في ذاكرة العامل (والمفاتيح الخاملة تحذف تلقائياً)
+# أو في Redis لمشاركتها بين العمال (RATE_LIMIT_BACKEND=redis)
+
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL") or os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_IDLE_TTL = float(os.environ.get("RATE_LIMIT_IDLE_TTL", 3600))
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class RateLimit:
+    name: str
+    scope: str  # ip | user (مستخدم الجلسة) | account (الحساب المستهدف في جسم الطلب)
+    limit: int
+    period: float  # بالثواني
+    kind: str = 'bucket'  # bucket | window
+
+class MemoryRateLimitStore:
+    """حالة القواعد في ذاكرة العامل: tuple صغير لكل مفتاح في TTLMap يحذف بعد RATE_LIMIT_IDLE_TTL من الخمول"""
+
+    def __init__(self, idle_ttl, max_keys):
+        self.buckets = TTLMap('rate_limit_buckets', idle_ttl, max_size=max_keys, sliding=True)
+        self.windows = TTLMap('rate_limit_windows', idle_ttl, max_size=max_keys, sliding=True)
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """أخذ token: يرجع 0 عند القبول، أو عدد الثواني حتى يتوفر token"""
+        with self.lock:
+            tokens, updated = self.buckets.get(key) or (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            return wait
+
+    def hit(self, key, limit, period, now):
+        """نافذة منزلقة تقريبية (النافذة الحالية + جزء من السابقة): يرجع 0 عند القبول أو ثواني الانتظار"""
+        window = int(now // period)
+        with self.lock:
+            start, current, previous = self.windows.get(key) or (window, 0, 0)
+            if window != start:
+                current, previous = 0, current if window == start + 1 else 0
+            elapsed = now - window * period
+            wait = sliding_window_wait(current, previous, limit, period, elapsed)
+            if not wait:
+                current += 1
+            self.windows[key] = (window, current, previous)
+            return wait
+
+def sliding_window_wait(current, previous, limit, period, elapsed):
+    """الثواني حتى يقبل طلب جديد (0 إذا كان مقبولاً الآن)"""
+    if previous * (1 - elapsed / period) + current + 1 <= limit:
+        return 0.0
+    if current + 1 > limit or not previous:
+        return period - elapsed
+    # وزن النافذة السابقة يقل خطياً حتى يصبح المجموع تحت الحد
+    return period * (1 - (limit - current - 1) / previous) - elapsed
+
+class RedisRateLimitStore:
+    """حالة القواعد في Redis (مشتركة بين كل العمال). كل عملية سكربت Lua واحد ذري،
+    والمفاتيح تنتهي بـ EXPIRE بعد الخمول"""
+
+    TAKE_SCRIPT = """
+    local state = redis.call('HMGET', KEYS[1], 't', 'u')
+    local capacity, rate, now, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 't', tokens, 'u', now)
+    redis.call('EXPIRE', KEYS[1], ttl)
+    return tostring(wait)
+    """
+
+    HIT_SCRIPT = """
+    local limit, period, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local window = math.floor(now / period)
+    local current = tonumber(redis.call('GET', KEYS[1] .. ':' .. window)) or 0
+    local previous = tonumber(redis.call('GET', KEYS[1] .. ':' .. (window - 1))) or 0
+    local elapsed = now - window * period
+    if previous * (1 - elapsed / period) + current + 1 <= limit then
+        redis.call('INCR', KEYS[1] .. ':' .. window)
+        redis.call('EXPIRE', KEYS[1] .. ':' .. window, math.ceil(period * 2))
+        return '0'
+    end
+    if current + 1 > limit or previous == 0 then return tostring(period - elapsed) end
+    return tostring(period * (1 - (limit - current - 1) / previous) - elapsed)
+    """
+
+    def __init__(self, url, idle_ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.idle_ttl = int(idle_ttl)
+        self.take_script = self.client.register_script(self.TAKE_SCRIPT)
+        self.hit_script = self.client.register_script(self.HIT_SCRIPT)
+
+    def take(self, key, capacity, rate, now):
+        return float(self.take_script(keys=[key], args=[capacity, rate, now, self.idle_ttl]))
+
+    def hit(self, key, limit, period, now):
+        return float(self.hit_script(keys=[key], args=[limit, period, now]))
+
+class RateLimiter:
+    """تطبيق القواعد على طلبات Flask. عند فشل المخزن يُقبل الطلب (لا نوقف الموقع بسبب Redis)"""
+
+    def __init__(self, store):
+        self.store = store
+        self.checked = collections.Counter()
+        self.rejected = collections.Counter()
+
+    def check(self, rule, identity):
+        """يرجع 0 إذا قُبل الطلب، أو عدد الثواني المطلوب انتظارها"""
+        if self.store is None:
+            return 0.0
+        key = f"rl:{rule.name}:{identity}"
+        self.checked[rule.name] += 1
+        try:
+            if rule.kind == 'bucket':
+                wait = self.store.take(key, rule.limit, rule.limit / rule.period, time.time())
+            else:
+                wait = self.store.hit(key, rule.limit, rule.period, time.time())
+        except Exception as e:
+            log.warning("خطأ في مخزن تحديد المعدل", rule=rule.name, error=str(e), sample=True)
+            return 0.0
+        if wait:
+            self.rejected[rule.name] += 1
+        return wait
+
+    def limit(self, *rules):
+        """decorator لمسار Flask: يرد 429 مع Retry-After عند تجاوز أي قاعدة"""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                identities = {'ip': client_ip(), 'user': request_user_id(), 'account': request_account_id()}
+                for rule in rules:
+                    identity = identities[rule.scope]
+                    if not identity:
+                        continue
+                    wait = self.check(rule, identity)
+                    if wait:
+                        return rate_limited_response(wait)
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+def client_ip():
+    """IP العميل كما أضافه البروكسي الموثوق (ProxyFix أعلاه)، لا كما يكتبه العميل في X-Forwarded-For"""
+    return request.remote_addr
+
+def request_user_id():
+    """مستخدم الجلسة فقط: user_id في جسم الطلب يكتبه العميل ويمكن تغييره مع كل طلب"""
+    user_id = session.get('user_id')
+    return str(user_id) if user_id else None
+
+def request_account_id():
+    """الحساب المستهدف (user_id في جسم الطلب) لحد التخمين قبل تسجيل الدخول: لا جلسة بعد،
+    ومن يخمن كود حساب معين مضطر لإرسال معرفه نفسه مهما غيّر IP"""
+    data = request.get_json(silent=True) or {}
+    user_id = str(data.get('user_id') or '').strip()
+    return user_id or None
+
+def rate_limited_response(wait):
+    retry_after = max(1, math.ceil(wait))
+    response = jsonify({
+        'success': False,
+        'status': 'error',
+        'message': f'محاولات كثيرة، حاول مرة أخرى بعد {retry_after} ثانية'
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def create_rate_limit_store():
+    """RATE_LIMIT_BACKEND=off يعطل التحديد (لقياس الأداء فقط)"""
+    if RATE_LIMIT_BACKEND == "off":
+        return None
+    if RATE_LIMIT_BACKEND == "redis":
+        try:
+            return RedisRateLimitStore(RATE_LIMIT_REDIS_URL, RATE_LIMIT_IDLE_TTL)
+        except ImportError:
+            log.warning("مكتبة redis غير مثبتة، سيتم تحديد المعدل في ذاكرة كل عامل")
+    return MemoryRateLimitStore(RATE_LIMIT_IDLE_TTL, RATE_LIMIT_MAX_KEYS)
+
+rate_limiter = RateLimiter(create_rate_limit_store())
+metrics.callback('rate_limit_checks_total', 'عدد الطلبات التي فحصت لكل قاعدة',
+                 lambda: {(name,): count for name, count in rate_limiter.checked.items()}, ['rule'], kind='counter')
+metrics.callback('rate_limit_rejected_total', 'عدد الطلبات المرفوضة لكل قاعدة',
+                 lambda: {(name,): count for name, count in rate_limiter.rejected.items()}, ['rule'], kind='counter')
+
+# القواعد: /verify تخمين كود من 6 أرقام، /charge_balance و /شحن تخمين أكواد الشحن
+VERIFY_LIMITS = (RateLimit('verify_ip', 'ip', 20, 60), RateLimit('verify_account', 'account', 5, 600, 'window'))
+CHARGE_LIMITS = (RateLimit('charge_ip', 'ip', 10, 60), RateLimit('charge_user', 'user', 20, 3600, 'window'))
+BUY_LIMITS = (RateLimit('buy_ip', 'ip', 30, 60), RateLimit('buy_user', 'user', 10, 60))
+
 # --- دوال مساعدة ---
 
 # دالة للتعامل مع where بالطريقة المتوافقة
@@ -123,35 +2243,102 @@ def query_where(collection_ref, field, op, value):
     else:
         return collection_ref.where(field, op, value)
 
+@functools.cache
+def compiled_template(source):
+    """ترجمة قالب Jinja مرة واحدة لكل عملية (render_template_string يعيد ترجمته في كل طلب)"""
+    return app.jinja_env.from_string(source)
+
+def render_page(source, **context):
+    return render_template(compiled_template(source), **context)
+
+# --- أقفال الأرصدة ---
+# كل تعديل للرصيد (قراءة ثم كتابة) يتم تحت قفل المستخدم داخل العامل حتى لا تضيع التحديثات المتزامنة.
+# جدول ثابت من الأقفال يختار منه القفل حسب hash المعرف، فلا يتوقف كل المستخدمين على قفل واحد
+# ولا ينمو عدد الأقفال مع عدد المستخدمين
+
+BALANCE_LOCK_STRIPES = int(os.environ.get("BALANCE_LOCK_STRIPES", 64))
+
+class StripedLocks:
+    """جدول أقفال مقسم (RLock لكل شريحة) مع قياس الانتظار عند التزاحم"""
+
+    def __init__(self, stripes):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+        self.acquired = 0
+        self.contended = 0
+
+    def stripe(self, key):
+        return hash(str(key)) % len(self.locks)
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        """قفل شرائح عدة مفاتيح بترتيب ثابت (يمنع الـ deadlock عند قفل مستخدمين معاً)"""
+        locks = [self.locks[index] for index in sorted({self.stripe(key) for key in keys})]
+        for lock in locks:
+            if not lock.acquire(blocking=False):
+                self.contended += 1
+                with balance_lock_wait.timed():
+                    lock.acquire()
+            self.acquired += 1
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+balance_locks = StripedLocks(BALANCE_LOCK_STRIPES)
+balance_lock_wait = metrics.histogram('balance_lock_wait_seconds', 'زمن انتظار قفل الرصيد عند التزاحم')
+metrics.callback('balance_lock_acquired_total', 'عدد مرات أخذ قفل رصيد',
+                 lambda: balance_locks.acquired, kind='counter')
+metrics.callback('balance_lock_contended_total', 'عدد مرات وجود قفل الرصيد مشغولاً بخيط آخر',
+                 lambda: balance_locks.contended, kind='counter')
+
 def get_balance(user_id):
     """جلب الرصيد من Firebase"""
     try:
-        uid = str(user_id)
-        doc = db.collection('users').document(uid).get()
-        if doc.exists:
-            return doc.to_dict().get('balance', 0.0)
-        return 0.0
+        return users_repo.get_balance(user_id)
     except Exception as e:
-        print(f"⚠️ خطأ في جلب الرصيد: {e}")
+        log.warning("خطأ في جلب الرصيد", user_id=user_id, error=str(e))
         return users_wallets.get(str(user_id), 0.0)
 
-def add_balance(user_id, amount):
-    """إضافة رصيد للمستخدم في Firebase والذاكرة"""
+def add_balance(user_id, amount, reason='credit', ref_id=None):
+    """إضافة رصيد للمستخدم مع حركة في السجل بمعاملة واحدة (reason/ref_id تصف مصدرها).
+    يرجع True إذا طُبقت، و False إذا سبق تطبيق نفس (reason, ref_id) أو فشل الحفظ"""
     uid = str(user_id)
-    if uid not in users_wallets:
-        users_wallets[uid] = 0.0
-    users_wallets[uid] += float(amount)
-    
-    # حفظ في Firebase
-    try:
-        db.collection('users').document(uid).set({
-            'balance': users_wallets[uid],
-            'telegram_id': uid,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }, merge=True)
-        print(f"✅ تم حفظ رصيد المستخدم {uid}: {users_wallets[uid]} ريال في Firestore")
-    except Exception as e:
-        print(f"❌ خطأ في حفظ الرصيد إلى Firebase: {e}")
+    amount = float(amount)
+    ref_id = str(ref_id) if ref_id else uuid.uuid4().hex
+    entry_id = ledger_repo.entry_id(uid, reason, ref_id)
+    sharded = users_repo.is_sharded(uid)
+
+    def credit_in_transaction(tx):
+        # الحركة موجودة = العملية طبقت سابقاً (إعادة إرسال أو إعادة محاولة)، فلا يتغير الرصيد
+        if tx.get(ledger_repo.collection, entry_id) is not None:
+            return False, None
+        balance = None
+        user = tx.get(users_repo.collection, uid)
+        if not users_repo.ledger_opened(user):
+            open_ledger(uid, users_repo.opening_balance(uid, user, tx.get), tx)
+        if sharded:
+            # المحفظة الموزعة: زيادة شريحة بدلاً من كتابة الرصيد الكامل
+            users_repo.increment_balance(uid, amount, batch=tx)
+        else:
+            balance = (user or {}).get('balance', 0.0) + amount
+            users_repo.set_balance(uid, balance, batch=tx)
+        ledger_repo.record(uid, amount, reason, ref_id, batch=tx)
+        return True, balance
+
+    with balance_locks.hold(uid):
+        try:
+            applied, balance = store.run_transaction(credit_in_transaction, 'ledger.credit')
+        except Exception as e:
+            log.error("خطأ في حفظ الرصيد إلى Firebase", user_id=uid, error=str(e))
+            return False
+        if not applied:
+            log.warning("حركة رصيد مكررة، لم يتغير الرصيد", user_id=uid, reason=reason, ref_id=ref_id)
+            return False
+        ledger_compactor.touch(uid)
+        users_wallets[uid] = users_repo.get_balance(uid) if sharded else balance
+        log.info("تم حفظ رصيد المستخدم", user_id=uid, balance=users_wallets[uid])
+        return True
 
 def get_user_profile_photo(user_id):
     """جلب صورة البروفايل من تيليجرام أو استخدام صورة افتراضية"""
@@ -163,142 +2350,106 @@ def get_user_profile_photo(user_id):
             file_url = f"https://api.telegram.org/file/bot{TOKEN}/{file_info.file_path}"
             return file_url
     except Exception as e:
-        print(f"⚠️ لم نتمكن من جلب صورة البروفايل: {e}")
+        log.warning("لم نتمكن من جلب صورة البروفايل", user_id=user_id, error=str(e))
     return None
 
-# إضافة UUID للمنتجات الموجودة (إذا لم يكن لديها ID)
-def ensure_product_ids():
-    for item in marketplace_items:
-        if 'id' not in item:
-            item['id'] = str(uuid.uuid4())
-
 # دالة لرفع البيانات من الذاكرة إلى Firebase
 def migrate_data_to_firebase():
     """نقل البيانات من المتغيرات في الذاكرة إلى Firebase"""
     try:
-        print("🔄 بدء نقل البيانات إلى Firebase...")
+        log.info("بدء نقل البيانات إلى Firebase")
         
         # 1. رفع المنتجات
         if marketplace_items:
-            products_ref = db.collection('products')
             for item in marketplace_items:
-                product_id = item.get('id', str(uuid.uuid4()))
-                products_ref.document(product_id).set({
-                    'item_name': item.get('item_name', ''),
-                    'price': float(item.get('price', 0)),
-                    'seller_id': str(item.get('seller_id', '')),
-                    'seller_name': item.get('seller_name', ''),
-                    'hidden_data': item.get('hidden_data', ''),
-                    'image_url': item.get('image_url', ''),
-                    'category': item.get('category', 'أخرى'),
-                    'details': item.get('details', ''),
-                    'sold': item.get('sold', False),
+                data = {
+                    **item.to_dict(),
+                    'category': item.category or 'أخرى',
                     'created_at': firestore.SERVER_TIMESTAMP
-                })
-            print(f"✅ تم رفع {len(marketplace_items)} منتج")
-        
-        # 2. رفع أرصدة المستخدمين
-        if users_wallets:
-            users_ref = db.collection('users')
-            for user_id, balance in users_wallets.items():
-                users_ref.document(str(user_id)).set({
-                    'balance': float(balance),
-                    'telegram_id': str(user_id),
-                    'updated_at': firestore.SERVER_TIMESTAMP
-                }, merge=True)
-            print(f"✅ تم رفع {len(users_wallets)} مستخدم")
-        
-        # 3. رفع الطلبات النشطة
+                }
+                # الكتالوج يحمل بدون البيانات المخفية، فلا نستبدل مستندها بقيمة فارغة
+                if not item.hidden_data:
+                    del data['hidden_data']
+                products_repo.create(item.id, data, merge=True)
+            log.info("تم رفع المنتجات", count=len(marketplace_items))
+        
+        # الأرصدة لا ترفع من الذاكرة: users_wallets نسخة مؤقتة قد تكون أقدم من Firestore،
+        # والرصيد لا يتغير إلا عبر add_balance أو الشراء مع حركة في السجل
+        
+        # 2. رفع الطلبات النشطة
         if active_orders:
-            orders_ref = db.collection('orders')
-            for order_id, order_data in active_orders.items():
-                orders_ref.document(str(order_id)).set({
-                    'item_name': order_data.get('item_name', ''),
-                    'price': float(order_data.get('price', 0)),
-                    'buyer_id': str(order_data.get('buyer_id', '')),
-                    'buyer_name': order_data.get('buyer_name', ''),
-                    'seller_id': str(order_data.get('seller_id', '')),
-                    'status': order_data.get('status', 'pending'),
-                    'admin_id': str(order_data.get('admin_id', '')) if order_data.get('admin_id') else '',
+            for order_id, order in active_orders.items():
+                orders_repo.set(order_id, {
+                    'item_name': order.item_name,
+                    'price': order.price,
+                    'buyer_id': order.buyer_id,
+                    'buyer_name': order.buyer_name,
+                    'seller_id': str(order.seller_id),
+                    'status': order.status,
+                    'admin_id': str(order.admin_id) if order.admin_id else '',
                     'created_at': firestore.SERVER_TIMESTAMP
                 })
-            print(f"✅ تم رفع {len(active_orders)} طلب")
+            log.info("تم رفع الطلبات", count=len(active_orders))
         
-        # 4. رفع مفاتيح الشحن
+        # 3. رفع مفاتيح الشحن
         if charge_keys:
-            keys_ref = db.collection('charge_keys')
-            for key_code, key_data in charge_keys.items():
-                keys_ref.document(key_code).set({
-                    'amount': float(key_data.get('amount', 0)),
-                    'used': key_data.get('used', False),
-                    'used_by': str(key_data.get('used_by', '')) if key_data.get('used_by') else '',
-                    'created_at': key_data.get('created_at', time.time())
+            for key_code, key in charge_keys.items():
+                keys_repo.set(key_code, {
+                    'amount': float(key.amount),
+                    'used': key.used,
+                    'used_by': str(key.used_by) if key.used_by else '',
+                    'created_at': key.created_at or time.time()
                 })
-            print(f"✅ تم رفع {len(charge_keys)} مفتاح شحن")
+            log.info("تم رفع مفاتيح الشحن", count=len(charge_keys))
         
-        print("🎉 تم رفع جميع البيانات إلى Firebase بنجاح!")
+        log.info("تم رفع جميع البيانات إلى Firebase بنجاح")
         return True
         
     except Exception as e:
-        print(f"❌ خطأ في رفع البيانات: {e}")
+        log.error("خطأ في رفع البيانات", error=str(e))
         return False
 
 # دالة لتحميل البيانات من Firebase إلى الذاكرة (عند بدء التشغيل)
 def load_data_from_firebase():
     """تحميل البيانات من Firebase إلى المتغيرات في الذاكرة للاستخدام السريع"""
-    global marketplace_items, users_wallets, charge_keys, active_orders
+    global users_wallets, charge_keys, active_orders
     
     try:
-        print("📥 بدء تحميل البيانات من Firebase...")
+        log.info("بدء تحميل البيانات من Firebase")
         
         # 1. تحميل المنتجات (غير المباعة فقط)
-        print("🔄 جاري تحميل المنتجات من Firestore...")
-        products_ref = query_where(db.collection('products'), 'sold', '==', False)
-        marketplace_items = []
-        for doc in products_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
-            marketplace_items.append(data)
-            print(f"  📦 منتج: {data.get('item_name', 'بدون اسم')} - {data.get('price', 0)} ريال")
-        print(f"✅ تم تحميل {len(marketplace_items)} منتج من Firestore")
+        products = []
+        for product_id, data in products_repo.listing(False):
+            products.append(Product.from_dict(product_id, data))
+            log.debug("منتج", product_id=product_id, item_name=data.get('item_name'), price=data.get('price', 0))
+        marketplace_items.replace(products)
+        log.info("تم تحميل المنتجات", count=len(marketplace_items))
         
         # 2. تحميل أرصدة المستخدمين
-        print("🔄 جاري تحميل المستخدمين من Firestore...")
-        users_ref = db.collection('users')
         users_wallets = {}
-        for doc in users_ref.stream():
-            data = doc.to_dict()
-            users_wallets[doc.id] = data.get('balance', 0.0)
-            print(f"  👤 مستخدم {doc.id}: {data.get('balance', 0)} ريال")
-        print(f"✅ تم تحميل {len(users_wallets)} مستخدم من Firestore")
+        for user_id, data in users_repo.all():
+            users_wallets[user_id] = users_repo.balance_from(user_id, data)
+            log.debug("مستخدم", user_id=user_id, balance=users_wallets[user_id])
+        log.info("تم تحميل المستخدمين", count=len(users_wallets))
         
         # 3. تحميل مفاتيح الشحن (غير المستخدمة فقط)
-        keys_ref = query_where(db.collection('charge_keys'), 'used', '==', False)
         charge_keys = {}
-        for doc in keys_ref.stream():
-            data = doc.to_dict()
-            charge_keys[doc.id] = {
-                'amount': data.get('amount', 0),
-                'used': data.get('used', False),
-                'used_by': data.get('used_by'),
-                'created_at': data.get('created_at', time.time())
-            }
-        print(f"✅ تم تحميل {len(charge_keys)} مفتاح شحن")
+        for key_code, data in keys_repo.unused():
+            charge_keys[key_code] = ChargeKey.from_dict(key_code, data)
+        charge_key_filter.refresh()
+        log.info("تم تحميل مفاتيح الشحن", count=len(charge_keys))
         
         # 4. تحميل الطلبات النشطة (pending فقط)
-        orders_ref = query_where(db.collection('orders'), 'status', '==', 'pending')
         active_orders = {}
-        for doc in orders_ref.stream():
-            data = doc.to_dict()
-            active_orders[doc.id] = data
-        print(f"✅ تم تحميل {len(active_orders)} طلب نشط")
+        for order_id, data in orders_repo.by_status('pending', fields=ORDER_CACHE_FIELDS):
+            active_orders[order_id] = Order.from_dict(order_id, data)
+        log.info("تم تحميل الطلبات النشطة", count=len(active_orders))
         
-        print("🎉 تم تحميل جميع البيانات من Firebase بنجاح!")
+        log.info("تم تحميل جميع البيانات من Firebase بنجاح")
         return True
         
     except Exception as e:
-        print(f"⚠️ تحذير: لم يتم تحميل البيانات من Firebase: {e}")
-        print("سيتم البدء ببيانات فارغة")
+        log.warning("لم يتم تحميل البيانات من Firebase، سيتم البدء ببيانات فارغة", error=str(e))
         return False
 
 # دالة لتوليد كود تحقق عشوائي
@@ -307,34 +2458,278 @@ def generate_verification_code(user_id, user_name):
     code = str(random.randint(100000, 999999))
     
     # حفظ الكود (صالح لمدة 10 دقائق)
-    verification_codes[str(user_id)] = {
-        'code': code,
-        'name': user_name,
-        'created_at': time.time()
-    }
+    verification_codes[str(user_id)] = VerificationCode(code, user_name, time.time())
     
     return code
 
 # دالة للتحقق من صحة الكود
 def verify_code(user_id, code):
-    user_id = str(user_id)
-    
-    if user_id not in verification_codes:
-        return None
-    
-    code_data = verification_codes[user_id]
-    
-    # التحقق من صلاحية الكود (10 دقائق)
-    if time.time() - code_data['created_at'] > 600:  # 10 * 60 ثانية
-        del verification_codes[user_id]
+    # الأكواد المنتهية (أكثر من 10 دقائق) لا تُرجع من verification_codes
+    code_data = verification_codes.get(str(user_id))
+    if code_data is None:
         return None
     
     # التحقق من تطابق الكود
-    if code_data['code'] != code:
+    if code_data.code != code:
         return None
     
     return code_data
 
+# --- طابور تحديثات تيليجرام (Webhook) ---
+# يتم الرد على تيليجرام فوراً ثم تُنفذ المعالجات في عمال بالخلفية.
+# كل محادثة مرتبطة بعامل واحد (حسب chat_id) للحفاظ على ترتيب رسائلها.
+
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_SEEN_SIZE = max(1, int(os.environ.get("WEBHOOK_SEEN_SIZE", 10000)))
+# تفعيل الحفظ في Firestore يمنع التكرار بين عمال gunicorn وبعد إعادة التشغيل
+WEBHOOK_DEDUP_PERSIST = os.environ.get("WEBHOOK_DEDUP_PERSIST", "0") == "1"
+
+def update_chat_id(update):
+    """معرف المحادثة الخاص بالتحديث (لاختيار العامل المسؤول عنه)"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+class UpdateDeduplicator:
+    """آخر update_id تمت معالجتها: حلقة دائرية بحجم ثابت + قاموس (update_id -> موقعه في الحلقة)
+    للبحث والحذف السريع"""
+
+    def __init__(self, size, persist=False):
+        self.ring = [None] * max(1, size)
+        self.position = 0
+        self.seen = {}
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.duplicates = 0
+
+    def check_and_add(self, update_id):
+        """تسجيل التحديث، وإرجاع False إذا كان مكرراً"""
+        with self.lock:
+            self.checks += 1
+            if update_id in self.seen:
+                self.duplicates += 1
+                return False
+            oldest = self.ring[self.position]
+            if oldest is not None:
+                del self.seen[oldest]
+            self.ring[self.position] = update_id
+            self.seen[update_id] = self.position
+            self.position = (self.position + 1) % len(self.ring)
+        
+        if self.persist and not self._persist(update_id):
+            with self.lock:
+                self.duplicates += 1
+            return False
+        return True
+
+    def forget(self, update_id):
+        """إلغاء تسجيل تحديث لم تتم جدولته (ليُقبل عند إعادة الإرسال)"""
+        with self.lock:
+            position = self.seen.pop(update_id, None)
+            if position is not None:
+                self.ring[position] = None
+        if self.persist:
+            try:
+                store.delete('webhook_updates', update_id)
+            except Exception as e:
+                log.warning("خطأ في حذف التحديث من Firebase", update_id=update_id, error=str(e))
+
+    def _persist(self, update_id):
+        """حفظ التحديث في Firestore بعملية create (تفشل إذا سبق حفظه من عامل آخر)"""
+        try:
+            store.create('webhook_updates', update_id, {
+                'received_at': firestore.SERVER_TIMESTAMP,
+                # لاستخدامه مع سياسة TTL في Firestore لحذف السجلات القديمة تلقائياً
+                'expire_at': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+            })
+            return True
+        except AlreadyExists:
+            return False
+        except Exception as e:
+            # عند تعذر الوصول لـ Firebase نكتفي بالمجموعة المحلية
+            log.warning("خطأ في حفظ التحديث في Firebase", update_id=update_id, error=str(e))
+            return True
+
+    def stats(self):
+        """إحصائيات منع التكرار (نسبة التحديثات المكررة)"""
+        with self.lock:
+            return {
+                'checks': self.checks,
+                'duplicates': self.duplicates,
+                'hit_rate': round(self.duplicates / self.checks, 4) if self.checks else 0.0,
+                'tracked': len(self.seen),
+                'capacity': len(self.ring)
+            }
+
+class UpdateDispatcher:
+    """توزيع التحديثات على عمال بالخلفية مع ضمان الترتيب لكل محادثة"""
+
+    def __init__(self, workers, queue_size, deduplicator):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.deduplicator = deduplicator
+        self.lock = threading.Lock()
+        self.started_pid = None
+
+    def start(self):
+        """تشغيل العمال (مرة واحدة لكل عملية، لأن gunicorn ينشئ العمال عبر fork)"""
+        with self.lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+        for index, worker_queue in enumerate(self.queues):
+            threading.Thread(
+                target=self._worker,
+                args=(worker_queue,),
+                name=f"webhook-worker-{index}",
+                daemon=True
+            ).start()
+
+    def submit(self, update):
+        """جدولة التحديث. ترجع False للمكرر وترفع queue.Full عند امتلاء الطابور"""
+        if not self.deduplicator.check_and_add(update.update_id):
+            return False
+        self.start()
+        worker_queue = self.queues[hash(update_chat_id(update)) % len(self.queues)]
+        try:
+            worker_queue.put_nowait(update)
+        except queue.Full:
+            self.deduplicator.forget(update.update_id)
+            raise
+        return True
+
+    def _worker(self, worker_queue):
+        while True:
+            update = worker_queue.get()
+            try:
+                with tracer.span("telegram.update", SPAN_KIND_SERVER, root=True, **{
+                    'telegram.update_id': update.update_id,
+                    'telegram.chat_id': update_chat_id(update) or 0,
+                }):
+                    bot.process_new_updates([update])
+            except Exception as e:
+                log.error("خطأ في معالجة التحديث", update_id=update.update_id, exc=True)
+            finally:
+                worker_queue.task_done()
+
+webhook_dedup = UpdateDeduplicator(WEBHOOK_SEEN_SIZE, persist=WEBHOOK_DEDUP_PERSIST)
+webhook_dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, webhook_dedup)
+
+metrics.callback('webhook_queue_depth', 'عدد التحديثات المنتظرة في طابور كل عامل',
+                 lambda: {(str(index),): q.qsize() for index, q in enumerate(webhook_dispatcher.queues)},
+                 ['worker'])
+metrics.callback('webhook_dedup_checks_total', 'عدد التحديثات التي تم فحصها لمنع التكرار',
+                 lambda: webhook_dedup.stats()['checks'], kind='counter')
+metrics.callback('webhook_dedup_duplicates_total', 'عدد التحديثات المكررة التي تم تجاهلها',
+                 lambda: webhook_dedup.stats()['duplicates'], kind='counter')
+metrics.callback('webhook_dedup_hit_ratio', 'نسبة التحديثات المكررة',
+                 lambda: webhook_dedup.stats()['hit_rate'])
+
+# --- عميل تيليجرام غير المتزامن (للاستدعاءات المتوازية) ---
+# حلقة asyncio في خيط خلفي تستخدم AsyncTeleBot (aiohttp) مع مجمع اتصالات keep-alive.
+# المعالجات المتزامنة ترسل الاستدعاءات عبر telegram_io وتنتظر النتائج إذا احتاجتها.
+
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 20))
+TELEGRAM_CALL_TIMEOUT = float(os.environ.get("TELEGRAM_CALL_TIMEOUT", 10))
+
+asyncio_helper.REQUEST_LIMIT = TELEGRAM_POOL_SIZE
+asyncio_helper.REQUEST_TIMEOUT = TELEGRAM_CALL_TIMEOUT
+
+class TelegramAsyncBridge:
+    """جسر بين المعالجات المتزامنة وعميل تيليجرام غير المتزامن"""
+
+    def __init__(self, token):
+        self.token = token
+        self.client = None
+        self.loop = None
+        self.lock = threading.Lock()
+        self.started_pid = None
+
+    def _ensure_started(self):
+        """تشغيل الحلقة مرة واحدة لكل عملية (بعد fork في gunicorn)"""
+        with self.lock:
+            if self.started_pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                self.client = AsyncTeleBot(self.token)
+                threading.Thread(target=self.loop.run_forever, name="telegram-io", daemon=True).start()
+                self.started_pid = os.getpid()
+            return self.loop
+
+    def submit(self, method, *args, **kwargs):
+        """جدولة استدعاء باسم دالة الـ API (مثل 'delete_message') وإرجاع Future"""
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(tracer.bind(getattr(self.client, method)(*args, **kwargs)), loop)
+
+    def call(self, method, *args, **kwargs):
+        """استدعاء واحد مع انتظار النتيجة"""
+        return self.submit(method, *args, **kwargs).result(TELEGRAM_CALL_TIMEOUT)
+
+    def gather(self, calls, timeout=TELEGRAM_CALL_TIMEOUT):
+        """تنفيذ عدة استدعاءات بالتوازي: calls قائمة (method, args, kwargs)
+        ترجع النتائج بنفس الترتيب، والاستدعاء الفاشل أو المتأخر يرجع كاستثناء"""
+        futures = [self.submit(method, *args, **kwargs) for method, args, kwargs in calls]
+        done, _ = concurrent.futures.wait(futures, timeout=timeout)
+        results = []
+        for future in futures:
+            if future not in done:
+                future.cancel()
+                results.append(TimeoutError("انتهت مهلة استدعاء تيليجرام"))
+            elif future.exception():
+                results.append(future.exception())
+            else:
+                results.append(future.result())
+        return results
+
+telegram_io = TelegramAsyncBridge(TOKEN)
+
+# قياس زمن كل استدعاء Bot API (العميل المتزامن والعميل غير المتزامن)
+def _timed_telegram_request(method, url, **kwargs):
+    api_method = url.rsplit('/', 1)[-1]
+    with telegram_latency.timed(api_method, 'sync'), tracer.span(
+        f"telegram {api_method}", SPAN_KIND_CLIENT, **{'telegram.method': api_method, 'telegram.transport': 'sync'}
+    ):
+        return apihelper._get_req_session().request(method, url, **kwargs)
+
+_async_process_request = asyncio_helper._process_request
+
+async def _timed_async_telegram_request(token, url, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        with tracer.span(f"telegram {url}", SPAN_KIND_CLIENT, **{'telegram.method': url, 'telegram.transport': 'async'}):
+            return await _async_process_request(token, url, *args, **kwargs)
+    finally:
+        telegram_latency.observe((url, 'async'), time.perf_counter() - start)
+
+apihelper.CUSTOM_REQUEST_SENDER = _timed_telegram_request
+asyncio_helper._process_request = _timed_async_telegram_request
+
+# --- إرسال متوازي لجميع المشرفين ---
+
+ADMIN_FANOUT_DEADLINE = float(os.environ.get("ADMIN_FANOUT_DEADLINE", 5))
+
+def fan_out_admins(method, build_call, admin_ids=None, deadline=ADMIN_FANOUT_DEADLINE):
+    """تنفيذ استدعاء تيليجرام لكل المشرفين بالتوازي خلال مهلة واحدة
+    build_call(admin_id) ترجع (args, kwargs) أو None لتخطي المشرف
+    ترجع {admin_id: النتيجة أو الاستثناء}"""
+    targets = []
+    calls = []
+    for admin_id in (admins_database if admin_ids is None else admin_ids):
+        call = build_call(admin_id)
+        if call is None:
+            continue
+        args, kwargs = call
+        targets.append(admin_id)
+        calls.append((method, args, kwargs))
+    
+    if not calls:
+        return {}
+    return dict(zip(targets, telegram_io.gather(calls, timeout=deadline)))
+
 # --- كود صفحة الويب (HTML + JavaScript) ---
 HTML_PAGE = """
 <!DOCTYPE html>
@@ -2177,12 +4572,10 @@ HTML_PAGE = """
         </div>
     </div>
     
+    <!-- البطاقات الظاهرة أولاً فقط، والباقي يرسم من catalog عند التصفية -->
     <div id="market" class="product-grid">
-        {% for item in items %}
-        <div class="product-card {% if item.get('sold') %}sold-product{% endif %}">
-            {% if item.get('sold') %}
-            <div class="sold-ribbon">مباع ✓</div>
-            {% endif %}
+        {% for item in first_cards %}
+        <div class="product-card" data-id="{{ item.id }}">
             <div class="product-image">
                 {% if item.get('image_url') %}
                 <img src="{{ item.image_url }}" alt="{{ item.item_name }}">
@@ -2199,15 +4592,10 @@ HTML_PAGE = """
                 {% endif %}
                 <div class="product-name">{{ item.item_name }}</div>
                 <div class="product-seller">🏪 {{ item.seller_name }}</div>
-                {% if item.get('sold') and item.get('buyer_name') %}
-                <div class="sold-info">🎉 تم شراءه بواسطة: {{ item.buyer_name }}</div>
-                {% endif %}
                 <div class="product-footer">
                     <div class="product-price">{{ item.price }} ريال</div>
-                    {% if item.get('sold') %}
-                        <button class="product-buy-btn" disabled style="opacity: 0.5; cursor: not-allowed;">مباع 🚫</button>
-                    {% elif item.seller_id|string != current_user_id|string %}
-                        <button class="product-buy-btn" onclick='buyItem("{{ item.id }}", {{ item.price }}, "{{ item.item_name|replace('"', '\\"') }}", "{{ item.get('category', '')|replace('"', '\\"') }}", {{ item.get('details', '')|tojson }})'>شراء 🛒</button>
+                    {% if item.seller_id|string != current_user_id|string %}
+                        <button class="product-buy-btn" onclick="buyProduct(this)">شراء 🛒</button>
                     {% else %}
                         <div class="my-product-badge">منتجك ⭐</div>
                     {% endif %}
@@ -2555,9 +4943,75 @@ HTML_PAGE = """
         }
         
         // تصفية المنتجات حسب الفئة
-        let allItems = {{ items|tojson }};
+        // الكتالوج بصيغة أعمدة مضغوطة: {cols: [...], rows: [[...], ...]} (المصدر الوحيد لبيانات البطاقات)
+        const catalog = {{ catalog|tojson }};
+        const allItems = catalog.rows.map(row => Object.fromEntries(catalog.cols.map((col, i) => [col, row[i]])));
+        const itemsById = new Map(allItems.map(item => [item.id, item]));
         let currentCategory = 'all'; // متغير لتتبع الفئة الحالية
         
+        function escapeHtml(value) {
+            return String(value ?? '').replace(/[&<>"']/g, ch => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[ch]));
+        }
+        
+        // نفس بطاقة القالب في الخادم
+        function renderProductCard(item) {
+            const isMyProduct = item.seller_id == currentUserId;
+            const card = document.createElement('div');
+            card.className = 'product-card';
+            card.dataset.id = item.id;
+            card.innerHTML = `
+                <div class="product-image">
+                    ${item.image_url ? `<img src="${escapeHtml(item.image_url)}" alt="${escapeHtml(item.item_name)}" loading="lazy">` : '🎁'}
+                </div>
+                ${item.category ? `<div class="product-badge">${escapeHtml(item.category)}</div>` : ''}
+                <div class="product-info">
+                    ${item.category ? `<span class="product-category">${escapeHtml(item.category)}</span>` : ''}
+                    <div class="product-name">${escapeHtml(item.item_name)}</div>
+                    <div class="product-seller">🏪 ${escapeHtml(item.seller_name)}</div>
+                    <div class="product-footer">
+                        <div class="product-price">${item.price} ريال</div>
+                        ${!isMyProduct ?
+                            `<button class="product-buy-btn" onclick="buyProduct(this)">شراء 🛒</button>` :
+                            `<div class="my-product-badge">منتجك ⭐</div>`}
+                    </div>
+                </div>
+            `;
+            return card;
+        }
+        
+        function buyProduct(button) {
+            const item = itemsById.get(button.closest('.product-card').dataset.id);
+            buyItem(item.id, item.price, item.item_name || '', item.category || '', item.details || '');
+        }
+        
+        // تحديث الشبكة بالمفاتيح (data-id): البطاقات الموجودة تنقل كما هي، وتنشأ الناقصة فقط، وتحذف الزائدة
+        function renderMarket(items) {
+            const market = document.getElementById('market');
+            const existing = new Map();
+            market.querySelectorAll(':scope > .product-card[data-id]').forEach(card => existing.set(card.dataset.id, card));
+            market.querySelectorAll(':scope > .market-empty').forEach(node => node.remove());
+            
+            let cursor = market.firstElementChild;
+            items.forEach(item => {
+                let card = existing.get(item.id);
+                if(card) {
+                    existing.delete(item.id);
+                } else {
+                    card = renderProductCard(item);
+                }
+                if(card === cursor) {
+                    cursor = cursor.nextElementSibling;
+                } else {
+                    market.insertBefore(card, cursor);
+                }
+            });
+            existing.forEach(card => card.remove());
+            
+            if(items.length === 0) {
+                market.insertAdjacentHTML('beforeend', '<p class="market-empty" style="text-align:center; color:#888; grid-column: 1/-1; padding: 40px;">📭 لا توجد منتجات في هذا القسم</p>');
+            }
+        }
+        
         function filterCategory(category) {
             currentCategory = category; // حفظ الفئة الحالية
             
@@ -2591,51 +5045,7 @@ HTML_PAGE = """
             }
             
             // تصفية وعرض المنتجات
-            const market = document.getElementById('market');
-            market.innerHTML = '';
-            
-            let filteredItems = category === 'all' ? allItems : allItems.filter(item => item.category === category);
-            
-            // ترتيب المنتجات: المتاحة أولاً، ثم المباعة
-            filteredItems.sort((a, b) => {
-                if(a.sold && !b.sold) return 1;
-                if(!a.sold && b.sold) return -1;
-                return 0;
-            });
-            
-            if(filteredItems.length === 0) {
-                market.innerHTML = '<p style="text-align:center; color:#888; grid-column: 1/-1; padding: 40px;">📭 لا توجد منتجات في هذا القسم</p>';
-            } else {
-                filteredItems.forEach((item, index) => {
-                    const isMyProduct = item.seller_id == currentUserId;
-                    const isSold = item.sold === true;
-                    const productHTML = `
-                        <div class="product-card ${isSold ? 'sold-product' : ''}">
-                            ${isSold ? '<div class="sold-ribbon">مباع ✓</div>' : ''}
-                            <div class="product-image">
-                                ${item.image_url ? `<img src="${item.image_url}" alt="${item.item_name}">` : '🎁'}
-                            </div>
-                            ${item.category ? `<div class="product-badge">${item.category}</div>` : ''}
-                            <div class="product-info">
-                                ${item.category ? `<span class="product-category">${item.category}</span>` : ''}
-                                <div class="product-name">${item.item_name}</div>
-                                <div class="product-seller">🏪 ${item.seller_name}</div>
-                                ${isSold && item.buyer_name ? `<div class="sold-info">🎉 تم شراءه بواسطة: ${item.buyer_name}</div>` : ''}
-                                <div class="product-footer">
-                                    <div class="product-price">${item.price} ريال</div>
-                                    ${isSold ? 
-                                        `<button class="product-buy-btn" disabled style="opacity: 0.5; cursor: not-allowed;">مباع 🚫</button>` :
-                                        (!isMyProduct ? 
-                                            `<button class="product-buy-btn" onclick='buyItem("${item.id}", ${item.price}, "${(item.item_name || '').replace(/"/g, '\\"')}", "${(item.category || '').replace(/"/g, '\\"')}", ${JSON.stringify(item.details || '')})'>شراء 🛒</button>` : 
-                                            `<div class="my-product-badge">منتجك ⭐</div>`)
-                                    }
-                                </div>
-                            </div>
-                        </div>
-                    `;
-                    market.innerHTML += productHTML;
-                });
-            }
+            renderMarket(category === 'all' ? allItems : allItems.filter(item => item.category === category));
             
             // تصفية المنتجات المباعة أيضاً
             filterSoldByMainCategory(category);
@@ -2806,9 +5216,9 @@ HTML_PAGE = """
             }
         }
         
-        // تحميل أول قسم (نتفلكس) عند فتح الصفحة
+        // تحميل أول قسم عند فتح الصفحة (بطاقاته الأولى مرسومة من الخادم وتبقى كما هي)
         window.addEventListener('DOMContentLoaded', function() {
-            filterCategory('نتفلكس');
+            filterCategory({{ initial_category|tojson }});
         });
         
         // ========== Bottom Bar Functions ==========
@@ -3037,9 +5447,82 @@ HTML_PAGE = """
 </html>
 """
 
+# --- توجيه أوامر البوت ---
+# telebot يفحص شروط المعالجات واحداً تلو الآخر بترتيب تسجيلها، فكل رسالة تمر على كل
+# الشروط قبل معالجها، ومعالج الرسائل العام المسجل قبل /my_id و /add_admin كان يحجبها.
+# هنا نسجل معالجاً واحداً للرسائل وآخر للأزرار ونوجه منهما عبر قواميس:
+# الأمر ونص الزر بحث مباشر، وبادئة الزر تُقطع عند '_' (الأطول أولاً حتى تسبق buyer_confirm_ على confirm_)
+
+class BotRouter:
+    """جداول توجيه الأوامر ونصوص الأزرار وبادئات أزرار inline"""
+    def __init__(self):
+        self.commands = {}
+        self.texts = {}
+        self.callbacks = {}
+        self.fallback = None
+
+    def _register(self, table, keys):
+        def decorator(handler):
+            for key in keys:
+                if key in table:
+                    raise ValueError(f"معالج مكرر لـ {key!r}")
+                table[key] = handler
+            return handler
+        return decorator
+
+    def command(self, *names):
+        return self._register(self.commands, names)
+
+    def text(self, *texts):
+        return self._register(self.texts, texts)
+
+    def callback(self, *prefixes):
+        for prefix in prefixes:
+            if not prefix.endswith('_'):
+                raise ValueError(f"بادئة الزر يجب أن تنتهي بـ '_': {prefix!r}")
+        return self._register(self.callbacks, prefixes)
+
+    def default(self, handler):
+        self.fallback = handler
+        return handler
+
+    def match_message(self, text):
+        if text.startswith('/'):
+            # نفس استخراج telebot: "/start@bot payload" -> start
+            command = text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+            handler = self.commands.get(command)
+            if handler is not None:
+                return handler
+        return self.texts.get(text, self.fallback)
+
+    def match_callback(self, data):
+        end = data.rfind('_')
+        while end > 0:
+            handler = self.callbacks.get(data[:end + 1])
+            if handler is not None:
+                return handler
+            end = data.rfind('_', 0, end)
+        return None
+
+    def dispatch_message(self, message):
+        handler = self.match_message(message.text or '')
+        if handler is not None:
+            return handler(message)
+
+    def dispatch_callback(self, call):
+        handler = self.match_callback(call.data or '')
+        if handler is not None:
+            return handler(call)
+
+router = BotRouter()
+# خطوات register_next_step_handler (معالج إضافة المنتج) يعالجها telebot قبل هذين المعالجين
+bot.message_handler(func=lambda message: True)(router.dispatch_message)
+bot.callback_query_handler(func=lambda call: True)(router.dispatch_callback)
+
 # --- أوامر البوت ---
 
-@bot.message_handler(commands=['start'])
+@router.command('start')
+@timed_handler
 def send_welcome(message):
     try:
         user_id = str(message.from_user.id)
@@ -3048,36 +5531,23 @@ def send_welcome(message):
             user_name += ' ' + message.from_user.last_name
         username = message.from_user.username or ''
         
-        print(f"✅ استقبال أمر /start من {user_name} ({user_id})")
+        log.info("استقبال أمر /start", user_id=user_id, sample=True)
         
         # حفظ معلومات المستخدم في Firebase
         try:
-            if db:
-                user_ref = db.collection('users').document(user_id)
-                user_doc = user_ref.get()
-                
-                if not user_doc.exists:
-                    # مستخدم جديد - إنشاء حساب
-                    user_ref.set({
-                        'telegram_id': user_id,
-                        'name': user_name,
-                        'username': username,
-                        'balance': 0.0,
-                        'created_at': firestore.SERVER_TIMESTAMP,
-                        'last_seen': firestore.SERVER_TIMESTAMP
-                    })
-                    users_wallets[user_id] = 0.0
-                    print(f"✅ تم إنشاء حساب جديد للمستخدم {user_id}")
-                else:
-                    # مستخدم موجود - تحديث آخر ظهور
-                    user_ref.update({
-                        'name': user_name,
-                        'username': username,
-                        'last_seen': firestore.SERVER_TIMESTAMP
-                    })
-                    print(f"✅ تم تحديث بيانات المستخدم {user_id}")
+            if user_id not in known_users and users_repo.get(user_id) is None:
+                # مستخدم جديد - إنشاء حساب
+                users_repo.create_profile(user_id, user_name, username)
+                users_wallets[user_id] = 0.0
+                known_users[user_id] = True
+                log.info("تم إنشاء حساب جديد للمستخدم", user_id=user_id)
+            else:
+                # مستخدم موجود - تحديث آخر ظهور (يكتب لاحقاً مع غيره في دفعة واحدة)
+                known_users[user_id] = True
+                profile_buffer.touch(user_id, user_name, username)
+                log.debug("تم تحديث بيانات المستخدم", user_id=user_id)
         except Exception as e:
-            print(f"⚠️ خطأ في حفظ معلومات المستخدم: {e}")
+            log.warning("خطأ في حفظ معلومات المستخدم", user_id=user_id, error=str(e))
         
         # إنشاء لوحة أزرار تفاعلية
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -3100,13 +5570,13 @@ def send_welcome(message):
             reply_markup=markup,
             parse_mode="Markdown"
         )
-        print(f"✅ تم إرسال رسالة الترحيب")
+        log.debug("تم إرسال رسالة الترحيب", user_id=user_id)
     except Exception as e:
-        print(f"❌ خطأ في معالج /start: {e}")
+        log.error("خطأ في معالج /start", exc=True)
         try:
             bot.send_message(message.chat.id, f"❌ حدث خطأ: {str(e)}")
         except:
-            print(f"❌ فشل إرسال رسالة الخطأ")
+            log.error("فشل إرسال رسالة الخطأ")
 
     btn_web = types.KeyboardButton("🏪 افتح السوق")
     btn_myid = types.KeyboardButton("🆔 معرفي")
@@ -3126,11 +5596,10 @@ def send_welcome(message):
     )
 
 # معالج الرسائل النصية (الأزرار)
-@bot.message_handler(func=lambda message: message.text in [
-    "🔐 كود الدخول", "🏪 افتح السوق", "🆔 معرفي"
-])
+@router.text("🔐 كود الدخول", "🏪 افتح السوق", "🆔 معرفي")
+@timed_handler
 def handle_buttons(message):
-    print(f"✅ استقبال ضغطة زر من {message.from_user.first_name}")
+    log.debug("استقبال ضغطة زر", user_id=message.from_user.id, button=message.text)
     if message.text == "🔐 كود الدخول":
         get_verification_code(message)
     
@@ -3141,9 +5610,10 @@ def handle_buttons(message):
         my_id(message)
 
 # معالج نصوص عام (لالتقاط جميع الرسائل الأخرى)
-@bot.message_handler(func=lambda message: True)
+@router.default
+@timed_handler
 def handle_unknown(message):
-    print(f"⚠️ رسالة غير معروفة: {message.text}")
+    log.info("رسالة غير معروفة", user_id=message.from_user.id, text=(message.text or '')[:100], sample=True)
     bot.reply_to(message, 
                  "📝 عذراً، لم أفهم الأمر\n\n"
                  "استخدم الأزرار أعلاه أو جرّب:\n"
@@ -3152,12 +5622,14 @@ def handle_unknown(message):
                  "• /my_id - معرفك")
 
 
-@bot.message_handler(commands=['my_id'])
+@router.command('my_id')
+@timed_handler
 def my_id(message):
     bot.reply_to(message, f"الآيدي الخاص بك: {message.from_user.id}\n\nأرسل هذا الرقم للمالك ليضيفك كمشرف!")
 
 # أمر إضافة مشرف (فقط للمالك)
-@bot.message_handler(commands=['add_admin'])
+@router.command('add_admin')
+@timed_handler
 def add_admin_command(message):
     # التحقق من أن المستخدم هو المالك
     if message.from_user.id != ADMIN_ID:
@@ -3204,7 +5676,8 @@ def add_admin_command(message):
         bot.reply_to(message, f"❌ حدث خطأ: {str(e)}")
 
 # أمر حذف مشرف (فقط للمالك)
-@bot.message_handler(commands=['remove_admin'])
+@router.command('remove_admin')
+@timed_handler
 def remove_admin_command(message):
     # التحقق من أن المستخدم هو المالك
     if message.from_user.id != ADMIN_ID:
@@ -3250,7 +5723,8 @@ def remove_admin_command(message):
         bot.reply_to(message, f"❌ حدث خطأ: {str(e)}")
 
 # أمر عرض قائمة المشرفين (فقط للمالك)
-@bot.message_handler(commands=['list_admins'])
+@router.command('list_admins')
+@timed_handler
 def list_admins_command(message):
     # التحقق من أن المستخدم هو المالك
     if message.from_user.id != ADMIN_ID:
@@ -3268,10 +5742,21 @@ def list_admins_command(message):
     bot.reply_to(message, admins_list_text)
 
 # تخزين بيانات المنتج المؤقتة
-temp_product_data = {}
+# حالة معالج إضافة المنتج لكل مستخدم (تنتهي بعد مدة من آخر خطوة)
+PRODUCT_WIZARD_TTL = int(os.environ.get("PRODUCT_WIZARD_TTL", 900))
+temp_product_data = TTLMap('add_product_wizard', PRODUCT_WIZARD_TTL, max_size=1000, sliding=True)
+
+def wizard_state(message):
+    """بيانات المعالج الحالية، أو None مع إبلاغ المستخدم إذا انتهت المهلة"""
+    state = temp_product_data.get(message.from_user.id)
+    if state is None:
+        bot.reply_to(message, "⌛ انتهت مهلة إضافة المنتج، ابدأ من جديد عبر /add_product",
+                     reply_markup=types.ReplyKeyboardRemove())
+    return state
 
 # أمر إضافة منتج (فقط للمالك)
-@bot.message_handler(commands=['add_product'])
+@router.command('add_product')
+@timed_handler
 def add_product_command(message):
     # التحقق من أن المستخدم هو المالك
     if message.from_user.id != ADMIN_ID:
@@ -3284,6 +5769,7 @@ def add_product_command(message):
     msg = bot.reply_to(message, "📦 **إضافة منتج جديد**\n\n📝 أرسل اسم المنتج:", parse_mode="Markdown")
     bot.register_next_step_handler(msg, process_product_name)
 
+@timed_handler
 def process_product_name(message):
     user_id = message.from_user.id
     
@@ -3291,12 +5777,17 @@ def process_product_name(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
     
-    temp_product_data[user_id]['item_name'] = message.text.strip()
+    state = wizard_state(message)
+    if state is None:
+        return
+    
+    state['item_name'] = message.text.strip()
     bot.reply_to(message, f"✅ تم إضافة الاسم: {message.text.strip()}")
     
     msg = bot.send_message(message.chat.id, "💰 أرسل سعر المنتج (بالريال):")
     bot.register_next_step_handler(msg, process_product_price)
 
+@timed_handler
 def process_product_price(message):
     user_id = message.from_user.id
     
@@ -3304,10 +5795,14 @@ def process_product_price(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
     
+    state = wizard_state(message)
+    if state is None:
+        return
+    
     # التحقق من السعر
     try:
         price = float(message.text.strip())
-        temp_product_data[user_id]['price'] = str(price)
+        state['price'] = str(price)
         bot.reply_to(message, f"✅ تم إضافة السعر: {price} ريال")
         
         # إرسال أزرار الفئات
@@ -3328,6 +5823,7 @@ def process_product_price(message):
         msg = bot.reply_to(message, "❌ السعر يجب أن يكون رقماً! أرسل السعر مرة أخرى:")
         bot.register_next_step_handler(msg, process_product_price)
 
+@timed_handler
 def process_product_category(message):
     user_id = message.from_user.id
     
@@ -3335,6 +5831,10 @@ def process_product_category(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
     
+    state = wizard_state(message)
+    if state is None:
+        return
+    
     valid_categories = ["نتفلكس", "شاهد", "ديزني بلس", "اوسن بلس", "فديو بريميم", "اشتراكات أخرى"]
     
     if message.text.strip() not in valid_categories:
@@ -3350,12 +5850,13 @@ def process_product_category(message):
         msg = bot.reply_to(message, "❌ فئة غير صحيحة! اختر من الأزرار:", reply_markup=markup)
         return bot.register_next_step_handler(msg, process_product_category)
     
-    temp_product_data[user_id]['category'] = message.text.strip()
+    state['category'] = message.text.strip()
     bot.reply_to(message, f"✅ تم اختيار الفئة: {message.text.strip()}", reply_markup=types.ReplyKeyboardRemove())
     
     msg = bot.send_message(message.chat.id, "📝 أرسل تفاصيل المنتج (مثل: مدة الاشتراك، المميزات، إلخ):")
     bot.register_next_step_handler(msg, process_product_details)
 
+@timed_handler
 def process_product_details(message):
     user_id = message.from_user.id
     
@@ -3363,7 +5864,11 @@ def process_product_details(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
     
-    temp_product_data[user_id]['details'] = message.text.strip()
+    state = wizard_state(message)
+    if state is None:
+        return
+    
+    state['details'] = message.text.strip()
     bot.reply_to(message, "✅ تم إضافة التفاصيل")
     
     markup = types.ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
@@ -3372,6 +5877,7 @@ def process_product_details(message):
     msg = bot.send_message(message.chat.id, "🖼️ أرسل رابط صورة المنتج (أو اضغط تخطي):", reply_markup=markup)
     bot.register_next_step_handler(msg, process_product_image)
 
+@timed_handler
 def process_product_image(message):
     user_id = message.from_user.id
     
@@ -3379,16 +5885,21 @@ def process_product_image(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
     
+    state = wizard_state(message)
+    if state is None:
+        return
+    
     if message.text.strip() == "تخطي":
-        temp_product_data[user_id]['image_url'] = "https://via.placeholder.com/300x200?text=No+Image"
+        state['image_url'] = "https://via.placeholder.com/300x200?text=No+Image"
         bot.reply_to(message, "⏭️ تم تخطي الصورة", reply_markup=types.ReplyKeyboardRemove())
     else:
-        temp_product_data[user_id]['image_url'] = message.text.strip()
+        state['image_url'] = message.text.strip()
         bot.reply_to(message, "✅ تم إضافة رابط الصورة", reply_markup=types.ReplyKeyboardRemove())
     
     msg = bot.send_message(message.chat.id, "🔐 أرسل البيانات المخفية (الايميل والباسورد مثلاً):")
     bot.register_next_step_handler(msg, process_product_hidden_data)
 
+@timed_handler
 def process_product_hidden_data(message):
     user_id = message.from_user.id
     
@@ -3396,11 +5907,15 @@ def process_product_hidden_data(message):
         temp_product_data.pop(user_id, None)
         return bot.reply_to(message, "❌ تم إلغاء إضافة المنتج")
     
-    temp_product_data[user_id]['hidden_data'] = message.text.strip()
+    state = wizard_state(message)
+    if state is None:
+        return
+    
+    state['hidden_data'] = message.text.strip()
     bot.reply_to(message, "✅ تم إضافة البيانات المخفية")
     
     # عرض ملخص المنتج
-    product = temp_product_data[user_id]
+    product = state
     summary = (
         "📦 **ملخص المنتج:**\n\n"
         f"📝 الاسم: {product['item_name']}\n"
@@ -3421,6 +5936,7 @@ def process_product_hidden_data(message):
     msg = bot.send_message(message.chat.id, summary, parse_mode="Markdown", reply_markup=markup)
     bot.register_next_step_handler(msg, confirm_add_product)
 
+@timed_handler
 def confirm_add_product(message):
     user_id = message.from_user.id
     
@@ -3430,39 +5946,27 @@ def confirm_add_product(message):
         if product:
             # إضافة المنتج
             product_id = str(uuid.uuid4())  # رقم فريد لا يتكرر
-            item = {
-                'id': product_id,
-                'item_name': product['item_name'],
-                'price': str(product['price']),
-                'seller_id': str(ADMIN_ID),
-                'seller_name': 'المالك',
-                'hidden_data': product['hidden_data'],
-                'category': product['category'],
-                'details': product['details'],
-                'image_url': product['image_url'],
-                'sold': False
-            }
+            item = Product(
+                id=product_id,
+                item_name=product['item_name'],
+                price=product['price'],
+                seller_id=str(ADMIN_ID),
+                seller_name='المالك',
+                hidden_data=product['hidden_data'],
+                category=product['category'],
+                details=product['details'],
+                image_url=product['image_url']
+            )
             
             # حفظ في Firebase أولاً
             try:
-                db.collection('products').document(product_id).set({
-                    'item_name': item['item_name'],
-                    'price': float(product['price']),
-                    'seller_id': str(ADMIN_ID),
-                    'seller_name': 'المالك',
-                    'hidden_data': item['hidden_data'],
-                    'category': item['category'],
-                    'details': item['details'],
-                    'image_url': item['image_url'],
-                    'sold': False,
-                    'created_at': firestore.SERVER_TIMESTAMP
-                })
-                print(f"✅ تم حفظ المنتج {product_id} في Firebase")
+                products_repo.create(product_id, {**item.to_dict(), 'created_at': firestore.SERVER_TIMESTAMP})
+                log.info("تم حفظ المنتج في Firebase", product_id=product_id)
             except Exception as e:
-                print(f"❌ خطأ في حفظ المنتج في Firebase: {e}")
+                log.error("خطأ في حفظ المنتج في Firebase", product_id=product_id, error=str(e))
             
             # حفظ في الذاكرة
-            marketplace_items.append(item)
+            marketplace_items.add(item)
             
             bot.reply_to(message,
                          f"✅ **تم إضافة المنتج بنجاح!**\n\n"
@@ -3479,7 +5983,8 @@ def confirm_add_product(message):
         bot.reply_to(message, "❌ تم إلغاء إضافة المنتج", reply_markup=types.ReplyKeyboardRemove())
         temp_product_data.pop(user_id, None)
 
-@bot.message_handler(commands=['code'])
+@router.command('code')
+@timed_handler
 def get_verification_code(message):
     user_id = message.from_user.id
     user_name = message.from_user.first_name
@@ -3504,7 +6009,8 @@ def get_verification_code(message):
 # أمر خاص بالآدمن لشحن رصيد المستخدمين
 # طريقة الاستخدام: /add ID AMOUNT
 # مثال: /add 123456789 50
-@bot.message_handler(commands=['add'])
+@router.command('add')
+@timed_handler
 def add_funds(message):
     if message.from_user.id != ADMIN_ID:
         return bot.reply_to(message, "⛔ هذا الأمر للمشرف فقط.")
@@ -3513,7 +6019,9 @@ def add_funds(message):
         parts = message.text.split()
         target_id = parts[1]
         amount = float(parts[2])
-        add_balance(target_id, amount)
+        # معرف الرسالة كمرجع: إعادة تسليم نفس التحديث لا تشحن مرتين
+        if not add_balance(target_id, amount, 'admin_credit', f"msg{message.chat.id}_{message.message_id}"):
+            return bot.reply_to(message, "⚠️ لم يتم الشحن (طلب مكرر أو خطأ في الحفظ)")
         bot.reply_to(message, f"✅ تم إضافة {amount} ريال للمستخدم {target_id}")
         bot.send_message(target_id, f"🎉 تم شحن رصيدك بمبلغ {amount} ريال!")
     except:
@@ -3522,7 +6030,8 @@ def add_funds(message):
 # أمر توليد مفاتيح الشحن
 # الاستخدام: /توليد AMOUNT [COUNT]
 # مثال: /توليد 50 10  (توليد 10 مفاتيح بقيمة 50 ريال لكل منها)
-@bot.message_handler(commands=['توليد'])
+@router.command('توليد')
+@timed_handler
 def generate_keys(message):
     if message.from_user.id != ADMIN_ID:
         return bot.reply_to(message, "⛔ هذا الأمر للمالك فقط!")
@@ -3546,23 +6055,18 @@ def generate_keys(message):
             key_code = f"KEY-{random.randint(10000, 99999)}-{random.randint(1000, 9999)}"
             
             # حفظ المفتاح في الذاكرة
-            charge_keys[key_code] = {
-                'amount': amount,
-                'used': False,
-                'used_by': None,
-                'created_at': time.time()
-            }
+            register_charge_key(key_code, amount)
             
             # حفظ في Firebase
             try:
-                db.collection('charge_keys').document(key_code).set({
+                keys_repo.set(key_code, {
                     'amount': float(amount),
                     'used': False,
                     'used_by': '',
                     'created_at': time.time()
                 })
             except Exception as e:
-                print(f"⚠️ خطأ في حفظ المفتاح في Firebase: {e}")
+                log.warning("خطأ في حفظ المفتاح في Firebase", error=str(e))
             
             generated_keys.append(key_code)
         
@@ -3601,7 +6105,8 @@ def generate_keys(message):
         bot.reply_to(message, "❌ الرجاء إدخال أرقام صحيحة!")
 
 # أمر شحن الرصيد بالمفتاح
-@bot.message_handler(commands=['شحن'])
+@router.command('شحن')
+@timed_handler
 def charge_with_key(message):
     try:
         parts = message.text.split()
@@ -3618,42 +6123,31 @@ def charge_with_key(message):
         user_id = str(message.from_user.id)
         user_name = message.from_user.first_name
         
-        # التحقق من وجود المفتاح
-        if key_code not in charge_keys:
-            return bot.reply_to(message, "❌ المفتاح غير صحيح أو منتهي الصلاحية!")
+        # نفس حد المحاولات لكل مستخدم في الموقع
+        wait = rate_limiter.check(CHARGE_LIMITS[1], user_id)
+        if wait:
+            return bot.reply_to(message, f"⏳ محاولات كثيرة، حاول مرة أخرى بعد {math.ceil(wait)} ثانية")
         
-        key_data = charge_keys[key_code]
+        # استخدام المفتاح وشحن الرصيد في معاملة واحدة
+        result = key_redemption.redeem(key_code, user_id, used_by=user_name)
         
-        # التحقق من استخدام المفتاح
-        if key_data['used']:
+        if result.status == 'unknown':
+            return bot.reply_to(message, "❌ المفتاح غير صحيح أو منتهي الصلاحية!")
+        
+        if result.status == 'used':
             return bot.reply_to(message, 
                               f"❌ هذا المفتاح تم استخدامه بالفعل!\n\n"
-                              f"👤 استخدمه: {key_data.get('used_by', 'مستخدم')}")
-        
-        # شحن الرصيد
-        amount = key_data['amount']
-        add_balance(user_id, amount)
-        
-        # تحديث حالة المفتاح في الذاكرة
-        charge_keys[key_code]['used'] = True
-        charge_keys[key_code]['used_by'] = user_name
-        charge_keys[key_code]['used_at'] = time.time()
+                              f"👤 استخدمه: {result.used_by or 'مستخدم'}")
         
-        # تحديث في Firebase
-        try:
-            db.collection('charge_keys').document(key_code).update({
-                'used': True,
-                'used_by': user_name,
-                'used_at': time.time()
-            })
-        except Exception as e:
-            print(f"⚠️ خطأ في تحديث المفتاح في Firebase: {e}")
+        amount = result.amount
+        users_wallets[user_id] = result.balance
+        mark_charge_key_used(key_code, user_name)
         
         # إرسال رسالة نجاح
         bot.reply_to(message,
                     f"✅ **تم شحن رصيدك بنجاح!**\n\n"
                     f"💰 المبلغ المضاف: {amount} ريال\n"
-                    f"💵 رصيدك الحالي: {get_balance(user_id)} ريال\n\n"
+                    f"💵 رصيدك الحالي: {result.balance} ريال\n\n"
                     f"🎉 استمتع بالتسوق!",
                     parse_mode="Markdown")
         
@@ -3673,13 +6167,14 @@ def charge_with_key(message):
         bot.reply_to(message, f"❌ حدث خطأ: {str(e)}")
 
 # أمر عرض المفاتيح النشطة (للمالك فقط)
-@bot.message_handler(commands=['المفاتيح'])
+@router.command('المفاتيح')
+@timed_handler
 def list_keys(message):
     if message.from_user.id != ADMIN_ID:
         return bot.reply_to(message, "⛔ هذا الأمر للمالك فقط!")
     
-    active_keys = [k for k, v in charge_keys.items() if not v['used']]
-    used_keys = [k for k, v in charge_keys.items() if v['used']]
+    active_keys = [k for k, v in charge_keys.items() if not v.used]
+    used_keys = [k for k, v in charge_keys.items() if v.used]
     
     if not charge_keys:
         return bot.reply_to(message, "📭 لا توجد مفاتيح محفوظة!")
@@ -3690,12 +6185,13 @@ def list_keys(message):
     response += f"📈 الإجمالي: {len(charge_keys)}\n\n"
     
     if active_keys:
-        total_value = sum([charge_keys[k]['amount'] for k in active_keys])
+        total_value = sum([charge_keys[k].amount for k in active_keys])
         response += f"💰 القيمة الإجمالية للمفاتيح النشطة: {total_value} ريال"
     
     bot.reply_to(message, response, parse_mode="Markdown")
 
-@bot.message_handler(commands=['web'])
+@router.command('web')
+@timed_handler
 def open_web_app(message):
     bot.send_message(message.chat.id, 
                      f"🏪 **مرحباً بك في السوق!**\n\n"
@@ -3706,7 +6202,8 @@ def open_web_app(message):
                      parse_mode="Markdown")
 
 # زر استلام الطلب من قبل المشرف
-@bot.callback_query_handler(func=lambda call: call.data.startswith('claim_'))
+@router.callback('claim_')
+@timed_handler
 def claim_order(call):
     order_id = call.data.replace('claim_', '')
     admin_id = call.from_user.id
@@ -3723,29 +6220,29 @@ def claim_order(call):
     order = active_orders[order_id]
     
     # التحقق من أن الطلب لم يتم استلامه مسبقاً
-    if order['status'] == 'claimed':
+    if order.status == 'claimed':
         return bot.answer_callback_query(call.id, "⚠️ تم استلام هذا الطلب مسبقاً!", show_alert=True)
     
     # تحديث حالة الطلب في الذاكرة
-    order['status'] = 'claimed'
-    order['admin_id'] = admin_id
+    order.status = 'claimed'
+    order.admin_id = admin_id
     
     # تحديث في Firebase
     try:
-        db.collection('orders').document(order_id).update({
+        orders_repo.update(order_id, {
             'status': 'claimed',
             'admin_id': str(admin_id),
             'claimed_at': firestore.SERVER_TIMESTAMP
         })
     except Exception as e:
-        print(f"⚠️ خطأ في تحديث الطلب في Firebase: {e}")
+        log.warning("خطأ في تحديث الطلب في Firebase", order_id=order_id, error=str(e))
     
     # تحديث رسالة المشرف الذي استلم
     try:
         bot.edit_message_text(
             f"✅ تم استلام الطلب #{order_id}\n\n"
-            f"📦 المنتج: {order['item_name']}\n"
-            f"💰 السعر: {order['price']} ريال\n\n"
+            f"📦 المنتج: {order.item_name}\n"
+            f"💰 السعر: {order.price} ريال\n\n"
             f"👨‍💼 أنت المسؤول عن هذا الطلب\n"
             f"⏰ الحالة: قيد التنفيذ...\n\n"
             f"🔒 سيتم إرسال البيانات السرية لك الآن...",
@@ -3755,17 +6252,26 @@ def claim_order(call):
     except:
         pass
     
-    # حذف الرسالة من المشرفين الآخرين
-    if 'admin_messages' in order:
-        for other_admin_id, msg_id in order['admin_messages'].items():
-            if other_admin_id != admin_id:
-                try:
-                    bot.delete_message(other_admin_id, msg_id)
-                except:
-                    pass
+    # حذف الرسالة من المشرفين الآخرين (بالتوازي)
+    # مفاتيح admin_messages نصية (مفاتيح الخرائط في Firestore لا تكون أرقاماً)
+    if order.admin_messages:
+        admin_key = str(admin_id)
+        admin_messages = {str(other_id): message_id for other_id, message_id in order.admin_messages.items()}
+        fan_out_admins(
+            'delete_message',
+            lambda other_admin_id: ((other_admin_id, admin_messages[other_admin_id]), {}),
+            admin_ids=[other_id for other_id in admin_messages if other_id != admin_key]
+        )
+        order.admin_messages = {admin_key: admin_messages[admin_key]} if admin_key in admin_messages else {}
     
     # إرسال البيانات المخفية للمشرف على الخاص
-    hidden_info = order['hidden_data'] if order['hidden_data'] else "لا توجد بيانات مخفية لهذا المنتج."
+    hidden_data = order.hidden_data
+    if not hidden_data:
+        try:
+            hidden_data = orders_repo.hidden_data(order_id)
+        except Exception as e:
+            log.warning("خطأ في جلب بيانات الطلب المخفية", order_id=order_id, error=str(e))
+    hidden_info = hidden_data if hidden_data else "لا توجد بيانات مخفية لهذا المنتج."
     
     # إنشاء زر لتأكيد إتمام الطلب
     markup = types.InlineKeyboardMarkup()
@@ -3775,12 +6281,12 @@ def claim_order(call):
     bot.send_message(
         admin_id,
         f"🔐 بيانات الطلب السرية #{order_id}\n\n"
-        f"📦 المنتج: {order['item_name']}\n\n"
+        f"📦 المنتج: {order.item_name}\n\n"
         f"👤 معلومات العميل:\n"
-        f"• الاسم: {order['buyer_name']}\n"
-        f"• آيدي تيليجرام: {order['buyer_id']}\n"
-        f"• آيدي اللعبة: {order['game_id']}\n"
-        f"• الاسم في اللعبة: {order['game_name']}\n\n"
+        f"• الاسم: {order.buyer_name}\n"
+        f"• آيدي تيليجرام: {order.buyer_id}\n"
+        f"• آيدي اللعبة: {order.game_id}\n"
+        f"• الاسم في اللعبة: {order.game_name}\n\n"
         f"🔒 البيانات المحمية:\n"
         f"{hidden_info}\n\n"
         f"⚡ قم بتنفيذ الطلب ثم اضغط الزر أدناه!",
@@ -3790,7 +6296,8 @@ def claim_order(call):
     bot.answer_callback_query(call.id, "✅ تم استلام الطلب! تحقق من رسائلك الخاصة.")
 
 # زر إتمام الطلب من قبل المشرف
-@bot.callback_query_handler(func=lambda call: call.data.startswith('complete_'))
+@router.callback('complete_')
+@timed_handler
 def complete_order(call):
     order_id = call.data.replace('complete_', '')
     admin_id = call.from_user.id
@@ -3801,18 +6308,18 @@ def complete_order(call):
     order = active_orders[order_id]
     
     # التحقق من أن المشرف هو نفسه من استلم الطلب
-    if order['admin_id'] != admin_id:
+    if order.admin_id != admin_id:
         return bot.answer_callback_query(call.id, "⛔ لم تستلم هذا الطلب!", show_alert=True)
     
     # تحويل المال للبائع
-    add_balance(order['seller_id'], order['price'])
+    add_balance(order.seller_id, order.price, 'order_sale', order_id)
     
     # إشعار البائع
     bot.send_message(
-        order['seller_id'],
+        order.seller_id,
         f"💰 تم بيع منتجك!\n\n"
-        f"📦 المنتج: {order['item_name']}\n"
-        f"💵 المبلغ: {order['price']} ريال\n\n"
+        f"📦 المنتج: {order.item_name}\n"
+        f"💵 المبلغ: {order.price} ريال\n\n"
         f"✅ تم إضافة المبلغ لرصيدك!"
     )
     
@@ -3822,16 +6329,16 @@ def complete_order(call):
     markup.add(confirm_btn)
     
     bot.send_message(
-        order['buyer_id'],
+        order.buyer_id,
         f"🎉 تم تنفيذ طلبك!\n\n"
-        f"📦 المنتج: {order['item_name']}\n\n"
+        f"📦 المنتج: {order.item_name}\n\n"
         f"✅ يرجى التحقق من حسابك والتأكد من استلام الخدمة\n\n"
         f"⚠️ إذا استلمت الخدمة بنجاح، اضغط الزر أدناه لتأكيد الاستلام.",
         reply_markup=markup
     )
     
     # تحديث حالة الطلب
-    order['status'] = 'completed'
+    order.status = 'completed'
     
     # حذف رسالة البيانات السرية من خاص المشرف
     try:
@@ -3846,7 +6353,8 @@ def complete_order(call):
     bot.answer_callback_query(call.id, "✅ تم إتمام الطلب بنجاح!")
 
 # زر تأكيد الاستلام من العميل
-@bot.callback_query_handler(func=lambda call: call.data.startswith('buyer_confirm_'))
+@router.callback('buyer_confirm_')
+@timed_handler
 def buyer_confirm(call):
     order_id = call.data.replace('buyer_confirm_', '')
     
@@ -3856,7 +6364,7 @@ def buyer_confirm(call):
     order = active_orders[order_id]
     
     # التحقق من أن المستخدم هو المشتري
-    if str(call.from_user.id) != order['buyer_id']:
+    if str(call.from_user.id) != order.buyer_id:
         return bot.answer_callback_query(call.id, "⛔ هذا ليس طلبك!", show_alert=True)
     
     # حذف الطلب من القائمة النشطة
@@ -3864,12 +6372,12 @@ def buyer_confirm(call):
     
     # تحديث في Firebase
     try:
-        db.collection('orders').document(order_id).update({
+        orders_repo.update(order_id, {
             'status': 'confirmed',
             'confirmed_at': firestore.SERVER_TIMESTAMP
         })
     except Exception as e:
-        print(f"⚠️ خطأ في تحديث الطلب في Firebase: {e}")
+        log.warning("خطأ في تحديث الطلب في Firebase", order_id=order_id, error=str(e))
     
     bot.edit_message_text(
         f"✅ شكراً لتأكيدك!\n\n"
@@ -3882,7 +6390,8 @@ def buyer_confirm(call):
     bot.answer_callback_query(call.id, "✅ شكراً لك!")
 
 # زر تأكيد الاستلام (يحرر المال للبائع) - الكود القديم للتوافق
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_'))
+@router.callback('confirm_')
+@timed_handler
 def confirm_transaction(call):
     trans_id = call.data.split('_')[1]
     
@@ -3900,7 +6409,7 @@ def confirm_transaction(call):
     amount = trans['amount']
     
     # إضافة الرصيد للبائع
-    add_balance(seller_id, amount)
+    add_balance(seller_id, amount, 'transaction', trans_id)
     
     # حذف العملية من الانتظار
     del transactions[trans_id]
@@ -3910,6 +6419,34 @@ def confirm_transaction(call):
 
 # --- مسارات الموقع (Flask) ---
 
+# قياس زمن كل طلب حسب المسار (القالب وليس الرابط الفعلي لتجنب تضخم عدد السلاسل)
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_span = tracer.start_span(f"{request.method} {route}", SPAN_KIND_SERVER, root=True, **{
+        'http.method': request.method,
+        'http.route': route,
+        'http.target': request.full_path.rstrip('?'),
+    })
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_latency.observe((route, request.method, str(response.status_code)), time.perf_counter() - started)
+    span = g.get('request_span', (None, None))[0]
+    if span is not None:
+        span.set_attribute('http.status_code', response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_span(error=None):
+    request_span = g.pop('request_span', None)
+    if request_span is not None:
+        tracer.end_span(*request_span, error=error)
+
 # مسار تسجيل الخروج
 @app.route('/logout', methods=['POST'])
 def logout():
@@ -3927,23 +6464,23 @@ def get_user_orders():
     # جلب جميع الطلبات الخاصة بالمستخدم
     user_orders = []
     for order_id, order in active_orders.items():
-        if str(order['buyer_id']) == user_id:
+        if order.buyer_id == user_id:
             # إضافة اسم المشرف إذا تم استلام الطلب
             admin_name = None
-            if order.get('admin_id'):
+            if order.admin_id:
                 try:
-                    admin_info = bot.get_chat(order['admin_id'])
+                    admin_info = bot.get_chat(order.admin_id)
                     admin_name = admin_info.first_name
                 except:
                     admin_name = "مشرف"
             
             user_orders.append({
                 'order_id': order_id,
-                'item_name': order['item_name'],
-                'price': order['price'],
-                'game_id': order.get('game_id', ''),
-                'game_name': order.get('game_name', ''),
-                'status': order['status'],
+                'item_name': order.item_name,
+                'price': order.price,
+                'game_id': order.game_id,
+                'game_name': order.game_name,
+                'status': order.status,
                 'admin_name': admin_name
             })
     
@@ -3954,6 +6491,7 @@ def get_user_orders():
 
 # مسار التحقق من الكود وتسجيل الدخول
 @app.route('/verify', methods=['POST'])
+@rate_limiter.limit(*VERIFY_LIMITS)
 def verify_login():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -3970,10 +6508,10 @@ def verify_login():
     
     # تسجيل دخول المستخدم
     session['user_id'] = user_id
-    session['user_name'] = code_data['name']
+    session['user_name'] = code_data.name
 
     # حذف الكود بعد الاستخدام
-    del verification_codes[str(user_id)]
+    verification_codes.pop(str(user_id))
 
     # جلب الرصيد
     balance = get_balance(user_id)
@@ -3988,16 +6526,28 @@ def verify_login():
             token = bot.token
             profile_photo_url = f"https://api.telegram.org/file/bot{token}/{file_info.file_path}"
     except Exception as e:
-        print(f"⚠️ خطأ في جلب صورة الحساب: {e}")
+        log.warning("خطأ في جلب صورة الحساب", user_id=user_id, error=str(e))
 
     return {
         'success': True,
         'message': 'تم تسجيل الدخول بنجاح',
-        'user_name': code_data['name'],
+        'user_name': code_data.name,
         'balance': balance,
         'profile_photo_url': profile_photo_url
     }
 
+# --- صفحة المتجر ---
+# بيانات المنتجات ترسل مرة واحدة بصيغة أعمدة (catalog) ويرسم منها المتصفح،
+# والخادم يرسم فقط البطاقات الأولى من القسم الافتراضي حتى تظهر الصفحة قبل تنفيذ JavaScript
+
+STOREFRONT_ABOVE_FOLD = int(os.environ.get("STOREFRONT_ABOVE_FOLD", 8))
+STOREFRONT_INITIAL_CATEGORY = 'نتفلكس'
+CATALOG_COLUMNS = ('id', 'item_name', 'price', 'seller_id', 'seller_name', 'category', 'details', 'image_url')
+
+def catalog_payload(items):
+    """الكتالوج كأعمدة وصفوف بدلاً من قائمة قواميس (أسماء الحقول لا تتكرر مع كل منتج)"""
+    return {'cols': CATALOG_COLUMNS, 'rows': [[item.get(col) for col in CATALOG_COLUMNS] for item in items]}
+
 @app.route('/')
 def index():
     # التحقق من جلسة المستخدم
@@ -4014,56 +6564,52 @@ def index():
     # 2. جلب المنتجات (مباشرة من Firebase لضمان ظهورها)
     items = []
     try:
-        # جلب المنتجات التي لم تُبع (sold == False)
-        docs = query_where(db.collection('products'), 'sold', '==', False).stream()
-        
-        for doc in docs:
-            p = doc.to_dict()
-            p['id'] = doc.id  # مهم جداً لعملية الشراء
+        # جلب المنتجات التي لم تُبع (sold == False) بحقول العرض فقط
+        for product_id, p in products_repo.listing(False):
+            p['id'] = product_id  # مهم جداً لعملية الشراء
             items.append(p)
         
-        print(f"✅ تم جلب {len(items)} منتج من Firebase للمتجر")
+        log.debug("تم جلب منتجات المتجر", count=len(items))
             
     except Exception as e:
-        print(f"❌ خطأ في جلب المنتجات للمتجر: {e}")
+        log.error("خطأ في جلب المنتجات للمتجر", error=str(e))
         # في حال الفشل، نعود لاستخدام الذاكرة كاحتياط
-        items = [i for i in marketplace_items if not i.get('sold')]
+        items = [item.listing() for item in marketplace_items.available()]
 
     # 3. جلب المنتجات المباعة (لعرضها في قسم منفصل)
     sold_items = []
     try:
-        sold_docs = query_where(db.collection('products'), 'sold', '==', True).stream()
-        for doc in sold_docs:
-            p = doc.to_dict()
-            p['id'] = doc.id
+        for product_id, p in products_repo.listing(True):
+            p['id'] = product_id
             sold_items.append(p)
-        print(f"✅ تم جلب {len(sold_items)} منتج مباع من Firebase")
+        log.debug("تم جلب المنتجات المباعة", count=len(sold_items))
     except Exception as e:
-        print(f"❌ خطأ في جلب المنتجات المباعة: {e}")
-        sold_items = [i for i in marketplace_items if i.get('sold')]
+        log.error("خطأ في جلب المنتجات المباعة", error=str(e))
+        sold_items = [item.listing(SOLD_LISTING_FIELDS) for item in marketplace_items.sold()]
 
     # 4. جلب مشتريات المستخدم الحالي
     my_purchases = []
     if user_id:
         try:
-            purchases_docs = query_where(db.collection('orders'), 'buyer_id', '==', str(user_id)).stream()
-            for doc in purchases_docs:
-                p = doc.to_dict()
-                p['order_id'] = doc.id
+            for order_id, p in orders_repo.by_buyer(user_id):
+                p['order_id'] = order_id
                 my_purchases.append(p)
-            print(f"✅ تم جلب {len(my_purchases)} مشتريات للمستخدم {user_id}")
+            log.debug("تم جلب مشتريات المستخدم", user_id=user_id, count=len(my_purchases))
         except Exception as e:
-            print(f"❌ خطأ في جلب مشتريات المستخدم: {e}")
+            log.error("خطأ في جلب مشتريات المستخدم", user_id=user_id, error=str(e))
 
     # عرض الصفحة
-    return render_template_string(HTML_PAGE, 
-                                  items=items,
-                                  sold_items=sold_items,
-                                  my_purchases=my_purchases,
-                                  balance=balance, 
-                                  current_user_id=user_id or 0, 
-                                  user_name=user_name,
-                                  profile_photo=profile_photo)
+    first_cards = [item for item in items if item.get('category') == STOREFRONT_INITIAL_CATEGORY][:STOREFRONT_ABOVE_FOLD]
+    return render_page(HTML_PAGE,
+                       catalog=catalog_payload(items),
+                       first_cards=first_cards,
+                       initial_category=STOREFRONT_INITIAL_CATEGORY,
+                       sold_items=sold_items,
+                       my_purchases=my_purchases,
+                       balance=balance,
+                       current_user_id=user_id or 0,
+                       user_name=user_name,
+                       profile_photo=profile_photo)
 
 # صفحة مشترياتي المنفصلة
 MY_PURCHASES_PAGE = """
@@ -4415,10 +6961,8 @@ def my_purchases_page():
     # جلب مشتريات المستخدم من Firebase
     purchases = []
     try:
-        orders_ref = query_where(db.collection('orders'), 'buyer_id', '==', str(user_id))
-        for doc in orders_ref.stream():
-            data = doc.to_dict()
-            data['id'] = doc.id
+        for order_id, data in orders_repo.by_buyer(user_id):
+            data['id'] = order_id
             # تحويل الوقت إذا وجد
             if data.get('created_at'):
                 try:
@@ -4429,9 +6973,9 @@ def my_purchases_page():
         # ترتيب من الأحدث للأقدم
         purchases.reverse()
     except Exception as e:
-        print(f"❌ خطأ في جلب المشتريات: {e}")
+        log.error("خطأ في جلب المشتريات", user_id=user_id, error=str(e))
     
-    return render_template_string(MY_PURCHASES_PAGE, purchases=purchases)
+    return render_page(MY_PURCHASES_PAGE, purchases=purchases)
 
 @app.route('/get_balance')
 def get_balance_api():
@@ -4445,6 +6989,7 @@ def get_balance_api():
     return {'balance': balance}
 
 @app.route('/charge_balance', methods=['POST'])
+@rate_limiter.limit(*CHARGE_LIMITS)
 def charge_balance_api():
     """شحن الرصيد باستخدام كود الشحن"""
     data = request.json
@@ -4454,48 +6999,22 @@ def charge_balance_api():
     if not user_id or not key_code:
         return jsonify({'success': False, 'message': 'بيانات غير مكتملة'})
     
-    # التحقق من وجود الكود
-    if key_code not in charge_keys:
-        return jsonify({'success': False, 'message': 'كود الشحن غير صحيح أو غير موجود'})
-    
-    key_data = charge_keys[key_code]
+    # استخدام الكود وشحن الرصيد في معاملة واحدة (لا يمكن استخدامه مرتين حتى من عاملين مختلفين)
+    try:
+        result = key_redemption.redeem(key_code, user_id, used_by=user_id)
+    except Exception as e:
+        log.error("خطأ في استخدام كود الشحن", user_id=user_id, error=str(e))
+        return jsonify({'success': False, 'message': 'حدث خطأ أثناء الشحن، حاول مرة أخرى'})
     
-    # التحقق من أن الكود لم يستخدم
-    if key_data.get('used', False):
+    if result.status == 'unknown':
+        return jsonify({'success': False, 'message': 'كود الشحن غير صحيح أو غير موجود'})
+    if result.status == 'used':
         return jsonify({'success': False, 'message': 'هذا الكود تم استخدامه مسبقاً'})
     
-    # شحن الرصيد
-    amount = key_data['amount']
-    current_balance = get_balance(user_id)
-    new_balance = current_balance + amount
-    
-    # تحديث الرصيد في الذاكرة
+    amount = result.amount
+    new_balance = result.balance
     users_wallets[user_id] = new_balance
-    
-    # تحديث الكود كمستخدم
-    charge_keys[key_code]['used'] = True
-    charge_keys[key_code]['used_by'] = user_id
-    charge_keys[key_code]['used_at'] = time.time()
-    
-    # تحديث في Firebase
-    if db:
-        try:
-            # تحديث رصيد المستخدم
-            user_ref = db.collection('users').document(user_id)
-            user_doc = user_ref.get()
-            if user_doc.exists:
-                user_ref.update({'balance': new_balance})
-            else:
-                user_ref.set({'user_id': user_id, 'balance': new_balance})
-            
-            # تحديث حالة الكود
-            db.collection('charge_keys').document(key_code).update({
-                'used': True,
-                'used_by': user_id,
-                'used_at': time.time()
-            })
-        except Exception as e:
-            print(f"خطأ في تحديث Firebase: {e}")
+    mark_charge_key_used(key_code, user_id)
     
     return jsonify({
         'success': True, 
@@ -4513,20 +7032,21 @@ def sell_item():
         return {'status': 'error', 'message': 'غير مصرح لك بإضافة منتجات! فقط المالك يمكنه ذلك.'}
     
     # حفظ البيانات المخفية بشكل آمن
-    item = {
-        'id': str(uuid.uuid4()),  # رقم فريد لا يتكرر
-        'item_name': data.get('item_name'),
-        'price': data.get('price'),
-        'seller_id': seller_id,
-        'seller_name': data.get('seller_name'),
-        'hidden_data': data.get('hidden_data', ''),  # البيانات المخفية
-        'category': data.get('category', ''),  # الفئة
-        'image_url': data.get('image_url', '')  # رابط الصورة
-    }
-    marketplace_items.append(item)
+    item = Product(
+        id=str(uuid.uuid4()),  # رقم فريد لا يتكرر
+        item_name=data.get('item_name'),
+        price=data.get('price'),
+        seller_id=seller_id,
+        seller_name=data.get('seller_name'),
+        hidden_data=data.get('hidden_data', ''),  # البيانات المخفية
+        category=data.get('category', ''),  # الفئة
+        image_url=data.get('image_url', '')  # رابط الصورة
+    )
+    marketplace_items.add(item)
     return {'status': 'success'}
 
 @app.route('/buy', methods=['POST'])
+@rate_limiter.limit(*BUY_LIMITS)
 def buy_item():
     try:
         data = request.json
@@ -4534,94 +7054,94 @@ def buy_item():
         buyer_name = data.get('buyer_name')
         item_id = str(data.get('item_id'))  # تأكد أنه نص
 
-        print(f"🛒 محاولة شراء - item_id: {item_id}, buyer_id: {buyer_id}")
-
-        # 1. البحث عن المنتج في Firebase مباشرة
-        doc_ref = db.collection('products').document(item_id)
-        doc = doc_ref.get()
-
-        if not doc.exists:
-            print(f"❌ المنتج {item_id} غير موجود في Firebase")
-            # محاولة البحث في الذاكرة كاحتياط
-            item = None
-            for prod in marketplace_items:
-                if prod.get('id') == item_id:
-                    item = prod
-                    print(f"✅ تم إيجاد المنتج في الذاكرة: {item.get('item_name')}")
-                    break
-            
-            if not item:
-                return {'status': 'error', 'message': 'المنتج غير موجود أو تم حذفه!'}
-        else:
-            item = doc.to_dict()
-            item['id'] = doc.id
-            print(f"✅ تم إيجاد المنتج في Firebase: {item.get('item_name')}")
-
-        # 2. التحقق من أن المنتج لم يُباع
-        if item.get('sold', False):
-            return {'status': 'error', 'message': 'عذراً، هذا المنتج تم بيعه للتو! 🚫'}
-
-        price = float(item.get('price', 0))
-
-        # 3. التحقق من رصيد المشتري (من Firebase مباشرة)
-        user_ref = db.collection('users').document(buyer_id)
-        user_doc = user_ref.get()
-        current_balance = user_doc.to_dict().get('balance', 0.0) if user_doc.exists else 0.0
-
-        if current_balance < price:
-            return {'status': 'error', 'message': 'رصيدك غير كافي للشراء!'}
-
-        # 4. تنفيذ العملية (خصم + تحديث حالة المنتج)
-        # نستخدم batch لضمان تنفيذ كل الخطوات معاً أو فشلها معاً
-        batch = db.batch()
+        log.info("محاولة شراء", item_id=item_id, buyer_id=buyer_id)
+
+        # القراءة والخصم تحت قفل المشتري (وقفل المنتج حتى لا يباع مرتين داخل نفس العامل)
+        with balance_locks.hold(buyer_id, f"product:{item_id}"):
+            # 1. جلب المنتج وبياناته المخفية ورصيد المشتري من Firebase في رحلة واحدة
+            product_data, secret_data, user_data = store.get_many([
+                products_repo.key(item_id), products_repo.secret_key(item_id), users_repo.key(buyer_id)
+            ])
+
+            if product_data is None:
+                log.warning("المنتج غير موجود في Firebase", item_id=item_id)
+                # محاولة البحث في الذاكرة كاحتياط
+                item = marketplace_items.get(item_id)
+                if not item:
+                    return {'status': 'error', 'message': 'المنتج غير موجود أو تم حذفه!'}
+                log.info("تم إيجاد المنتج في الذاكرة", item_id=item_id)
+            else:
+                item = Product.from_dict(item_id, product_data)
+                item.hidden_data = products_repo.hidden_data(secret_data, product_data)
+                log.debug("تم إيجاد المنتج في Firebase", item_id=item_id)
 
-        # خصم الرصيد
-        new_balance = current_balance - price
-        batch.update(user_ref, {'balance': new_balance})
+            # 2. التحقق من أن المنتج لم يُباع
+            if item.sold:
+                return {'status': 'error', 'message': 'عذراً، هذا المنتج تم بيعه للتو! 🚫'}
 
-        # تحديث المنتج كمباع (تأكد من استخدام document reference الصحيح)
-        product_doc_ref = db.collection('products').document(item_id)
-        batch.set(product_doc_ref, {
-            'sold': True,
-            'buyer_id': buyer_id,
-            'buyer_name': buyer_name,
-            'sold_at': firestore.SERVER_TIMESTAMP
-        }, merge=True)
+            price = item.price
 
-        # حفظ الطلب
-        order_id = f"ORD_{random.randint(100000, 999999)}"
-        order_ref = db.collection('orders').document(order_id)
-        batch.set(order_ref, {
-            'buyer_id': buyer_id,
-            'buyer_name': buyer_name,
-            'item_name': item.get('item_name'),
-            'price': price,
-            'hidden_data': item.get('hidden_data'),
-            'seller_id': item.get('seller_id'),
-            'status': 'completed',
-            'created_at': firestore.SERVER_TIMESTAMP
-        })
+            # 3. التحقق من رصيد المشتري (تم جلبه مع المنتج، والمحفظة الموزعة تقرأ شرائحها مباشرة لا من الذاكرة المؤقتة)
+            sharded = users_repo.is_sharded(buyer_id)
+            if sharded:
+                current_balance = users_repo.sharded_balance(buyer_id, fresh=True)
+            else:
+                current_balance = users_repo.balance_from(buyer_id, user_data)
+
+            if current_balance < price:
+                return {'status': 'error', 'message': 'رصيدك غير كافي للشراء!'}
+
+            # 4. تنفيذ العملية (خصم + تحديث حالة المنتج)
+            # نستخدم batch لضمان تنفيذ كل الخطوات معاً أو فشلها معاً
+            batch = store.batch()
+
+            # خصم الرصيد مع حركة في السجل
+            order_id = f"ORD_{random.randint(100000, 999999)}"
+            new_balance = current_balance - price
+            if not users_repo.ledger_opened(user_data):
+                open_ledger(buyer_id, current_balance, batch)
+            if sharded:
+                # خصم من شريحة بدلاً من كتابة رصيد محسوب قد يمحو إضافة وصلت للتو
+                users_repo.increment_balance(buyer_id, -price, batch=batch)
+            else:
+                users_repo.set_balance(buyer_id, new_balance, batch=batch)
+            ledger_repo.record(buyer_id, -price, 'purchase', order_id, batch=batch)
+
+            # تحديث المنتج كمباع
+            products_repo.mark_sold(item_id, buyer_id, buyer_name, batch=batch)
+
+            # حفظ الطلب
+            orders_repo.set(order_id, {
+                'buyer_id': buyer_id,
+                'buyer_name': buyer_name,
+                'item_name': item.item_name,
+                'price': price,
+                'hidden_data': item.hidden_data,
+                'seller_id': item.seller_id,
+                'status': 'completed',
+                'created_at': firestore.SERVER_TIMESTAMP
+            }, batch=batch)
 
-        # تنفيذ التغييرات
-        batch.commit()
+            # تنفيذ التغييرات
+            batch.commit()
+            ledger_compactor.touch(buyer_id)
+            if sharded:
+                new_balance = users_repo.get_balance(buyer_id)
 
-        # 5. تحديث الذاكرة المحلية (اختياري لكن جيد للسرعة)
-        users_wallets[buyer_id] = new_balance
-        # البحث عن المنتج في القائمة المحلية وتحديثه
-        for prod in marketplace_items:
-            if prod.get('id') == item_id:
-                prod['sold'] = True
-                break
+            # 5. تحديث الذاكرة المحلية (اختياري لكن جيد للسرعة)
+            users_wallets[buyer_id] = new_balance
+            # نقل المنتج إلى المباع في الكتالوج المحلي
+            marketplace_items.mark_sold(item_id)
 
         # 6. إرسال المنتج للمشتري
-        hidden_info = item.get('hidden_data', 'لا توجد بيانات')
+        hidden_info = item.hidden_data or 'لا توجد بيانات'
         message_sent = False
         
         try:
             bot.send_message(
                 int(buyer_id),
                 f"✅ **تم الشراء بنجاح!**\n\n"
-                f"📦 المنتج: {item.get('item_name')}\n"
+                f"📦 المنتج: {item.item_name}\n"
                 f"💰 السعر: {price} ريال\n"
                 f"🆔 رقم الطلب: #{order_id}\n\n"
                 f"🔐 **بيانات الاشتراك:**\n`{hidden_info}`\n\n"
@@ -4629,25 +7149,25 @@ def buy_item():
                 parse_mode="Markdown"
             )
             message_sent = True
-            print(f"✅ تم إرسال بيانات المنتج للمشتري {buyer_id}")
+            log.info("تم إرسال بيانات المنتج للمشتري", buyer_id=buyer_id)
             
             # إشعار للمالك
             bot.send_message(
                 ADMIN_ID,
                 f"🔔 **عملية بيع جديدة!**\n"
-                f"📦 المنتج: {item.get('item_name')}\n"
+                f"📦 المنتج: {item.item_name}\n"
                 f"👤 المشتري: {buyer_name} ({buyer_id})\n"
                 f"💰 السعر: {price} ريال\n"
                 f"✅ تم إرسال البيانات للمشتري"
             )
         except Exception as e:
-            print(f"⚠️ فشل إرسال الرسالة للمشتري {buyer_id}: {e}")
+            log.warning("فشل إرسال الرسالة للمشتري", buyer_id=buyer_id, error=str(e))
             # إشعار المالك بالفشل
             try:
                 bot.send_message(
                     ADMIN_ID,
                     f"⚠️ **تنبيه: فشل إرسال بيانات المنتج!**\n"
-                    f"📦 المنتج: {item.get('item_name')}\n"
+                    f"📦 المنتج: {item.item_name}\n"
                     f"👤 المشتري: {buyer_name} ({buyer_id})\n"
                     f"🔐 البيانات: `{hidden_info}`\n"
                     f"❌ السبب: المشتري لم يبدأ محادثة مع البوت",
@@ -4666,7 +7186,7 @@ def buy_item():
         }
 
     except Exception as e:
-        print(f"❌ Error in buy_item: {e}")
+        log.error("خطأ في عملية الشراء", exc=True)
         return {'status': 'error', 'message': 'حدث خطأ أثناء الشراء، حاول مرة أخرى.'}
 
 # لاستقبال تحديثات تيليجرام (Webhook)
@@ -4674,27 +7194,32 @@ def buy_item():
 def getMessage():
     try:
         json_string = request.get_data().decode('utf-8')
-        print(f"📩 استقبال رسالة: {json_string[:100]}...")
-        
         update = telebot.types.Update.de_json(json_string)
         
-        # التحقق من نوع التحديث
+        # التحقق من نوع التحديث (سجل بالعينة فقط لأنه يتكرر مع كل رسالة)
         if update.message:
-            print(f"✅ رسالة نصية من {update.message.from_user.first_name}")
+            kind = 'message'
         elif update.callback_query:
-            print(f"✅ استدعاء callback من {update.callback_query.from_user.first_name}")
+            kind = 'callback_query'
         else:
-            print(f"⚠️ تحديث غير معروف")
+            kind = 'other'
+        log.debug("استقبال تحديث", update_id=update.update_id, kind=kind, payload=json_string[:100], sample=True)
         
-        # معالجة التحديث
-        bot.process_new_updates([update])
-        print(f"✅ تم معالجة التحديث بنجاح")
+        # جدولة التحديث في الخلفية والرد على تيليجرام فوراً
+        try:
+            queued = webhook_dispatcher.submit(update)
+        except queue.Full:
+            log.warning("طابور التحديثات ممتلئ، سيعيد تيليجرام إرسال التحديث", update_id=update.update_id)
+            return "busy", 503
+        
+        if queued:
+            log.debug("تمت جدولة التحديث", update_id=update.update_id)
+        else:
+            log.info("تم تجاهل تحديث مكرر", update_id=update.update_id)
         return "ok", 200
         
     except Exception as e:
-        print(f"❌ خطأ في معالجة الرسالة: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("خطأ في معالجة الرسالة", exc=True)
         return "error", 200
 
 @app.route("/set_webhook")
@@ -4706,7 +7231,7 @@ def set_webhook():
         bot.set_webhook(url=webhook_url)
         return f"✅ Webhook set to {webhook_url}", 200
     except Exception as e:
-        print(f"❌ خطأ في تعيين webhook: {e}")
+        log.error("خطأ في تعيين webhook", error=str(e))
         return f"❌ Error: {str(e)}", 500
 
 @app.route("/test_bot")
@@ -4728,6 +7253,16 @@ def test_bot():
 def health():
     return {'status': 'ok'}, 200
 
+# مقاييس Prometheus: لجلسة المشرف، أو لمن يرسل METRICS_TOKEN (لـ Prometheus). بدون الاثنين 403
+@app.route('/metrics')
+def metrics_endpoint():
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    if not session.get('is_admin'):
+        provided = request.args.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not metrics_token or not hmac.compare_digest(provided.encode(), metrics_token.encode()):
+            return 'غير مصرح', 403
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 # مسار لرفع البيانات إلى Firebase (للمالك فقط)
 @app.route('/migrate_to_firebase')
 def migrate_to_firebase_route():
@@ -4747,7 +7282,6 @@ def migrate_to_firebase_route():
             'message': 'تم رفع البيانات بنجاح إلى Firebase',
             'data': {
                 'products': len(marketplace_items),
-                'users': len(users_wallets),
                 'orders': len(active_orders),
                 'keys': len(charge_keys)
             }
@@ -4823,6 +7357,195 @@ LOGIN_HTML = """
 </html>
 """
 
+# صفحة التتبع: أبطأ الطلبات الأخيرة مع توزيع الزمن على كل span
+TRACES_HTML = """
+<!DOCTYPE html>
+<html dir="rtl">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>التتبع</title>
+    <style>
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background: #1a1a2e; color: #eee; padding: 20px; }
+        h1 { color: #667eea; margin-bottom: 15px; }
+        form { margin-bottom: 20px; }
+        select, input, button { padding: 8px; border-radius: 6px; border: none; margin-left: 6px; }
+        .trace { background: #16213e; border-radius: 10px; padding: 15px; margin-bottom: 15px; }
+        .trace h2 { font-size: 16px; margin-bottom: 10px; }
+        .trace h2 span { color: #f39c12; }
+        .meta { color: #888; font-size: 12px; margin-bottom: 10px; direction: ltr; text-align: right; }
+        table { width: 100%; border-collapse: collapse; font-size: 13px; direction: ltr; }
+        td, th { padding: 4px 8px; text-align: left; border-bottom: 1px solid #0f3460; }
+        .bar-cell { width: 40%; }
+        .bar { position: relative; height: 12px; background: #0f3460; border-radius: 3px; }
+        .bar div { position: absolute; height: 12px; background: #667eea; border-radius: 3px; min-width: 2px; }
+        .bar div.client { background: #2ecc71; }
+        .error td { color: #e74c3c; }
+        .attrs { color: #888; font-size: 11px; }
+    </style>
+</head>
+<body>
+    <h1>🔍 أبطأ الطلبات الأخيرة</h1>
+    <form method="GET">
+        <select name="name">
+            <option value="">كل المسارات</option>
+            {% for option in names %}
+            <option value="{{ option }}" {% if option == name %}selected{% endif %}>{{ option }}</option>
+            {% endfor %}
+        </select>
+        <input type="number" name="limit" value="{{ limit }}" min="1" max="200">
+        <button type="submit">عرض</button>
+        <a href="?format=json&limit={{ limit }}&name={{ name or '' }}" style="color:#667eea">JSON (OTLP)</a>
+    </form>
+    {% for trace, rows in traces %}
+    <div class="trace">
+        <h2>{{ trace.root.name }} — <span>{{ '%.2f'|format(trace.duration_ms) }} ms</span></h2>
+        <div class="meta">trace {{ trace.trace_id }} · {{ trace.spans|length }} spans</div>
+        <table>
+            <tr><th>span</th><th>offset (ms)</th><th>duration (ms)</th><th class="bar-cell"></th></tr>
+            {% for row in rows %}
+            <tr class="{{ 'error' if row.span.error else '' }}">
+                <td style="padding-left: {{ 8 + row.depth * 16 }}px">{{ row.span.name }}
+                    <div class="attrs">{{ row.attributes }}{% if row.span.error %} · {{ row.span.error }}{% endif %}</div></td>
+                <td>{{ '%.2f'|format(row.offset) }}</td>
+                <td>{{ '%.2f'|format(row.span.duration_ms) }}</td>
+                <td class="bar-cell"><div class="bar"><div class="{{ 'client' if row.span.kind == 3 else '' }}"
+                    style="left: {{ row.left }}%; width: {{ row.width }}%"></div></div></td>
+            </tr>
+            {% endfor %}
+        </table>
+    </div>
+    {% else %}
+    <p>لا توجد طلبات مسجلة بعد.</p>
+    {% endfor %}
+</body>
+</html>
+"""
+
+def trace_rows(trace):
+    """ترتيب spans كشجرة (الأب ثم أبناؤه) مع الإزاحة والعرض النسبي لشريط الزمن"""
+    children = {}
+    for span in trace.spans:
+        children.setdefault(span.parent_id, []).append(span)
+    total = max(trace.duration_ms, 0.001)
+    rows = []
+
+    def walk(span, depth):
+        offset = (span.start_ns - trace.root.start_ns) / 1e6
+        rows.append({
+            'span': span,
+            'depth': depth,
+            'offset': offset,
+            'left': round(min(offset / total * 100, 100), 2),
+            'width': round(min(span.duration_ms / total * 100, 100 - min(offset / total * 100, 100)), 2),
+            'attributes': ', '.join(f"{key}={value}" for key, value in span.attributes.items()),
+        })
+        for child in sorted(children.get(span.span_id, []), key=lambda child: child.start_ns):
+            walk(child, depth + 1)
+
+    walk(trace.root, 0)
+    return rows
+
+# عرض التتبع (للمالك فقط)
+@app.route('/debug/traces')
+def debug_traces():
+    if not session.get('is_admin'):
+        return redirect('/dashboard')
+    
+    name = request.args.get('name') or None
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    traces = trace_store.slowest(limit, name)
+    
+    if request.args.get('format') == 'json':
+        return jsonify([trace.to_otel() for trace in traces])
+    
+    names = sorted({trace.root.name for trace in list(trace_store.traces)})
+    views = [(trace, trace_rows(trace)) for trace in traces]
+    return render_page(TRACES_HTML, traces=views, names=names, name=name, limit=limit)
+
+# أدوات التشخيص على العامل الحالي (للمالك فقط)
+@app.route('/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """GET: حالة الجلسة. POST: بدء جلسة ?seconds=30&interval_ms=10&idle=1"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح'}, 403
+    
+    if request.method == 'POST':
+        started = profiler.start(
+            request.args.get('seconds', 30, type=int),
+            request.args.get('interval_ms', PROFILER_INTERVAL_MS, type=float),
+            include_idle=request.args.get('idle') == '1'
+        )
+        if not started:
+            return {'status': 'error', 'message': 'يوجد profiler قيد التشغيل بالفعل', **profiler.status()}, 409
+    return {'status': 'success', **profiler.status()}
+
+@app.route('/debug/profile/stop', methods=['POST'])
+def debug_profile_stop():
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح'}, 403
+    profiler.stop()
+    return {'status': 'success', **profiler.status()}
+
+@app.route('/debug/profile/collapsed')
+def debug_profile_collapsed():
+    """ملف collapsed stacks لآخر جلسة (يُفتح في speedscope أو flamegraph.pl)"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح'}, 403
+    return profiler.collapsed(), 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Content-Disposition': f'attachment; filename="profile-{os.getpid()}.collapsed"',
+    }
+
+@app.route('/debug/memory', methods=['POST'])
+def debug_memory():
+    """?action=start|snapshot|stop — اللقطة الأولى بعد start أساس للمقارنة"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح'}, 403
+    
+    action = request.args.get('action', 'snapshot')
+    if action == 'start':
+        memory_snapshots.start(request.args.get('frames', 10, type=int))
+        return {'status': 'success', 'tracing': True, 'pid': os.getpid()}
+    if action == 'stop':
+        memory_snapshots.stop()
+        return {'status': 'success', 'tracing': False, 'pid': os.getpid()}
+    
+    group = request.args.get('group', 'lineno')
+    if group not in MemorySnapshots.GROUPS:
+        return {'status': 'error', 'message': f"group يجب أن يكون واحداً من: {', '.join(MemorySnapshots.GROUPS)}"}, 400
+    result = memory_snapshots.snapshot(request.args.get('top', 25, type=int), group)
+    if result is None:
+        return {'status': 'error', 'message': 'tracemalloc غير مفعل، استخدم action=start أولاً'}, 400
+    return {'status': 'success', **result}
+
+@app.route('/debug/ledger')
+def debug_ledger():
+    """?user_id= — مقارنة الرصيد المحفوظ بالرصيد المعاد بناؤه من السجل (&compact=1 يضم الحركات الآن)"""
+    if not session.get('is_admin'):
+        return {'status': 'error', 'message': 'غير مصرح'}, 403
+
+    user_id = request.args.get('user_id', '').strip()
+    if not user_id:
+        return {'status': 'error', 'message': 'user_id مطلوب'}, 400
+    if request.args.get('compact'):
+        ledger_repo.compact(user_id, datetime.datetime.now(datetime.timezone.utc))
+
+    snapshot = ledger_repo.snapshot(user_id)
+    entries = ledger_repo.entries(user_id, snapshot['as_of'])
+    ledger_balance = snapshot['balance'] + sum(entry['amount'] for _, entry in entries)
+    stored_balance = users_repo.get_balance(user_id)
+    return jsonify({
+        'status': 'success',
+        'user_id': user_id,
+        'stored_balance': stored_balance,
+        'ledger_balance': ledger_balance,
+        'difference': round(stored_balance - ledger_balance, 2),
+        'snapshot': snapshot,
+        'entries': [{'id': entry_id, **entry} for entry_id, entry in entries]
+    })
+
 # لوحة التحكم للمالك (محدثة بنظام Session آمن)
 @app.route('/dashboard', methods=['GET', 'POST'])
 def dashboard():
@@ -4835,51 +7558,46 @@ def dashboard():
             session['is_admin'] = True  # حفظ حالة الدخول في الجلسة
             return redirect('/dashboard')  # إعادة توجيه لرابط نظيف
         else:
-            return render_template_string(LOGIN_HTML, error="❌ كلمة مرور خاطئة!")
+            return render_page(LOGIN_HTML, error="❌ كلمة مرور خاطئة!")
     
     # 2. إذا كان المستخدم مسجل دخول مسبقاً (في الجلسة)
     if not session.get('is_admin'):
         # إذا لم يكن مسجل دخول -> عرض صفحة الدخول
-        return render_template_string(LOGIN_HTML, error="")
+        return render_page(LOGIN_HTML, error="")
     
     # 3. المستخدم مسجل دخول -> عرض لوحة التحكم
     
     # --- جلب الإحصائيات الحقيقية من Firebase ---
     try:
         # عدد المستخدمين
-        users_ref = db.collection('users')
-        total_users = len(list(users_ref.stream()))
+        all_users = users_repo.all()
+        total_users = len(all_users)
         
         # مجموع الأرصدة (يحتاج لعمل Loop)
         total_balance = 0
-        for user in users_ref.stream():
-            total_balance += user.to_dict().get('balance', 0)
+        for user_id, user_data in all_users:
+            total_balance += users_repo.balance_from(user_id, user_data)
 
         # المنتجات
-        products_ref = db.collection('products')
-        all_products = list(products_ref.stream())
+        all_products = products_repo.all(fields=('sold',))
         total_products = len(all_products)
         
         # حساب المباع والمتاح
         sold_products = 0
         available_products = 0
-        for p in all_products:
-            p_data = p.to_dict()
+        for _, p_data in all_products:
             if p_data.get('sold'):
                 sold_products += 1
             else:
                 available_products += 1
                 
         # الطلبات (Orders)
-        orders_ref = db.collection('orders')
         # نجلب آخر 10 طلبات فقط للعرض
-        recent_orders_docs = orders_ref.order_by('created_at', direction=firestore.Query.DESCENDING).limit(10).stream()
         recent_orders = []
-        for doc in recent_orders_docs:
-            data = doc.to_dict()
+        for order_id, data in orders_repo.recent(10):
             # تنسيق البيانات للعرض في الجدول
             recent_orders.append((
-                doc.id[:8], # رقم طلب قصير
+                order_id[:8], # رقم طلب قصير
                 {
                     'item_name': data.get('item_name', 'منتج'),
                     'price': data.get('price', 0),
@@ -4888,17 +7606,14 @@ def dashboard():
             ))
 
         # المفاتيح - جلبها من Firebase مباشرة
-        keys_ref = db.collection('charge_keys')
-        all_keys_docs = list(keys_ref.stream())
+        all_keys_docs = keys_repo.all()
         
         # تحضير قائمة المفاتيح للعرض
         charge_keys_display = {}
         active_keys = 0
         used_keys = 0
         
-        for k in all_keys_docs:
-            data = k.to_dict()
-            key_code = k.id
+        for key_code, data in all_keys_docs:
             is_used = data.get('used', False)
             
             if is_used:
@@ -4909,16 +7624,15 @@ def dashboard():
             charge_keys_display[key_code] = data
         
         # إجمالي الطلبات
-        total_orders = len(list(orders_ref.stream()))
+        total_orders = len(orders_repo.all())
         
         # جلب آخر 20 مستخدم للعرض في الجدول
         users_list = []
-        for user_doc in users_ref.limit(20).stream():
-            user_data = user_doc.to_dict()
-            users_list.append((user_doc.id, user_data.get('balance', 0)))
+        for user_id, user_data in all_users[:20]:
+            users_list.append((user_id, users_repo.balance_from(user_id, user_data)))
 
     except Exception as e:
-        print(f"Error loading stats from Firebase: {e}")
+        log.error("خطأ في جلب إحصائيات لوحة التحكم من Firebase", error=str(e))
         # قيم افتراضية عند الخطأ
         total_users = 0
         total_balance = 0
@@ -4928,9 +7642,9 @@ def dashboard():
         total_orders = 0
         recent_orders = []
         users_list = []
-        active_keys = len([k for k, v in charge_keys.items() if not v.get('used', False)])
-        used_keys = len([k for k, v in charge_keys.items() if v.get('used', False)])
-        charge_keys_display = charge_keys
+        active_keys = len([k for k, v in charge_keys.items() if not v.used])
+        used_keys = len([k for k, v in charge_keys.items() if v.used])
+        charge_keys_display = {key_code: key.to_dict() for key_code, key in charge_keys.items()}
     
     return f"""
     <!DOCTYPE html>
@@ -5307,7 +8021,8 @@ def dashboard():
                 fetch('/api/add_balance', {{
                     method: 'POST',
                     headers: {{'Content-Type': 'application/json'}},
-                    body: JSON.stringify({{user_id: userId, amount: parseFloat(amount)}})
+                    body: JSON.stringify({{user_id: userId, amount: parseFloat(amount),
+                                          request_id: 'web' + Date.now() + Math.random().toString(36).slice(2)}})
                 }})
                 .then(r => r.json())
                 .then(data => {{
@@ -5402,7 +8117,9 @@ def api_add_balance():
     if not user_id or amount <= 0:
         return {'status': 'error', 'message': 'بيانات غير صحيحة'}
     
-    add_balance(user_id, amount)
+    # request_id من لوحة التحكم لكل ضغطة: إعادة إرسال نفس الطلب لا تشحن مرتين
+    if not add_balance(user_id, amount, 'admin_credit', data.get('request_id')):
+        return {'status': 'error', 'message': 'لم يتم الشحن (طلب مكرر أو خطأ في الحفظ)'}
     
     # إشعار المستخدم
     try:
@@ -5445,12 +8162,12 @@ def api_add_product():
         }
         
         # 1. الحفظ في Firebase (المهم)
-        db.collection('products').document(new_id).set(item)
-        print(f"✅ تم حفظ المنتج {new_id} في Firestore: {name}")
+        products_repo.create(new_id, item)
+        log.info("تم حفظ المنتج في Firestore", product_id=new_id)
         
         # 2. تحديث الذاكرة المحلية (للعرض السريع)
-        marketplace_items.append(item)
-        print(f"✅ تم إضافة المنتج للذاكرة. إجمالي المنتجات: {len(marketplace_items)}")
+        marketplace_items.add(Product.from_dict(new_id, item))
+        log.debug("تم إضافة المنتج للذاكرة", total=len(marketplace_items))
         
         # 3. إشعار المالك (داخل try/except لضمان عدم توقف العملية)
         try:
@@ -5460,12 +8177,12 @@ def api_add_product():
                 parse_mode="Markdown"
             )
         except Exception as e:
-            print(f"فشل إرسال الإشعار: {e}")
+            log.warning("فشل إرسال الإشعار", error=str(e))
             
         return {'status': 'success', 'message': 'تم الحفظ في قاعدة البيانات'}
 
     except Exception as e:
-        print(f"Error in add_product: {e}")
+        log.error("خطأ في إضافة المنتج", exc=True)
         return {'status': 'error', 'message': f'حدث خطأ في السيرفر: {str(e)}'}
 
 # --- API لتوليد المفاتيح (مصحح للحفظ في Firebase) ---
@@ -5480,7 +8197,7 @@ def api_generate_keys():
             return {'status': 'error', 'message': 'أرقام غير صحيحة'}
         
         generated_keys = []
-        batch = db.batch() # استخدام الدفعات للحفظ السريع
+        batch = store.batch() # استخدام الدفعات للحفظ السريع
         
         for _ in range(count):
             # إنشاء كود عشوائي
@@ -5490,15 +8207,15 @@ def api_generate_keys():
                 'amount': amount,
                 'used': False,
                 'used_by': None,
-                'created_at': firestore.SERVER_TIMESTAMP
+                # بالثواني مثل /توليد و ChargeKey حتى تلتقطها مزامنة المرشح في العمال الأخرى
+                'created_at': time.time()
             }
             
             # تجهيز الحفظ في Firebase
-            doc_ref = db.collection('charge_keys').document(key_code)
-            batch.set(doc_ref, key_data)
+            keys_repo.set(key_code, key_data, batch=batch)
             
             # تحديث الذاكرة
-            charge_keys[key_code] = key_data
+            register_charge_key(key_code, amount)
             generated_keys.append(key_code)
             
         # تنفيذ الحفظ في Firebase دفعة واحدة
@@ -5507,7 +8224,7 @@ def api_generate_keys():
         return {'status': 'success', 'keys': generated_keys}
 
     except Exception as e:
-        print(f"Error generating keys: {e}")
+        log.error("خطأ في توليد المفاتيح", exc=True)
         return {'status': 'error', 'message': f'فشل التوليد: {str(e)}'}
 
 # مسار لتسجيل خروج الآدمن
@@ -5518,13 +8235,10 @@ def logout_admin():
 
 if __name__ == "__main__":
     # تحميل البيانات من Firebase عند بدء التشغيل
-    print("🚀 بدء تشغيل التطبيق...")
+    log.info("بدء تشغيل التطبيق")
     load_data_from_firebase()
     
-    # التأكد من أن جميع المنتجات لديها UUID
-    ensure_product_ids()
-    
     # هذا السطر يجعل البوت يعمل على المنفذ الصحيح في ريندر أو 10000 في جهازك
     port = int(os.environ.get("PORT", 10000))
-    print(f"✅ التطبيق يعمل على المنفذ {port}")
+    log.info("التطبيق يعمل", port=port)
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,822 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+قياس أداء المتجر ومسار الشراء
+
+الأوامر:
+    python benchmark.py micro   --iterations 300 --output micro.json
+    python benchmark.py load    --workers 2 --threads 8 --concurrency 32 --duration 30 --output load.json
+    python benchmark.py replay  --rate 200 --count 2000 --mix start=5,code=3,charge=2,claim=1,wizard=1
+    python benchmark.py compare old.json new.json --threshold 10
+    python benchmark.py logging --iterations 20000
+    python benchmark.py memory  --count 100000
+    python benchmark.py dispatch --handlers 10 100 1000
+
+- micro: قياس داخل نفس العملية عبر Flask test client (بدون شبكة)
+- load: تشغيل التطبيق تحت gunicorn وإرسال طلبات متزامنة من عدة خيوط
+- replay: توليد تحديثات تيليجرام واقعية وإرسالها لـ /webhook بمعدل ثابت مع قياس زمن كل معالج
+- compare: مقارنة نتيجتين وإرجاع خطأ إذا زاد p95 لأي مسار عن الحد المسموح
+- logging: مقارنة كلفة السجلات لكل طلب بين print المباشر والسجل المنظم عبر الطابور
+- memory: ذاكرة RSS لذاكرة المنتجات ومفاتيح الشحن المؤقتة (قواميس مقابل سجلات __slots__)
+- dispatch: كلفة توجيه أمر وزر لمعالجه مع زيادة عدد المعالجات (شروط telebot الخطية مقابل BotRouter)
+
+البيانات تُزرع في مخزن الذاكرة (STORE_BACKEND=memory) افتراضياً، أو في محاكي Firestore
+إذا تم ضبط STORE_BACKEND=firestore مع FIRESTORE_EMULATOR_HOST.
+استدعاءات تيليجرام تذهب لخادم وهمي محلي بزمن استجابة قابل للضبط (--telegram-latency).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import gc
+import tempfile
+import itertools
+import statistics
+import threading
+import contextlib
+import subprocess
+import http.client
+import http.server
+
+os.environ.setdefault("STORE_BACKEND", "memory")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# كل طلبات القياس من نفس IP ونفس مجموعة المستخدمين، فتحديد المعدل سيرفض معظمها
+os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+
+# يبقى مفتوحاً طوال التشغيل لأن سجلات التطبيق تكتب على stdout الذي كان وقت الاستيراد
+DEVNULL = open(os.devnull, 'w')
+
+ENDPOINTS = ['index', 'buy', 'charge_balance', 'get_orders', 'webhook']
+
+# --- خادم تيليجرام الوهمي ---
+
+STUB_MESSAGE = {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}
+STUB_RESULTS = {
+    'sendMessage': STUB_MESSAGE,
+    'editMessageText': STUB_MESSAGE,
+    'getUserProfilePhotos': {'total_count': 0, 'photos': []},
+    'getChat': {'id': 1, 'type': 'private', 'first_name': 'مشرف'},
+    'getFile': {'file_id': 'f', 'file_unique_id': 'f', 'file_path': 'photos/f.jpg'},
+    'getMe': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'},
+}
+
+class StubTelegramHandler(http.server.BaseHTTPRequestHandler):
+    """يرد على أي استدعاء Bot API بنتيجة ناجحة بعد تأخير ثابت"""
+
+    protocol_version = 'HTTP/1.1'
+    # إرسال الترويسة والمحتوى معاً (تجنب تأخير Nagle/delayed ACK الذي يشوه القياس)
+    wbufsize = 1 << 16
+    disable_nagle_algorithm = True
+    latency = 0.0
+    calls = {}
+    lock = threading.Lock()
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        method = self.path.split('?')[0].rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        body = json.dumps({'ok': True, 'result': STUB_RESULTS.get(method, True)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_telegram(latency_ms=0.0):
+    """تشغيل خادم تيليجرام الوهمي في خيط خلفي وإرجاع رابط API بصيغة telebot"""
+    StubTelegramHandler.latency = latency_ms / 1000.0
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubTelegramHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+
+def point_bot_to(api_url):
+    """توجيه العميلين (المتزامن وغير المتزامن) إلى خادم تيليجرام الوهمي"""
+    from telebot import apihelper, asyncio_helper
+    apihelper.API_URL = api_url
+    asyncio_helper.API_URL = api_url
+
+# --- زرع البيانات ---
+
+def seed(app_module, users, products, keys, rng_seed=1):
+    """زرع مستخدمين ومنتجات ومفاتيح شحن بأرقام ثابتة (نفس البيانات في كل عامل)"""
+    rng = random.Random(rng_seed)
+    categories = ["نتفلكس", "شاهد", "ديزني بلس", "اوسن بلس", "فديو بريميم", "اشتراكات أخرى"]
+
+    for i in range(users):
+        app_module.users_repo.set_balance(f"{100000 + i}", 1000000.0)
+
+    for i in range(products):
+        app_module.products_repo.create(f"prod-{i}", {
+            'item_name': f"اشتراك {i}",
+            'price': float(rng.randint(5, 100)),
+            'seller_id': str(app_module.ADMIN_ID),
+            'seller_name': 'المالك',
+            'hidden_data': f"user{i}@mail.com / pass{i}",
+            'category': rng.choice(categories),
+            'details': 'اشتراك شهر كامل بجودة عالية',
+            'image_url': '',
+            'sold': False,
+        })
+
+    for i in range(keys):
+        app_module.keys_repo.set(f"KEY-{i:05d}-BNCH", {
+            'amount': 10.0,
+            'used': False,
+            'used_by': '',
+            'created_at': time.time(),
+        })
+
+    with contextlib.redirect_stdout(DEVNULL):
+        app_module.load_data_from_firebase()
+
+def create_app():
+    """مصنع التطبيق لـ gunicorn: يزرع البيانات في كل عامل ويوجه البوت للخادم الوهمي"""
+    import app as app_module
+    point_bot_to(os.environ["BENCH_TELEGRAM_URL"])
+    seed(app_module,
+         int(os.environ.get("BENCH_USERS", 1000)),
+         int(os.environ.get("BENCH_PRODUCTS", 1000)),
+         int(os.environ.get("BENCH_KEYS", 1000)))
+    return app_module.app
+
+# --- سيناريوهات الطلبات ---
+
+class Scenarios:
+    """تولد طلباً لكل مسار: (method, path, body)"""
+
+    def __init__(self, users, products, keys):
+        self.users = users
+        self.products = itertools.count()
+        self.product_count = products
+        self.keys = itertools.count()
+        self.key_count = keys
+        self.update_ids = itertools.count(1)
+
+    def user_id(self):
+        return f"{100000 + random.randrange(self.users)}"
+
+    def build(self, endpoint):
+        if endpoint == 'index':
+            return 'GET', f"/?user_id={self.user_id()}", None
+        if endpoint == 'buy':
+            product = next(self.products) % self.product_count
+            return 'POST', '/buy', {'buyer_id': self.user_id(), 'buyer_name': 'bench', 'item_id': f"prod-{product}"}
+        if endpoint == 'charge_balance':
+            key = next(self.keys) % self.key_count
+            return 'POST', '/charge_balance', {'user_id': self.user_id(), 'charge_key': f"KEY-{key:05d}-BNCH"}
+        if endpoint == 'get_orders':
+            return 'GET', f"/get_orders?user_id={self.user_id()}", None
+        if endpoint == 'webhook':
+            user = int(self.user_id())
+            return 'POST', '/webhook', {
+                'update_id': next(self.update_ids),
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user, 'type': 'private'},
+                    'from': {'id': user, 'is_bot': False, 'first_name': 'bench'},
+                    'text': '/start',
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                },
+            }
+        raise ValueError(endpoint)
+
+# --- مولد تحديثات تيليجرام ---
+
+UPDATE_KINDS = ['start', 'code', 'charge', 'claim', 'wizard']
+
+class UpdateGenerator:
+    """يولد تحديثات Update بصيغة JSON كما يرسلها تيليجرام للـ Webhook.
+    كل دالة ترجع قائمة (kind, update) لأن بعض السيناريوهات عدة خطوات متتالية في نفس المحادثة"""
+
+    def __init__(self, users, keys, admin_id, rng_seed=7):
+        self.users = users
+        self.keys = itertools.count()
+        self.key_count = keys
+        self.admin_id = admin_id
+        self.rng = random.Random(rng_seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.orders = itertools.count(1)
+
+    def _user(self, user_id=None):
+        user_id = user_id or 100000 + self.rng.randrange(self.users)
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'username': f"u{user_id}"}
+
+    def message(self, text, user_id=None):
+        sender = self._user(user_id)
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': sender['id'], 'type': 'private', 'first_name': sender['first_name']},
+            'from': sender,
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, data, user_id):
+        sender = self._user(user_id)
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.message_ids)),
+                'from': sender,
+                'chat_instance': str(sender['id']),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': sender['id'], 'type': 'private'},
+                    'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'},
+                    'text': 'طلب جديد',
+                },
+            },
+        }
+
+    def start(self):
+        return [('start', self.message('/start'))]
+
+    def code(self):
+        return [('code', self.message('/code'))]
+
+    def charge(self):
+        key = next(self.keys) % self.key_count
+        return [('charge', self.message(f"/شحن KEY-{key:05d}-BNCH"))]
+
+    def claim(self):
+        """استلام طلب ثم إتمامه من نفس المشرف (order_id يجب أن يكون مزروعاً في active_orders)"""
+        order_id = f"ORD_BENCH_{next(self.orders)}"
+        return [
+            ('claim', self.callback(f"claim_{order_id}", self.admin_id)),
+            ('complete', self.callback(f"complete_{order_id}", self.admin_id)),
+        ]
+
+    def wizard(self):
+        """خطوات /add_product كاملة من المالك"""
+        steps = ['/add_product', 'اشتراك تجريبي', '25', 'نتفلكس', 'شهر كامل', 'تخطي', 'mail@x.com / pass', '✅ موافق']
+        kinds = ['add_product'] + ['wizard_step'] * (len(steps) - 1)
+        return [(kind, self.message(text, self.admin_id)) for kind, text in zip(kinds, steps)]
+
+    def stream(self, count, mix):
+        """تسلسل من count تحديث حسب أوزان السيناريوهات في mix"""
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        produced = 0
+        while produced < count:
+            for item in getattr(self, self.rng.choices(kinds, weights)[0])():
+                yield item
+                produced += 1
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in UPDATE_KINDS:
+            raise argparse.ArgumentTypeError(f"سيناريو غير معروف: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+# --- الإحصائيات ---
+
+def summarize(latencies, errors, elapsed):
+    """p50/p95/p99 بالملي ثانية ومعدل الطلبات في الثانية"""
+    if not latencies:
+        return {'count': 0, 'errors': errors}
+    ordered = sorted(latencies)
+    cuts = statistics.quantiles(ordered, n=100) if len(ordered) > 1 else [ordered[0]] * 99
+    return {
+        'count': len(ordered),
+        'errors': errors,
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(cuts[49] * 1000, 3),
+        'p95_ms': round(cuts[94] * 1000, 3),
+        'p99_ms': round(cuts[98] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+    }
+
+def print_report(results, out=sys.stdout):
+    width = max([16] + [len(name) + 2 for name in results])
+    print(f"{'endpoint':<{width}}{'count':>8}{'err':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}", file=out)
+    for endpoint, stats in results.items():
+        if not stats.get('count'):
+            print(f"{endpoint:<{width}}{0:>8}{stats.get('errors', 0):>6}", file=out)
+            continue
+        print(f"{endpoint:<{width}}{stats['count']:>8}{stats['errors']:>6}"
+              f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{stats['throughput_rps']:>10.1f}", file=out)
+
+def write_results(path, mode, args, results):
+    if not path:
+        return
+    payload = {
+        'meta': {
+            'mode': mode,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'store_backend': os.environ.get("STORE_BACKEND"),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'},
+        },
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+# --- الأوامر ---
+
+def run_micro(args):
+    """قياس كل مسار داخل العملية عبر Flask test client"""
+    real_stdout = sys.stdout
+    _, api_url = start_stub_telegram(args.telegram_latency)
+    with contextlib.redirect_stdout(DEVNULL):
+        import app as app_module
+        point_bot_to(api_url)
+        products = max(args.products, args.iterations + args.warmup)
+        keys = max(args.keys, args.iterations + args.warmup)
+        seed(app_module, args.users, products, keys)
+        client = app_module.app.test_client()
+        scenarios = Scenarios(args.users, products, keys)
+
+        results = {}
+        for endpoint in args.endpoints:
+            latencies = []
+            errors = 0
+            for i in range(args.warmup + args.iterations):
+                method, path, body = scenarios.build(endpoint)
+                start = time.perf_counter()
+                response = client.open(path, method=method, json=body)
+                elapsed = time.perf_counter() - start
+                if i < args.warmup:
+                    continue
+                if response.status_code >= 400:
+                    errors += 1
+                latencies.append(elapsed)
+            results[endpoint] = summarize(latencies, errors, sum(latencies))
+
+        print_report(results, out=real_stdout)
+    write_results(args.output, 'micro', args, results)
+    return 0
+
+def _load_client(host, port, scenarios, endpoints, deadline, records, lock):
+    """خيط عميل: اتصال keep-alive واحد يرسل طلبات عشوائية حتى انتهاء المدة"""
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    local = {endpoint: ([], 0) for endpoint in endpoints}
+    while time.perf_counter() < deadline:
+        endpoint = random.choice(endpoints)
+        method, path, body = scenarios.build(endpoint)
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+            failed = True
+        latencies, errors = local[endpoint]
+        if failed:
+            local[endpoint] = (latencies, errors + 1)
+        else:
+            latencies.append(time.perf_counter() - start)
+    connection.close()
+    with lock:
+        for endpoint, (latencies, errors) in local.items():
+            records[endpoint][0].extend(latencies)
+            records[endpoint][1] += errors
+
+def _wait_for(host, port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=2)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.3)
+    return False
+
+def run_load(args):
+    """تشغيل التطبيق تحت gunicorn وقياس زمن الاستجابة والإنتاجية تحت حمل متزامن"""
+    server, api_url = start_stub_telegram(args.telegram_latency)
+    host, port = '127.0.0.1', args.port
+    env = dict(os.environ,
+               BENCH_TELEGRAM_URL=api_url,
+               BENCH_USERS=str(args.users),
+               BENCH_PRODUCTS=str(args.products),
+               BENCH_KEYS=str(args.keys))
+    command = [
+        sys.executable, '-m', 'gunicorn', 'benchmark:create_app()',
+        '--bind', f"{host}:{port}",
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--log-level', 'warning',
+    ]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if not _wait_for(host, port):
+            print("❌ لم يبدأ gunicorn في الوقت المحدد", file=sys.stderr)
+            return 1
+
+        scenarios = Scenarios(args.users, args.products, args.keys)
+        records = {endpoint: [[], 0] for endpoint in args.endpoints}
+        lock = threading.Lock()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        threads = [
+            threading.Thread(target=_load_client, args=(host, port, scenarios, args.endpoints, deadline, records, lock))
+            for _ in range(args.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        server.shutdown()
+
+    results = {endpoint: summarize(latencies, errors, elapsed) for endpoint, (latencies, errors) in records.items()}
+    total = sum(stats.get('count', 0) for stats in results.values())
+    print_report(results)
+    print(f"\nالإجمالي: {total} طلب خلال {elapsed:.1f} ثانية ({total / elapsed:.1f} طلب/ثانية)")
+    write_results(args.output, 'load', args, results)
+    return 0
+
+def run_replay(args):
+    """إرسال تحديثات مولدة لـ /webhook بمعدل ثابت وقياس زمن المعالج لكل أمر"""
+    real_stdout = sys.stdout
+    _, api_url = start_stub_telegram(args.telegram_latency)
+    with contextlib.redirect_stdout(DEVNULL):
+        import app as app_module
+        point_bot_to(api_url)
+        seed(app_module, args.users, 0, max(args.keys, args.count))
+        client = app_module.app.test_client()
+        generator = UpdateGenerator(args.users, max(args.keys, args.count), app_module.ADMIN_ID)
+        updates = list(generator.stream(args.count, args.mix))
+
+        # طلبات معلقة لسيناريو claim/complete
+        for order_number in range(1, next(generator.orders)):
+            order_id = f"ORD_BENCH_{order_number}"
+            app_module.active_orders[order_id] = app_module.Order(
+                id=order_id, item_name='اشتراك', price=10.0, buyer_id='100000', buyer_name='bench',
+                seller_id=str(app_module.ADMIN_ID), hidden_data='secret', game_id='-', game_name='-',
+            )
+
+        # قياس زمن المعالج داخل عامل الـ Webhook
+        kinds = {update['update_id']: kind for kind, update in updates}
+        handler_latency = {}
+        queued_at = {}
+        end_to_end = {}
+        lock = threading.Lock()
+        process_updates = app_module.bot.process_new_updates
+
+        def timed_process(batch):
+            start = time.perf_counter()
+            process_updates(batch)
+            finished = time.perf_counter()
+            with lock:
+                for update in batch:
+                    kind = kinds.get(update.update_id, 'other')
+                    handler_latency.setdefault(kind, []).append(finished - start)
+                    end_to_end.setdefault(kind, []).append(finished - queued_at.get(update.update_id, start))
+
+        app_module.bot.process_new_updates = timed_process
+
+        ack_latency = []
+        errors = 0
+        interval = 1.0 / args.rate
+        started = time.perf_counter()
+        for index, (kind, update) in enumerate(updates):
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            queued_at[update['update_id']] = time.perf_counter()
+            response = client.post('/webhook', json=update)
+            ack_latency.append(time.perf_counter() - queued_at[update['update_id']])
+            if response.status_code != 200:
+                errors += 1
+        for worker_queue in app_module.webhook_dispatcher.queues:
+            worker_queue.join()
+        elapsed = time.perf_counter() - started
+
+    results = {'webhook_ack': summarize(ack_latency, errors, elapsed)}
+    for kind in sorted(handler_latency):
+        results[f"handler:{kind}"] = summarize(handler_latency[kind], 0, elapsed)
+        results[f"end_to_end:{kind}"] = summarize(end_to_end[kind], 0, elapsed)
+    print_report(results, out=real_stdout)
+    print(f"\nتم إرسال {len(updates)} تحديث خلال {elapsed:.1f} ثانية "
+          f"(المطلوب {args.rate:.0f}/ثانية، الفعلي {len(updates) / elapsed:.1f}/ثانية)", file=real_stdout)
+    write_results(args.output, 'replay', args, results)
+    return 0
+
+def run_compare(args):
+    """مقارنة p95 بين نتيجتين (خط الأساس والجديدة)"""
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    print(f"{'endpoint':<16}{'p95 old':>10}{'p95 new':>10}{'change':>10}")
+    for endpoint, stats in current.items():
+        old = baseline.get(endpoint, {}).get('p95_ms')
+        new = stats.get('p95_ms')
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        flag = ''
+        if change > args.threshold:
+            regressions += 1
+            flag = '  ⚠️'
+        print(f"{endpoint:<16}{old:>10.2f}{new:>10.2f}{change:>9.1f}%{flag}")
+    return 1 if regressions else 0
+
+class SlowSink:
+    """مجرى كتابة يتأخر في كل سطر لمحاكاة stdout بطيء (سائق سجلات الحاوية تحت الضغط)"""
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def run_logging(args):
+    """كلفة السجلات لكل طلب webhook: print متزامن (النمط القديم) مقابل السجل المنظم عبر الطابور"""
+    with contextlib.redirect_stdout(DEVNULL):
+        import app as app_module
+    payload = json.dumps(UpdateGenerator(args.users, 1, 1).start()[0][1], ensure_ascii=False)
+
+    def old_print(i, out):
+        print(f"📩 استقبال رسالة: {payload[:100]}...", file=out)
+        print(f"✅ رسالة نصية من مستخدم {i}", file=out)
+        print(f"✅ تمت جدولة التحديث {i}", file=out)
+        print(f"✅ استقبال أمر /start من مستخدم ({i})", file=out)
+
+    def json_all(i, out):
+        log = app_module.log
+        log.info("استقبال تحديث", update_id=i, kind='message', payload=payload[:100])
+        log.info("تمت جدولة التحديث", update_id=i)
+        log.info("استقبال أمر /start", user_id=i)
+        log.info("تم إرسال رسالة الترحيب", user_id=i)
+
+    def json_sampled(i, out):
+        # نفس أحداث /webhook و /start في app.py بالمستويات والعينات الفعلية
+        log = app_module.log
+        log.debug("استقبال تحديث", update_id=i, kind='message', payload=payload[:100], sample=True)
+        log.debug("تمت جدولة التحديث", update_id=i)
+        log.info("استقبال أمر /start", user_id=i, sample=True)
+        log.debug("تم إرسال رسالة الترحيب", user_id=i)
+
+    modes = {'print': old_print, 'json_queue': json_all, 'json_sampled': json_sampled}
+    logger = app_module._app_logger
+    results = {}
+    for name, emit in modes.items():
+        # ملف بتخزين سطري يحاكي stdout غير المخزن في Render
+        with tempfile.TemporaryFile('w', buffering=1, encoding='utf-8') as sink:
+            out = SlowSink(sink, args.sink_delay / 1e6) if args.sink_delay else sink
+            app_module._log_stream_handler.setStream(out)
+            logger.setLevel('INFO')
+            dropped_before = app_module.log_queue_handler.dropped
+            latencies = []
+            for i in range(args.warmup + args.iterations):
+                start = time.perf_counter()
+                emit(i, out)
+                elapsed = time.perf_counter() - start
+                if i >= args.warmup:
+                    latencies.append(elapsed)
+            # انتظار تفريغ الطابور قبل الوضع التالي حتى لا تتداخل الخيوط
+            drain_start = time.perf_counter()
+            while app_module.log_queue_handler.queue.qsize():
+                time.sleep(0.001)
+            stats = summarize(latencies, 0, sum(latencies))
+            stats['dropped'] = app_module.log_queue_handler.dropped - dropped_before
+            stats['drain_ms'] = round((time.perf_counter() - drain_start) * 1000, 3)
+            results[name] = stats
+            app_module._log_stream_handler.setStream(DEVNULL)
+
+    print_report(results)
+    for name, stats in results.items():
+        print(f"{name:<16}mean={stats['mean_ms'] * 1000:.1f}µs  dropped={stats['dropped']}  drain={stats['drain_ms']:.1f}ms")
+    write_results(args.output, 'logging', args, results)
+    return 0
+
+def _rss_bytes():
+    """الذاكرة المقيمة الحالية للعملية (Linux) أو الذروة كاحتياط"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _memory_variant(variant, count):
+    """بناء count منتج و count مفتاح شحن بنفس طريقة load_data_from_firebase وقياس زيادة RSS
+    (dict: قائمة قواميس كما كان سابقاً، records: ProductCatalog مع عروضه + سجلات ChargeKey)"""
+    with contextlib.redirect_stdout(DEVNULL):
+        import app as app_module
+    categories = ["نتفلكس", "شاهد", "ديزني بلس", "اوسن بلس", "فديو بريميم", "اشتراكات أخرى"]
+    gc.collect()
+    before = _rss_bytes()
+    products = [] if variant == 'dict' else app_module.ProductCatalog()
+    keys = {}
+    for i in range(count):
+        product_id = f"prod-{i:06d}"
+        data = {
+            'item_name': f"اشتراك {i}",
+            'price': float(5 + i % 95),
+            'seller_id': str(app_module.ADMIN_ID),
+            'seller_name': 'المالك',
+            'hidden_data': f"user{i}@mail.com / pass{i}",
+            'category': categories[i % len(categories)],
+            'details': 'اشتراك شهر كامل بجودة عالية',
+            'image_url': '',
+            'sold': False,
+        }
+        key_code = f"KEY-{i:06d}-BNCH"
+        key_data = {'amount': 10.0, 'used': False, 'used_by': None, 'created_at': time.time()}
+        if variant == 'dict':
+            data['id'] = product_id
+            products.append(data)
+            keys[key_code] = key_data
+        else:
+            products.add(app_module.Product.from_dict(product_id, data))
+            keys[key_code] = app_module.ChargeKey.from_dict(key_code, key_data)
+    gc.collect()
+    return {'rss_bytes': _rss_bytes() - before, 'entries': len(products) + len(keys)}
+
+def run_memory(args):
+    """كل نوع في عملية مستقلة حتى لا تؤثر ذاكرة الأول على قياس الثاني"""
+    if args.variant:
+        print(json.dumps(_memory_variant(args.variant, args.count)))
+        return 0
+    results = {}
+    for variant in ('dict', 'records'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'memory', '--variant', variant, '--count', str(args.count)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results[variant] = json.loads(output.strip().splitlines()[-1])
+    print(f"{'variant':<12}{'entries':>10}{'RSS (MB)':>12}{'bytes/entry':>14}")
+    for variant, stats in results.items():
+        stats['rss_mb'] = round(stats['rss_bytes'] / 1024 / 1024, 2)
+        stats['bytes_per_entry'] = round(stats['rss_bytes'] / stats['entries'], 1)
+        print(f"{variant:<12}{stats['entries']:>10}{stats['rss_mb']:>12.2f}{stats['bytes_per_entry']:>14.1f}")
+    reduction = 1 - results['records']['rss_bytes'] / results['dict']['rss_bytes']
+    print(f"\nالتوفير: {reduction * 100:.1f}%")
+    write_results(args.output, 'memory', args, results)
+    return 0
+
+def _dispatch_bots(app_module, count):
+    """بوتان بنفس count أمر و count بادئة زر: الأول بشروط telebot الخطية كما كان app.py
+    والثاني بمعالج واحد يوجه عبر BotRouter (threaded=False حتى يُقاس التوجيه نفسه)"""
+    import telebot
+    linear = telebot.TeleBot(os.environ["BOT_TOKEN"], threaded=False)
+    routed = telebot.TeleBot(os.environ["BOT_TOKEN"], threaded=False)
+    router = app_module.BotRouter()
+    hits = []
+    noop = hits.append
+    for i in range(count):
+        linear.message_handler(commands=[f"cmd{i}"])(noop)
+        linear.callback_query_handler(func=lambda call, prefix=f"btn{i}_": call.data.startswith(prefix))(noop)
+        router.command(f"cmd{i}")(noop)
+        router.callback(f"btn{i}_")(noop)
+    routed.message_handler(func=lambda message: True)(router.dispatch_message)
+    routed.callback_query_handler(func=lambda call: True)(router.dispatch_callback)
+    return {'linear': linear, 'router': routed}, hits
+
+def run_dispatch(args):
+    """كلفة توجيه تحديث واحد لمعالجه مع زيادة عدد المعالجات (آخر معالج مسجل = أسوأ حالة للفحص الخطي)"""
+    with contextlib.redirect_stdout(DEVNULL):
+        import app as app_module
+    import telebot
+    generator = UpdateGenerator(args.users, 1, 1)
+    results = {}
+    print(f"{'handlers':>10}{'kind':>10}{'linear (µs)':>14}{'router (µs)':>14}{'speedup':>10}")
+    for count in args.handlers:
+        bots, hits = _dispatch_bots(app_module, count)
+        last = count - 1
+        updates = {
+            'command': telebot.types.Update.de_json(generator.message(f"/cmd{last} arg")),
+            'callback': telebot.types.Update.de_json(generator.callback(f"btn{last}_order-1", 1)),
+        }
+        row = {}
+        for kind, update in updates.items():
+            timings = {}
+            for name, bot in bots.items():
+                process = (bot.process_new_messages if kind == 'command' else bot.process_new_callback_query)
+                item = update.message if kind == 'command' else update.callback_query
+                for _ in range(args.warmup):
+                    process([item])
+                hits.clear()
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    process([item])
+                elapsed = time.perf_counter() - start
+                if len(hits) != args.iterations:
+                    raise RuntimeError(f"{name}/{kind}: وصل {len(hits)} من {args.iterations} تحديث للمعالج")
+                timings[name] = round(elapsed / args.iterations * 1e6, 2)
+            timings['speedup'] = round(timings['linear'] / timings['router'], 1)
+            row[kind] = timings
+            print(f"{count:>10}{kind:>10}{timings['linear']:>14.2f}{timings['router']:>14.2f}{timings['speedup']:>9.1f}x")
+        results[str(count)] = row
+    write_results(args.output, 'dispatch', args, results)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء المتجر ومسار الشراء")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(command):
+        command.add_argument('--users', type=int, default=1000)
+        command.add_argument('--products', type=int, default=1000)
+        command.add_argument('--keys', type=int, default=1000)
+        command.add_argument('--endpoints', nargs='+', default=ENDPOINTS, choices=ENDPOINTS)
+        command.add_argument('--telegram-latency', type=float, default=0.0, help="تأخير خادم تيليجرام الوهمي (ملي ثانية)")
+        command.add_argument('--output', help="حفظ النتائج كملف JSON")
+
+    micro = commands.add_parser('micro', help="قياس داخل العملية")
+    add_common(micro)
+    micro.add_argument('--iterations', type=int, default=300)
+    micro.add_argument('--warmup', type=int, default=20)
+    micro.set_defaults(func=run_micro)
+
+    load = commands.add_parser('load', help="اختبار حمل تحت gunicorn")
+    add_common(load)
+    load.add_argument('--workers', type=int, default=2)
+    load.add_argument('--threads', type=int, default=8)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--duration', type=float, default=20.0)
+    load.add_argument('--port', type=int, default=18080)
+    load.set_defaults(func=run_load)
+
+    replay = commands.add_parser('replay', help="إعادة تشغيل تحديثات تيليجرام مولدة على /webhook")
+    replay.add_argument('--users', type=int, default=1000)
+    replay.add_argument('--keys', type=int, default=1000)
+    replay.add_argument('--count', type=int, default=1000, help="عدد التحديثات")
+    replay.add_argument('--rate', type=float, default=100.0, help="تحديث في الثانية")
+    replay.add_argument('--mix', type=parse_mix, default=parse_mix('start=5,code=3,charge=2,claim=1,wizard=1'))
+    replay.add_argument('--telegram-latency', type=float, default=0.0, help="تأخير خادم تيليجرام الوهمي (ملي ثانية)")
+    replay.add_argument('--output', help="حفظ النتائج كملف JSON")
+    replay.set_defaults(func=run_replay)
+
+    compare = commands.add_parser('compare', help="مقارنة نتيجتين")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10.0, help="نسبة الزيادة المسموحة في p95")
+    compare.set_defaults(func=run_compare)
+
+    logging_cmd = commands.add_parser('logging', help="مقارنة كلفة print والسجل المنظم")
+    logging_cmd.add_argument('--iterations', type=int, default=20000)
+    logging_cmd.add_argument('--warmup', type=int, default=500)
+    logging_cmd.add_argument('--users', type=int, default=1000)
+    logging_cmd.add_argument('--sink-delay', type=float, default=0.0, help="تأخير كل كتابة على stdout (ميكرو ثانية)")
+    logging_cmd.add_argument('--output', help="حفظ النتائج كملف JSON")
+    logging_cmd.set_defaults(func=run_logging)
+
+    memory = commands.add_parser('memory', help="ذاكرة المنتجات والمفاتيح: قواميس مقابل سجلات")
+    memory.add_argument('--count', type=int, default=100000, help="عدد المنتجات (ونفس العدد من المفاتيح)")
+    memory.add_argument('--variant', choices=['dict', 'records'], help=argparse.SUPPRESS)
+    memory.add_argument('--output', help="حفظ النتائج كملف JSON")
+    memory.set_defaults(func=run_memory)
+
+    dispatch = commands.add_parser('dispatch', help="كلفة توجيه تحديثات البوت: فحص خطي مقابل BotRouter")
+    dispatch.add_argument('--handlers', type=int, nargs='+', default=[10, 100, 1000], help="أعداد المعالجات المقاسة")
+    dispatch.add_argument('--iterations', type=int, default=2000)
+    dispatch.add_argument('--warmup', type=int, default=200)
+    dispatch.add_argument('--users', type=int, default=1000)
+    dispatch.add_argument('--output', help="حفظ النتائج كملف JSON")
+    dispatch.set_defaults(func=run_dispatch)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
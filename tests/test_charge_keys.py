@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""اختبارات استخدام أكواد الشحن على مخزن الذاكرة: مرة واحدة فقط، وذاكرة الأكواد المرفوضة لا تحجب كوداً ولد لاحقاً"""
+
+import os
+import sys
+import time
+import unittest
+import uuid
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STORE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import app
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class KeyRedemptionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(app.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.redemption = app.KeyRedemption(app.store, 60, 1000)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.redemption.misses)
+        self.key_filter = app.ChargeKeyFilter(0.01, 3600, 5)
+        self.key_filter.started_pid = os.getpid()   # بدون خيط المزامنة الخلفي: المزامنة يدوية في الاختبار
+        for name, value in (('key_redemption', self.redemption), ('charge_key_filter', self.key_filter)):
+            patcher = mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.key_filter.refresh()
+
+        self.user_id = f"test-{uuid.uuid4().hex[:12]}"
+        app.users_repo.create_profile(self.user_id, 'Test', 'test')
+
+    def create_key(self, amount=5.0):
+        """كود مولد في عامل آخر: موجود في Firestore فقط"""
+        key_code = f"KEY-{uuid.uuid4().hex[:10]}"
+        app.keys_repo.set(key_code, {'amount': amount, 'used': False, 'used_by': '', 'created_at': time.time()})
+        return key_code
+
+    def test_key_is_redeemed_once(self):
+        key_code = self.create_key()
+        app.register_charge_key(key_code, 5.0)
+        self.addCleanup(app.charge_keys.pop, key_code, None)
+
+        result = self.redemption.redeem(key_code, self.user_id, self.user_id)
+        self.assertEqual(result.status, 'redeemed')
+        self.assertEqual(result.balance, 5.0)
+
+        again = self.redemption.redeem(key_code, self.user_id, self.user_id)
+        self.assertEqual(again.status, 'used')
+        self.assertEqual(again.used_by, self.user_id)
+        self.assertEqual(app.users_repo.get_balance(self.user_id), 5.0)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 5.0)
+
+    def test_unknown_key_is_cached_as_miss(self):
+        # المرشح مبني بدون هذا الكود، فنعطله مؤقتاً حتى يصل الكود للمعاملة ثم للذاكرة المؤقتة
+        with mock.patch.object(self.key_filter, 'might_exist', return_value=True):
+            first = self.redemption.redeem('KEY-missing', self.user_id, self.user_id)
+        self.assertEqual(first.status, 'unknown')
+        self.assertIn('KEY-missing', self.redemption.misses)
+
+        with mock.patch.object(app.store, 'run_transaction') as run_transaction:
+            second = self.redemption.redeem('KEY-missing', self.user_id, self.user_id)
+        run_transaction.assert_not_called()
+        self.assertEqual(second.status, 'unknown')
+        self.assertEqual(self.redemption.results['cached_miss'], 1)
+
+    def test_miss_becomes_redeemable_when_generated_here(self):
+        key_code = f"KEY-{uuid.uuid4().hex[:10]}"
+        with mock.patch.object(self.key_filter, 'might_exist', return_value=True):
+            self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'unknown')
+
+        app.keys_repo.set(key_code, {'amount': 7.0, 'used': False, 'used_by': '', 'created_at': time.time()})
+        app.register_charge_key(key_code, 7.0)
+        self.addCleanup(app.charge_keys.pop, key_code, None)
+        self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'redeemed')
+
+    def test_filtered_key_is_redeemable_after_sync(self):
+        key_code = f"KEY-{uuid.uuid4().hex[:10]}"
+        self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'unknown')
+        self.assertEqual(self.redemption.results['filtered'], 1)
+
+        app.keys_repo.set(key_code, {'amount': 7.0, 'used': False, 'used_by': '', 'created_at': time.time()})
+        self.key_filter.sync()
+        self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'redeemed')
+
+    def test_cached_miss_generated_elsewhere_is_redeemable_after_ttl(self):
+        key_code = f"KEY-{uuid.uuid4().hex[:10]}"
+        with mock.patch.object(self.key_filter, 'might_exist', return_value=True):
+            self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'unknown')
+
+        app.keys_repo.set(key_code, {'amount': 7.0, 'used': False, 'used_by': '', 'created_at': time.time()})
+        self.key_filter.sync()
+        # مرفوض من الذاكرة المؤقتة حتى تنتهي مدته (CHARGE_KEY_MISS_TTL)
+        self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'unknown')
+        self.clock.now += 61
+        self.assertEqual(self.redemption.redeem(key_code, self.user_id, self.user_id).status, 'redeemed')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""اختبارات سجل حركات الرصيد على مخزن الذاكرة: مجموع السجل يساوي الرصيد المخزن دائماً"""
+
+import datetime
+import os
+import sys
+import threading
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STORE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import app
+
+
+def new_user_id():
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+
+class OpeningEntryTest(unittest.TestCase):
+    def test_existing_balance_is_opened_with_first_credit(self):
+        user_id = new_user_id()
+        app.store.set('users', user_id, {'balance': 10.0})
+        self.assertTrue(app.add_balance(user_id, 5, 'credit', 'first'))
+        self.assertTrue(app.add_balance(user_id, 5, 'credit', 'second'))
+        self.assertEqual(app.users_repo.get_balance(user_id), 20.0)
+        self.assertEqual(app.ledger_repo.balance(user_id), 20.0)
+        reasons = [entry['reason'] for _, entry in app.ledger_repo.entries(user_id)]
+        self.assertEqual(reasons.count('opening'), 1)
+
+    def test_new_profile_needs_no_opening_entry(self):
+        user_id = new_user_id()
+        app.users_repo.create_profile(user_id, 'Test', 'test')
+        app.add_balance(user_id, 3, 'credit', 'first')
+        reasons = [entry['reason'] for _, entry in app.ledger_repo.entries(user_id)]
+        self.assertEqual(reasons, ['credit'])
+
+    def test_sharded_wallet_opens_with_stored_total(self):
+        user_id = new_user_id()
+        app.users_repo.hot_wallets.add(user_id)
+        self.addCleanup(app.users_repo.hot_wallets.discard, user_id)
+        app.store.set('users', user_id, {'balance': 100.0})
+        app.add_balance(user_id, 7, 'credit', 'first')
+        app.add_balance(user_id, 3, 'credit', 'second')
+        self.assertEqual(app.users_repo.sharded_balance(user_id, fresh=True), 110.0)
+        self.assertEqual(app.ledger_repo.balance(user_id), 110.0)
+
+
+class LedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.user_id = new_user_id()
+        app.users_repo.create_profile(self.user_id, 'Test', 'test')
+
+    def credit_concurrently(self, refs):
+        results = []
+        barrier = threading.Barrier(len(refs))
+
+        def credit(ref_id):
+            barrier.wait()
+            results.append(app.add_balance(self.user_id, 1, 'credit', ref_id))
+
+        threads = [threading.Thread(target=credit, args=(ref_id,)) for ref_id in refs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_same_ref_is_credited_once(self):
+        self.assertTrue(app.add_balance(self.user_id, 5, 'credit', 'order-1'))
+        self.assertFalse(app.add_balance(self.user_id, 5, 'credit', 'order-1'))
+        self.assertTrue(app.add_balance(self.user_id, 5, 'refund', 'order-1'))
+        self.assertEqual(app.users_repo.get_balance(self.user_id), 10.0)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 10.0)
+
+    def test_compaction_matches_balance(self):
+        for n in range(5):
+            app.add_balance(self.user_id, n + 1, 'credit', f'c{n}')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.assertEqual(app.ledger_repo.compact(self.user_id, now), 0)
+        snapshot = app.ledger_repo.snapshot(self.user_id)
+        self.assertEqual((snapshot['balance'], snapshot['entries']), (15.0, 5))
+        self.assertEqual(app.ledger_repo.entries(self.user_id, snapshot['as_of']), [])
+
+        app.add_balance(self.user_id, 2.5, 'credit', 'after')
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 17.5)
+        self.assertEqual(app.users_repo.get_balance(self.user_id), 17.5)
+        # ضغط ثان لا يضم الحركات المضمومة مرة أخرى
+        app.ledger_repo.compact(self.user_id, datetime.datetime.now(datetime.timezone.utc))
+        self.assertEqual(app.ledger_repo.snapshot(self.user_id)['balance'], 17.5)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 17.5)
+
+    def test_concurrent_credits_all_apply(self):
+        results = self.credit_concurrently([f'c{n}' for n in range(50)])
+        self.assertEqual(results, [True] * 50)
+        self.assertEqual(app.users_repo.get_balance(self.user_id), 50.0)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 50.0)
+
+    def test_concurrent_credits_to_sharded_wallet(self):
+        app.users_repo.hot_wallets.add(self.user_id)
+        self.addCleanup(app.users_repo.hot_wallets.discard, self.user_id)
+        results = self.credit_concurrently([f'c{n}' for n in range(50)])
+        self.assertEqual(results, [True] * 50)
+        self.assertEqual(app.users_repo.sharded_balance(self.user_id, fresh=True), 50.0)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 50.0)
+
+    def test_concurrent_retries_apply_once(self):
+        results = self.credit_concurrently(['same'] * 50)
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(app.users_repo.get_balance(self.user_id), 1.0)
+        self.assertEqual(app.ledger_repo.balance(self.user_id), 1.0)
+
+
+class MigrationTest(unittest.TestCase):
+    def test_stale_cached_balance_is_not_written_back(self):
+        user_id = new_user_id()
+        app.users_repo.create_profile(user_id, 'Test', 'test')
+        app.add_balance(user_id, 10, 'credit', 'first')
+        app.users_wallets[user_id] = 2.0        # نسخة قديمة في ذاكرة عامل آخر
+        self.addCleanup(app.users_wallets.pop, user_id, None)
+        self.assertTrue(app.migrate_data_to_firebase())
+        self.assertEqual(app.users_repo.get_balance(user_id), 10.0)
+        self.assertEqual(app.ledger_repo.balance(user_id), 10.0)
+
+    def test_sharded_wallet_is_left_to_its_shards(self):
+        user_id = new_user_id()
+        app.users_repo.hot_wallets.add(user_id)
+        self.addCleanup(app.users_repo.hot_wallets.discard, user_id)
+        app.add_balance(user_id, 25, 'credit', 'first')
+        app.users_wallets[user_id] = 0.0
+        self.addCleanup(app.users_wallets.pop, user_id, None)
+        self.assertTrue(app.migrate_data_to_firebase())
+        self.assertEqual(app.users_repo.sharded_balance(user_id, fresh=True), 25.0)
+        self.assertEqual(app.ledger_repo.balance(user_id), 25.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
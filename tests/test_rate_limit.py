@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""اختبارات تحديد معدل الطلبات: مخزن الذاكرة، تعدد القواعد، وتطابق سكربتات Lua مع مخزن الذاكرة"""
+
+import os
+import sys
+import unittest
+import uuid
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STORE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import app
+
+# سكربتات Lua تُختبر فقط عند توفر Redis حقيقي (لا نحاكيه): RATE_LIMIT_TEST_REDIS_URL=redis://localhost:6379/15
+TEST_REDIS_URL = os.environ.get("RATE_LIMIT_TEST_REDIS_URL")
+
+
+class FakeClock:
+    def __init__(self, now=6000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """كل اختبار بمخزن ذاكرة جديد حتى لا تتسرب العدادات بين الاختبارات"""
+
+    def setUp(self):
+        self.memory = app.MemoryRateLimitStore(3600, 1000)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.buckets)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.windows)
+        patcher = mock.patch.object(app.rate_limiter, 'store', self.memory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.app.test_client()
+
+    def post(self, path, payload, ip):
+        # خلف بروكسي واحد (TRUSTED_PROXY_HOPS=1): IP العميل هو آخر عنوان في X-Forwarded-For
+        return self.client.post(path, json=payload, headers={'X-Forwarded-For': ip})
+
+
+class MemoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.memory = app.MemoryRateLimitStore(3600, 1000)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.buckets)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.windows)
+
+    def test_window_blocks_until_previous_window_fades(self):
+        now = 6000.0                        # بداية نافذة (6000 / 600 = 10)
+        for _ in range(5):
+            self.assertEqual(self.memory.hit('k', 5, 600, now), 0)
+        self.assertEqual(self.memory.hit('k', 5, 600, now + 599), 1)
+        # النافذة التالية: السابقة ما زالت تحسب بوزن 1 في بدايتها
+        self.assertGreater(self.memory.hit('k', 5, 600, now + 600), 0)
+        # منتصف النافذة التالية: 5 * 0.5 + 0 + 1 <= 5
+        self.assertEqual(self.memory.hit('k', 5, 600, now + 900), 0)
+
+    def test_window_resets_after_two_periods(self):
+        for _ in range(5):
+            self.memory.hit('k', 5, 600, 6000.0)
+        for _ in range(5):
+            self.assertEqual(self.memory.hit('k', 5, 600, 7200.0), 0)
+        self.assertGreater(self.memory.hit('k', 5, 600, 7200.0), 0)
+
+    def test_bucket_refills_over_time(self):
+        for _ in range(3):
+            self.assertEqual(self.memory.take('k', 3, 0.5, 100.0), 0)
+        self.assertAlmostEqual(self.memory.take('k', 3, 0.5, 100.0), 2.0)
+        self.assertEqual(self.memory.take('k', 3, 0.5, 102.0), 0)
+        self.assertGreater(self.memory.take('k', 3, 0.5, 102.0), 0)
+
+    def test_verify_account_window_expires(self):
+        clock = FakeClock()
+        rule = app.RateLimit('verify_account', 'account', 5, 600, 'window')
+        limiter = app.RateLimiter(self.memory)
+        with mock.patch.object(app.time, 'time', clock):
+            for _ in range(5):
+                self.assertEqual(limiter.check(rule, '424242'), 0)
+            self.assertGreater(limiter.check(rule, '424242'), 0)
+            clock.now += 1200
+            self.assertEqual(limiter.check(rule, '424242'), 0)
+        self.assertEqual(limiter.rejected['verify_account'], 1)
+
+
+class MultipleRulesTest(RateLimitTestCase):
+    def test_ip_rule_applies_when_accounts_rotate(self):
+        # verify_ip (20 في الدقيقة) يوقف من يدور على حسابات مختلفة من نفس IP
+        statuses = [
+            self.post('/verify', {'user_id': 600000 + n, 'code': '000000'}, '10.0.3.1').status_code
+            for n in range(21)
+        ]
+        self.assertEqual(statuses, [200] * 20 + [429])
+        self.assertEqual(self.post('/verify', {'user_id': 700000, 'code': '000000'}, '10.0.3.2').status_code, 200)
+
+    def test_rejected_request_is_counted_on_the_rule_that_fired(self):
+        limiter = app.rate_limiter
+        before_ip, before_account = limiter.rejected['verify_ip'], limiter.rejected['verify_account']
+        for guess in range(6):
+            self.post('/verify', {'user_id': 424244, 'code': f'{guess:06d}'}, '10.0.4.1')
+        self.assertEqual(limiter.rejected['verify_ip'], before_ip)
+        self.assertEqual(limiter.rejected['verify_account'], before_account + 1)
+
+
+@unittest.skipUnless(TEST_REDIS_URL, "RATE_LIMIT_TEST_REDIS_URL غير محدد")
+class RedisParityTest(unittest.TestCase):
+    """سكربتات Lua يجب أن ترجع نفس الانتظار الذي يرجعه مخزن الذاكرة لنفس تسلسل الطلبات"""
+
+    def setUp(self):
+        try:
+            self.redis = app.RedisRateLimitStore(TEST_REDIS_URL, 3600)
+            self.redis.client.ping()
+        except Exception as e:
+            self.skipTest(f"Redis غير متاح: {e}")
+        self.memory = app.MemoryRateLimitStore(3600, 1000)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.buckets)
+        self.addCleanup(app.ttl_sweeper.maps.remove, self.memory.windows)
+        self.prefix = f"rl-test:{uuid.uuid4().hex}"
+        self.addCleanup(self.cleanup_keys)
+
+    def cleanup_keys(self):
+        keys = list(self.redis.client.scan_iter(f"{self.prefix}*"))
+        if keys:
+            self.redis.client.delete(*keys)
+
+    def test_take_matches_memory(self):
+        key = f"{self.prefix}:bucket"
+        for now in (100.0, 100.0, 100.0, 100.0, 100.5, 101.0, 103.0, 103.0, 110.0):
+            self.assertAlmostEqual(
+                self.redis.take(key, 3, 0.5, now), self.memory.take(key, 3, 0.5, now), places=6)
+
+    def test_hit_matches_memory(self):
+        key = f"{self.prefix}:window"
+        for now in (6000.0,) * 6 + (6599.0, 6600.0, 6750.0, 6900.0, 6900.0, 6900.0, 7300.0, 9000.0):
+            self.assertAlmostEqual(
+                self.redis.hit(key, 5, 600, now), self.memory.hit(key, 5, 600, now), places=6)
+
+
+class VerifyAccountLimitTest(RateLimitTestCase):
+    def test_sixth_guess_for_one_account_is_rejected_across_ips(self):
+        statuses = [
+            self.post('/verify', {'user_id': 424242, 'code': f'{guess:06d}'}, f'10.0.0.{guess}').status_code
+            for guess in range(6)
+        ]
+        self.assertEqual(statuses, [200] * 5 + [429])
+
+    def test_account_id_is_normalized(self):
+        for user_id in (424243, '424243', ' 424243 ', '424243', 424243):
+            self.assertEqual(self.post('/verify', {'user_id': user_id, 'code': '000000'}, '10.0.1.1').status_code, 200)
+        response = self.post('/verify', {'user_id': '424243', 'code': '000000'}, '10.0.1.2')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_other_accounts_are_not_affected(self):
+        for guess in range(5):
+            self.post('/verify', {'user_id': 515151, 'code': f'{guess:06d}'}, '10.0.2.1')
+        self.assertEqual(self.post('/verify', {'user_id': 515152, 'code': '000000'}, '10.0.2.1').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
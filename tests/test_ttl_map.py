@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""اختبارات TTLMap: المسح يحذف المنتهي فقط حتى بعد تحديث المفاتيح أو تجديدها"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STORE_BACKEND", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import app
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TTLMapTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(app.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make(self, **kwargs):
+        ttl_map = app.TTLMap('test', **kwargs)
+        self.addCleanup(app.ttl_sweeper.maps.remove, ttl_map)
+        return ttl_map
+
+    def test_sweep_removes_only_expired(self):
+        ttl_map = self.make(ttl=100)
+        ttl_map['a'] = 1
+        self.clock.now += 50
+        ttl_map['b'] = 2
+        self.clock.now += 60
+        self.assertEqual(ttl_map.sweep(), 1)
+        self.assertNotIn('a', ttl_map)
+        self.assertEqual(ttl_map['b'], 2)
+
+    def test_overwritten_key_does_not_expire_live_entries(self):
+        ttl_map = self.make(ttl=300)
+        ttl_map['code'] = 'old'
+        self.clock.now += 200
+        ttl_map['other'] = 'live'           # ينتهي عند 1500
+        ttl_map['code'] = 'new'             # المدخل القديم لـ code في رأس الـ heap
+        self.clock.now += 105               # 1305: المدخل القديم انتهى ولا شيء حي انتهى
+        self.assertEqual(ttl_map.sweep(), 0)
+        self.assertEqual(ttl_map['other'], 'live')
+        self.assertEqual(ttl_map['code'], 'new')
+        self.clock.now += 200               # 1505: other انتهى و code (1500) كذلك
+        self.assertEqual(ttl_map.sweep(), 2)
+        self.assertEqual(len(ttl_map), 0)
+
+    def test_sliding_key_is_kept_after_touch(self):
+        ttl_map = self.make(ttl=100, sliding=True)
+        ttl_map['wizard'] = {'step': 1}
+        ttl_map['idle'] = {'step': 1}
+        self.clock.now += 50
+        self.assertEqual(ttl_map['wizard'], {'step': 1})   # تجديد حتى 1150
+        self.clock.now += 55                                # 1105
+        self.assertEqual(ttl_map.sweep(), 1)
+        self.assertNotIn('idle', ttl_map)
+        self.assertIn('wizard', ttl_map)
+
+    def test_eviction_drops_oldest_live_entry(self):
+        ttl_map = self.make(ttl=100, max_size=2)
+        ttl_map['a'] = 1
+        self.clock.now += 1
+        ttl_map['b'] = 2
+        self.clock.now += 1
+        ttl_map['a'] = 3                    # a أصبح الأحدث
+        self.clock.now += 1
+        ttl_map['c'] = 4
+        self.assertNotIn('b', ttl_map)
+        self.assertEqual(ttl_map['a'], 3)
+        self.assertEqual(ttl_map['c'], 4)
+        self.assertEqual(ttl_map.evicted, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()